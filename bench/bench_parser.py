@@ -0,0 +1,172 @@
+#!/usr/bin/env python3
+# vim:fenc=utf-8 tabstop=4 expandtab shiftwidth=4 softtabstop=4
+"""
+Benchmark the qstat -f parsers in qconnect.py
+
+Compares the original per-line regex loop from check_queue() with the
+streaming text parser and the XML parser, on qstat -f output for 10, 1000 and
+50000 jobs. The outputs are generated with a fixed seed so that runs are
+comparable, real recordings can be benchmarked by passing them with --text
+and --xml.
+
+USAGE: bench/bench_parser.py [--sizes 10 1000 50000] [--text FILE] [--xml FILE]
+"""
+import os
+import sys
+import random
+from io   import BytesIO
+from time import perf_counter
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+import qconnect
+
+# A typical Torque job, the Variable_List is long enough to be wrapped
+_attributes = [('Job_Name', '{name}'), ('Job_Owner', '{user}@login01.cluster'),
+               ('resources_used.cput', '00:00:{sec:02d}'), ('resources_used.mem', '{mem}kb'),
+               ('resources_used.vmem', '{vmem}kb'), ('resources_used.walltime', '00:{min:02d}:00'),
+               ('job_state', '{state}'), ('queue', '{queue}'), ('server', 'master.cluster'),
+               ('Checkpoint', 'u'), ('ctime', 'Wed Jan 14 10:00:00 2015'),
+               ('Error_Path', 'login01:/home/{user}/.{name}.error'), ('exec_host', '{exec_host}'),
+               ('Hold_Types', 'n'), ('Join_Path', 'n'), ('Keep_Files', 'n'), ('Mail_Points', 'a'),
+               ('mtime', 'Wed Jan 14 10:00:01 2015'), ('Output_Path', 'login01:/dev/null'),
+               ('Priority', '0'), ('qtime', 'Wed Jan 14 10:00:00 2015'), ('Rerunable', 'True'),
+               ('Resource_List.mem', '4gb'), ('Resource_List.nodect', '1'),
+               ('Resource_List.nodes', '1:ppn={cores}'), ('Resource_List.walltime', '24:00:00'),
+               ('session_id', '{session}'), ('euser', '{user}'), ('egroup', 'users'),
+               ('queue_type', 'E'), ('etime', 'Wed Jan 14 10:00:00 2015'), ('submit_args', ''),
+               ('start_time', 'Wed Jan 14 10:00:01 2015'), ('start_count', '1'),
+               ('fault_tolerant', 'False'), ('job_radix', '0'), ('submit_host', 'login01.cluster')]
+_variables = ('PBS_O_QUEUE={queue},PBS_O_HOME=/home/{user},PBS_O_LOGNAME={user},'
+              'PBS_O_PATH=/usr/local/bin:/usr/bin:/bin:/usr/local/sbin:/usr/sbin,'
+              'PBS_O_MAIL=/var/spool/mail/{user},PBS_O_SHELL=/bin/bash,PBS_O_LANG=en_US.UTF-8,'
+              'PBS_O_WORKDIR=/home/{user},PBS_O_HOST=login01.cluster,PBS_O_SERVER=master')
+
+def _jobs(count, seed=42):
+    """ Yield (job_id, {field: value}) for count synthetic jobs """
+    rand = random.Random(seed)
+    for i in range(count):
+        kind  = rand.choice(['int_tmux', 'int_gui', 'int_vnc', 'batch', 'batch'])
+        state = rand.choice('QRRRC')
+        node  = 'node{:02d}'.format(rand.randint(1, 99))
+        yield str(100000 + i) + '.master.cluster', {
+            'name': kind if kind.startswith('int') else 'pipeline_' + str(i),
+            'user': 'user{}'.format(rand.randint(1, 200)),
+            'queue': 'interactive' if kind.startswith('int') else 'batch',
+            'state': state, 'sec': rand.randint(0, 59), 'min': rand.randint(0, 59),
+            'mem': rand.randint(1000, 9000000), 'vmem': rand.randint(1000, 9000000),
+            'cores': rand.randint(1, 8), 'session': rand.randint(1000, 99999),
+            'exec_host': '' if state == 'Q' else node + '/0'}
+
+def make_text(count):
+    """ Synthetic qstat -f output for count jobs """
+    out = []
+    for job_id, fields in _jobs(count):
+        out.append('Job Id: ' + job_id)
+        for key, value in _attributes:
+            value = value.format(**fields)
+            if key == 'exec_host' and not value:
+                continue
+            out.append('    {} = {}'.format(key, value))
+        # Torque wraps long values onto tab indented lines
+        variables = _variables.format(**fields)
+        out.append('    Variable_List = ' + variables[:60])
+        for i in range(60, len(variables), 70):
+            out.append('\t' + variables[i:i + 70])
+        out.append('')
+    return '\n'.join(out) + '\n'
+
+def make_xml(count):
+    """ Synthetic qstat -f -x output for count jobs """
+    out = ['<Data>']
+    for job_id, fields in _jobs(count):
+        out.append('<Job><Job_Id>' + job_id + '</Job_Id>')
+        groups = {}
+        for key, value in _attributes:
+            value = value.format(**fields)
+            if key == 'exec_host' and not value:
+                continue
+            if '.' in key:
+                group, key = key.split('.', 1)
+                groups.setdefault(group, []).append('<{0}>{1}</{0}>'.format(key, value))
+            else:
+                out.append('<{0}>{1}</{0}>'.format(key, value))
+        for group, values in groups.items():
+            out.append('<{0}>{1}</{0}>'.format(group, ''.join(values)))
+        out.append('<Variable_List>' + _variables.format(**fields) + '</Variable_List></Job>')
+    out.append('</Data>')
+    return ''.join(out)
+
+def legacy_parse(text):
+    """ The qstat -f handling of the original check_queue(), run over every
+        job: patterns compiled per job, search then findall on each line.
+        Note that this only extracts two fields and builds no records, and
+        that the original also ran one qstat subprocess per job. """
+    from re import compile as mkregex
+    jobs = []
+    for chunk in text.split('Job Id: ')[1:]:
+        find_queue = mkregex(r'queue = (.*)$')
+        find_name  = mkregex(r'Job_Name = (.*)$')
+        queue, names = '', []
+        for i in chunk.rstrip().split('\n'):
+            if find_queue.search(i):
+                queue = find_queue.findall(i)[0]
+            elif find_name.search(i):
+                names = find_name.findall(i)[0].split('_')
+        if '_'.join(names[-2:]) in qconnect.job_types:
+            jobs.append((queue, names))
+    return jobs
+
+def text_parse(text):
+    records = qconnect.split_qstat_full(text.splitlines(True), qconnect.made_by_qconnect,
+                                        qconnect.Job.attributes)
+    return list(qconnect.parse_qstat_full(records))
+
+def xml_parse(data):
+    records = qconnect.split_qstat_xml(BytesIO(data), qconnect.made_by_qconnect, qconnect.Job.attributes)
+    return list(qconnect.parse_qstat_full(records))
+
+def timeit(function, argument, repeat=3):
+    """ Best wall time of repeat runs, and the result of the last one """
+    best = float('inf')
+    for i in range(repeat):
+        start  = perf_counter()
+        result = function(argument)
+        best   = min(best, perf_counter() - start)
+    return best, result
+
+def run(label, text, xml):
+    """ Time each parser on one input and print a row per parser """
+    rows = [('legacy regex', legacy_parse, text), ('text parser', text_parse, text)]
+    if xml is not None:
+        rows.append(('xml parser', xml_parse, xml.encode()))
+    for name, function, argument in rows:
+        elapsed, result = timeit(function, argument)
+        print('{:>12}  {:<14}{:>10.4f} s  {:>13}'.format(label, name, elapsed, len(result)))
+
+def _get_args():
+    """Command Line Argument Parsing"""
+    import argparse
+    parser = argparse.ArgumentParser(description=__doc__,
+                                     formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--sizes', type=int, nargs='+', default=[10, 1000, 50000],
+                        help="Number of jobs in each generated qstat output")
+    parser.add_argument('--text', help="A recorded qstat -f output to benchmark")
+    parser.add_argument('--xml',  help="A recorded qstat -f -x output to benchmark")
+    return parser
+
+def main():
+    """Run directly"""
+    args = _get_args().parse_args()
+
+    print('{:>12}  {:<14}{:>12}  {:>13}'.format('input', 'parser', 'best of 3', 'qconnect jobs'))
+    if args.text or args.xml:
+        text = open(args.text).read() if args.text else ''
+        xml  = open(args.xml).read() if args.xml else None
+        run('recorded', text, xml)
+        return
+
+    for size in args.sizes:
+        run(str(size) + ' jobs', make_text(size), make_xml(size))
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,305 @@
+#!/usr/bin/env python3
+# vim:fenc=utf-8 tabstop=4 expandtab shiftwidth=4 softtabstop=4
+"""
+A local stand-in for qstat, qselect, qsub, qdel, ssh and xpra
+
+Lets qconnect run, and be timed, without a cluster. Symlink this file to
+the name of each command in a directory that is put first in the PATH, the
+name it is called by decides what it does. run_bench.py does all of this.
+
+The job table lives in $FAKE_PBS_STATE/jobs.json, create it with:
+
+    fake_pbs.py --init JOBS --user USER [--others N] [--batch N]
+
+Environment:
+    FAKE_PBS_STATE        Directory holding the job table (required)
+    FAKE_PBS_LATENCY      Seconds every scheduler command takes (default 0)
+    FAKE_SSH_LATENCY      Seconds every ssh command takes (default 0)
+    FAKE_PBS_START_DELAY  Seconds a new job queues before it runs (default 0)
+    FAKE_PBS_MARKERS      If set, running jobs create their ready marker in
+                          $HOME/.qconnect like the real job scripts do
+    PBS_DEFAULT           Server to use, each has its own job table in a
+                          subdirectory of FAKE_PBS_STATE (default 'fake')
+"""
+import os
+import sys
+import json
+import fcntl
+import random
+from time import sleep, time
+
+server = os.environ.get('PBS_DEFAULT') or 'fake'
+
+## Job Table
+
+class State(object):
+    """ Locked access to the job table, use as a context manager """
+    def __init__(self, write=False):
+        self.path  = os.path.join(_state_dir(), 'jobs.json')
+        self.write = write
+
+    def __enter__(self):
+        self.lock = open(self.path + '.lock', 'w')
+        fcntl.flock(self.lock, fcntl.LOCK_EX if self.write else fcntl.LOCK_SH)
+        try:
+            with open(self.path) as fin:
+                self.table = json.load(fin)
+        except (OSError, ValueError):
+            self.table = {'next_id': 1000, 'jobs': []}
+        return self
+
+    def __exit__(self, *args):
+        if self.write:
+            with open(self.path + '.tmp', 'w') as fout:
+                json.dump(self.table, fout)
+            os.replace(self.path + '.tmp', self.path)
+        self.lock.close()
+
+    @property
+    def jobs(self):
+        """ The jobs, with queued jobs that are due started """
+        now = time()
+        for job in self.table['jobs']:
+            if job['state'] == 'Q' and job['start_at'] <= now:
+                job['state']      = 'R'
+                job['start_time'] = int(job['start_at'])
+                job['exec_host']  = '+'.join('{}/0'.format(i) for i in _nodes(job))
+            if job['state'] == 'R' and os.environ.get('FAKE_PBS_MARKERS'):
+                marker = os.path.join(os.path.expanduser('~/.qconnect'), job['id'] + '.ready')
+                if not os.path.exists(marker):
+                    os.makedirs(os.path.dirname(marker), exist_ok=True)
+                    open(marker, 'w').close()
+        return self.table['jobs']
+
+def _state_dir():
+    """ The job table directory of server """
+    if server == 'fake':
+        return os.environ['FAKE_PBS_STATE']
+    return os.path.join(os.environ['FAKE_PBS_STATE'], server)
+
+def _nodes(job):
+    """ The nodes of job, the first is job['node'] """
+    number = int(job['node'][4:])
+    return ['node{:02d}'.format((number + i - 1) % 99 + 1) for i in range(job.get('nodes', 1))]
+
+def new_job(table, name, owner, queue='interactive', state='Q', cores=1, mem='4gb', start_delay=0):
+    """ Add a job to the table and return it """
+    now = int(time())
+    job = {'id': str(table['next_id']), 'name': name, 'owner': owner, 'queue': queue,
+           'state': state, 'cores': cores, 'mem': mem, 'qtime': now,
+           'start_at': now + start_delay, 'start_time': now if state == 'R' else 0,
+           'node': 'node{:02d}'.format(random.randint(1, 99)), 'exec_host': ''}
+    if state == 'R':
+        job['exec_host'] = job['node'] + '/0'
+    table['next_id'] += 1
+    table['jobs'].append(job)
+    return job
+
+def init(count, user, others=0, batch=0, seed=1):
+    """ Write a fresh job table: count interactive jobs for user, already
+        running or queued, others jobs belonging to other users, and batch
+        jobs of user's in the batch queue """
+    random.seed(seed)
+    os.makedirs(_state_dir(), exist_ok=True)
+    with State(write=True) as state:
+        state.table = {'next_id': 1000, 'jobs': []}
+        for i in range(count):
+            new_job(state.table, random.choice(['int_tmux', 'work_int_tmux', 'rstudio_int_gui']),
+                    user, state=random.choice('RRRQ'), start_delay=3600)
+        for i in range(others):
+            new_job(state.table, 'int_tmux', 'user{}'.format(i % 50), state=random.choice('RQ'),
+                    start_delay=3600)
+        for i in range(batch):
+            new_job(state.table, 'pipeline', user, queue='batch', state=random.choice('RQC'),
+                    start_delay=3600)
+
+## Output
+
+def full_text(job):
+    """ One job in qstat -f format """
+    lines = ['Job Id: {}.{}'.format(job['id'], server),
+             '    Job_Name = ' + job['name'],
+             '    Job_Owner = {}@login'.format(job['owner']),
+             '    job_state = ' + job['state'],
+             '    queue = ' + job['queue'],
+             '    server = ' + server,
+             '    ctime = ' + _ctime(job['qtime']),
+             '    qtime = ' + _ctime(job['qtime'])]
+    if job['exec_host']:
+        lines.append('    exec_host = ' + job['exec_host'])
+        lines.append('    start_time = ' + _ctime(job['start_time']))
+        lines.append('    resources_used.walltime = 00:00:{:02d}'.format(int(time() - job['start_time']) % 60))
+        lines.append('    resources_used.cput = 00:00:00')
+        lines.append('    resources_used.mem = {}kb'.format(int(job['id']) % 4096 * 1024))
+    lines += ['    Resource_List.mem = ' + job['mem'],
+              '    Resource_List.nodes = {}:ppn={}'.format(job.get('nodes', 1), job['cores']),
+              '    Resource_List.walltime = 24:00:00',
+              '    Variable_List = PBS_O_QUEUE={0},PBS_O_HOME=/home/{1},PBS_O_LOGNAME={1},'.format(job['queue'], job['owner']),
+              '\tPBS_O_PATH=/usr/local/bin:/usr/bin:/bin,PBS_O_SHELL=/bin/bash,PBS_O_LANG=C',
+              '']
+    return '\n'.join(lines) + '\n'
+
+def full_xml(job):
+    """ One job in qstat -f -x format """
+    out = ['<Job><Job_Id>{}.{}</Job_Id>'.format(job['id'], server),
+           '<Job_Name>{}</Job_Name><Job_Owner>{}@login</Job_Owner>'.format(job['name'], job['owner']),
+           '<job_state>{}</job_state><queue>{}</queue>'.format(job['state'], job['queue']),
+           '<qtime>{}</qtime>'.format(job['qtime'])]
+    if job['exec_host']:
+        out.append('<exec_host>{}</exec_host><start_time>{}</start_time>'.format(job['exec_host'], job['start_time']))
+        out.append('<resources_used><cput>00:00:00</cput><mem>{}kb</mem></resources_used>'.format(int(job['id']) % 4096 * 1024))
+    out.append('<Resource_List><mem>{}</mem><nodes>{}:ppn={}</nodes><walltime>24:00:00</walltime>'
+               '</Resource_List></Job>'.format(job['mem'], job.get('nodes', 1), job['cores']))
+    return ''.join(out)
+
+def _ctime(epoch):
+    from time import ctime
+    return ctime(epoch)
+
+## Commands
+
+def _latency(variable='FAKE_PBS_LATENCY'):
+    sleep(float(os.environ.get(variable, 0) or 0))
+
+def qstat(args):
+    _latency()
+    full  = '-f' in args
+    xml   = '-x' in args
+    names = [i for i in args if not i.startswith('-')]
+
+    with State() as state:
+        jobs = state.jobs
+    if '-Q' in args:
+        for queue in names:
+            print('Queue: ' + queue)
+            print('    state_count = Transit:0 Queued:{} Held:0 Waiting:0 Running:0 Exiting:0'.format(
+                  sum(1 for j in jobs if j['queue'] == queue and j['state'] == 'Q')))
+        return 0
+    selected = [j for j in jobs if j['id'] in [i.split('.')[0] for i in names] or j['queue'] in names]
+
+    if not full:
+        known = [j['id'] for j in selected]
+        for i in names:
+            if i.split('.')[0] not in known:
+                print('qstat: Unknown Job Id {}.{}'.format(i, server), file=sys.stderr)
+                return 153
+        print('Job ID                    Name             User            Time Use S Queue')
+        print('------------------------- ---------------- --------------- -------- - -----')
+        for j in selected:
+            print('{}.{}  {}  {}  00:00:00 {} {}'.format(j['id'], server, j['name'], j['owner'], j['state'], j['queue']))
+        return 0
+
+    if xml:
+        sys.stdout.write('<Data>' + ''.join(full_xml(j) for j in selected) + '</Data>')
+    else:
+        sys.stdout.write(''.join(full_text(j) for j in selected))
+    # Like Torque, the jobs it knows and then an error for each other one
+    known   = [j['id'] for j in selected]
+    unknown = [i for i in names if i.split('.')[0] not in known and i not in [j['queue'] for j in jobs]]
+    for i in unknown:
+        print('qstat: Unknown Job Id {}.{}'.format(i, server), file=sys.stderr)
+    return 153 if unknown else 0
+
+def qselect(args):
+    _latency()
+    options = dict(zip(args[::2], args[1::2]))
+    with State() as state:
+        jobs = state.jobs
+    for j in jobs:
+        if '-u' in options and not j['owner'] == options['-u']:
+            continue
+        if '-q' in options and not j['queue'] == options['-q']:
+            continue
+        if '-s' in options and j['state'] not in options['-s']:
+            continue
+        if '-A' in options and not j.get('account') == options['-A']:
+            continue
+        print('{}.{}'.format(j['id'], server))
+    return 0
+
+def qsub(args):
+    _latency()
+    script = sys.stdin.read()
+    name, queue, nodes, cores, array, account = 'STDIN', 'batch', 1, 1, 0, ''
+    for line in script.split('\n'):
+        if line.startswith('#PBS -N '):
+            name = line.split()[-1]
+        elif line.startswith('#PBS -q '):
+            queue = line.split()[-1]
+        elif line.startswith('#PBS -l nodes='):
+            nodes = int(line.split('=')[1].split(':')[0])
+            cores = int(line.split('ppn=')[-1])
+        elif line.startswith('#PBS -A '):
+            account = line.split()[-1]
+        elif line.startswith('#PBS -t '):
+            array = int(line.split('-')[-1]) + 1
+    delay = float(os.environ.get('FAKE_PBS_START_DELAY', 0) or 0)
+    user  = os.environ.get('USER', 'bench')
+    with State(write=True) as state:
+        job = new_job(state.table, name, user, queue=queue, cores=cores, start_delay=delay)
+        job['account'] = account
+        job['nodes']   = nodes
+        if array:
+            # The first job stands in for the whole array
+            print('{}[].{}'.format(job['id'], server))
+            return 0
+    print('{}.{}'.format(job['id'], server))
+    return 0
+
+def qdel(args):
+    _latency()
+    ids = [i.split('.')[0] for i in args]
+    with State(write=True) as state:
+        for job in state.jobs:
+            if job['id'] in ids:
+                job['state'] = 'C'
+    return 0
+
+def ssh(args):
+    _latency('FAKE_SSH_LATENCY')
+    command = []
+    while args:
+        arg = args.pop(0)
+        if arg in ('-o', '-O'):
+            option = args.pop(0)
+            if arg == '-O':
+                # No real master connections to check or stop
+                return 255 if option == 'check' else 0
+        elif arg.startswith('-'):
+            if arg == '-N':
+                return 0
+        else:
+            command = args
+            break
+    command = ' '.join(command)
+    # Only the probe asks for an answer, attaching runs tmux on the
+    # terminal, which would land in the benchmark's output
+    if 'echo tmux:yes' in command:
+        print('tmux:yes')
+    return 0
+
+def xpra(args):
+    if args and args[0] == 'attach':
+        sleep(0.1)
+    return 0
+
+commands = {'qstat': qstat, 'qselect': qselect, 'qsub': qsub, 'qdel': qdel, 'ssh': ssh, 'xpra': xpra}
+
+def main():
+    """Run directly"""
+    name = os.path.basename(sys.argv[0])
+    if name in commands:
+        sys.exit(commands[name](sys.argv[1:]))
+
+    import argparse
+    parser = argparse.ArgumentParser(description=__doc__,
+                                     formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--init', type=int, required=True, help="Number of interactive jobs for the user")
+    parser.add_argument('--user', required=True, help="The user running qconnect")
+    parser.add_argument('--others', type=int, default=0, help="Number of jobs belonging to other users")
+    parser.add_argument('--batch', type=int, default=0, help="Number of batch jobs for the user")
+    args = parser.parse_args()
+    init(args.init, args.user, args.others, args.batch)
+
+if __name__ == '__main__':
+    main()
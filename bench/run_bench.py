@@ -0,0 +1,154 @@
+#!/usr/bin/env python3
+# vim:fenc=utf-8 tabstop=4 expandtab shiftwidth=4 softtabstop=4
+"""
+Benchmark qconnect end to end against the fake scheduler in fake_pbs.py
+
+Times check_queue, print_jobs, create_job and try_to_attach with 1, 100 and
+10000 interactive jobs in the queue, alongside as many batch jobs of the same
+user. Everything runs in a scratch directory: fake_pbs.py is linked in as
+qstat, qselect, qsub, qdel, ssh and xpra at the front of the PATH, and HOME
+and XDG_RUNTIME_DIR point into it, so nothing touches a real cluster or the
+real ~/.qconnect.
+
+try_to_attach submits a job that the fake scheduler starts after
+--start-delay seconds, the time reported is how long after that the attach
+finished, which is the cost of the wait strategy plus attaching.
+
+Each run is appended as one JSON line to the --results file together with
+the git commit, so that changes can be compared over time.
+
+USAGE: bench/run_bench.py [--sizes 1 100 10000] [--latency SECONDS]
+                          [--ssh-latency SECONDS] [--start-delay SECONDS]
+                          [--wait-strategy fixed|backoff] [--results FILE]
+"""
+import os
+import sys
+import json
+import shutil
+import tempfile
+import subprocess
+from io       import StringIO
+from time     import perf_counter, strftime
+from contextlib import redirect_stdout
+
+bench_dir = os.path.dirname(os.path.abspath(__file__))
+fake_pbs  = os.path.join(bench_dir, 'fake_pbs.py')
+user      = 'bench'
+
+def setup(scratch, latency, ssh_latency, start_delay):
+    """ Put the fake commands first in the PATH and sandbox HOME, must run
+        before qconnect is imported """
+    bin_dir = os.path.join(scratch, 'bin')
+    os.makedirs(bin_dir)
+    for name in ['qstat', 'qselect', 'qsub', 'qdel', 'ssh', 'xpra']:
+        os.symlink(fake_pbs, os.path.join(bin_dir, name))
+    os.environ.update({'PATH': bin_dir + os.pathsep + os.environ['PATH'],
+                       'HOME': os.path.join(scratch, 'home'),
+                       'XDG_RUNTIME_DIR': os.path.join(scratch, 'run'),
+                       'USER': user,
+                       'FAKE_PBS_STATE': os.path.join(scratch, 'pbs'),
+                       'FAKE_PBS_LATENCY': str(latency),
+                       'FAKE_SSH_LATENCY': str(ssh_latency),
+                       'FAKE_PBS_START_DELAY': str(start_delay),
+                       'FAKE_PBS_MARKERS': '1'})
+    for directory in ['home', 'run']:
+        os.makedirs(os.path.join(scratch, directory), mode=0o700)
+
+def timeit(function, repeat=3):
+    """ Best wall time of repeat runs with output discarded, and the result
+        of the last one """
+    best = float('inf')
+    for i in range(repeat):
+        with redirect_stdout(StringIO()):
+            start  = perf_counter()
+            result = function()
+            best   = min(best, perf_counter() - start)
+    return best, result
+
+def bench_size(qconnect, size, start_delay):
+    """ Time each operation with size jobs in the queue """
+    import fake_pbs
+    fake_pbs.init(size, user, others=size // 10, batch=size)
+    results = {}
+
+    results['check_queue'], (jobs, _) = timeit(lambda: qconnect.check_queue(user))
+    results['print_jobs'], _          = timeit(lambda: qconnect.print_jobs(jobs))
+    results['create_job'], _          = timeit(lambda: qconnect.create_job(), repeat=1)
+
+    # Submit outside the timer, the job starts start_delay seconds later
+    with redirect_stdout(StringIO()):
+        job_id = qconnect.create_job()
+    start = perf_counter()
+    try:
+        with redirect_stdout(StringIO()):
+            qconnect.try_to_attach(job_id)
+        results['try_to_attach'] = perf_counter() - start - start_delay
+    except SystemExit as err:
+        print('try_to_attach exited with {} at {} jobs'.format(err.code, size), file=sys.stderr)
+        results['try_to_attach'] = None
+    return results
+
+def git_commit():
+    """ Short hash of the checked out commit, if there is one """
+    try:
+        return subprocess.check_output(['git', 'rev-parse', '--short', 'HEAD'], cwd=bench_dir,
+                                       stderr=subprocess.DEVNULL).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return ''
+
+def _get_args():
+    """Command Line Argument Parsing"""
+    import argparse
+    parser = argparse.ArgumentParser(description=__doc__,
+                                     formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--sizes', type=int, nargs='+', default=[1, 100, 10000],
+                        help="Number of the user's jobs in the queue for each run")
+    parser.add_argument('--latency', type=float, default=0.05,
+                        help="Seconds every fake scheduler command takes (default 0.05)")
+    parser.add_argument('--ssh-latency', type=float, default=0.02,
+                        help="Seconds every fake ssh command takes (default 0.02)")
+    parser.add_argument('--start-delay', type=float, default=2,
+                        help="Seconds a submitted job queues before it runs (default 2)")
+    parser.add_argument('--wait-strategy',
+                        choices=['fixed', 'backoff'], help="Override qconnect's wait_strategy")
+    parser.add_argument('--results', default=os.path.join(bench_dir, 'results.jsonl'),
+                        help="File to append the results to (default bench/results.jsonl)")
+    return parser
+
+def main():
+    """Run directly"""
+    args    = _get_args().parse_args()
+    scratch = tempfile.mkdtemp(prefix='qconnect-bench-')
+    try:
+        setup(scratch, args.latency, args.ssh_latency, args.start_delay)
+        sys.path.insert(0, os.path.join(bench_dir, '..'))
+        import qconnect
+        qconnect.uid           = user
+        qconnect.cache_ttl     = 0
+        # A daemon on this machine would answer from the real queue
+        qconnect.daemon_socket = ''
+        if args.wait_strategy:
+            qconnect.wait_strategy = args.wait_strategy
+
+        record = {'date': strftime('%Y-%m-%dT%H:%M:%S'), 'commit': git_commit(),
+                  'version': qconnect.version, 'latency': args.latency,
+                  'ssh_latency': args.ssh_latency, 'start_delay': args.start_delay,
+                  'wait_strategy': qconnect.wait_strategy, 'sizes': {}}
+
+        print('{:>8}  {:>12}  {:>12}  {:>12}  {:>13}'.format(
+            'jobs', 'check_queue', 'print_jobs', 'create_job', 'try_to_attach'))
+        for size in args.sizes:
+            results = bench_size(qconnect, size, args.start_delay)
+            record['sizes'][str(size)] = results
+            print('{:>8}  {:>10.4f} s  {:>10.4f} s  {:>10.4f} s  {:>11} s'.format(
+                size, results['check_queue'], results['print_jobs'], results['create_job'],
+                'failed' if results['try_to_attach'] is None else '{:.4f}'.format(results['try_to_attach'])))
+    finally:
+        shutil.rmtree(scratch, ignore_errors=True)
+
+    with open(args.results, 'a') as fout:
+        fout.write(json.dumps(record) + '\n')
+    print('\nAppended to', args.results)
+
+if __name__ == '__main__':
+    main()
@@ -10,11 +10,16 @@ fi
 
 while getopts :iuh OPTS; do
   case $OPTS in
-    i)  install -m755 qconnect.py /usr/bin/
-        ln -s /usr/bin/qconnect.py /usr/bin/qconnect
+    i)  # The launcher imports qconnect.py from its own directory, compile
+        # it here as users can't write the cache there
+        install -d /usr/lib/qconnect
+        install -m755 qconnect qconnect.py /usr/lib/qconnect/
+        python3 -m compileall -q /usr/lib/qconnect
+        rm -f /usr/bin/qconnect /usr/bin/qconnect.py
+        ln -s /usr/lib/qconnect/qconnect /usr/bin/qconnect
         install -m644 qconnect.1.gz /usr/share/man/man1/
         ;;
-    u)  rm /usr/bin/qconnect.py
+    u)  rm -r /usr/lib/qconnect
         rm /usr/bin/qconnect
         rm /usr/share/man/man1/qconnect.1.gz
         ;;
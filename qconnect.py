@@ -25,203 +25,3407 @@
 #                                            #
 ##############################################
 
+# Batch system: 'torque', 'pbspro' or 'slurm' (needs squeue --json, Slurm 21.08+)
+scheduler = 'torque'
+
 # Queue Options
-interactive_queue = 'interactive'
+interactive_queue = 'interactive'  # The partition for Slurm
 short_queue_name  = 'interact'   # The queue name displayed when you run qstat -n -1
 
-# Interactive Node Options
-default_cores     = 1
-default_max_cores = 8   # Used for calculating memory request, set to total cores on node
-default_max_mem   = 32  # In GB, used to calculate a default memory based on number of cores
+# Submit jobs under this account (-A) and select them by it, so that queue
+# scans only ever see qconnect jobs. Only set it to an account you may use
+job_account = ''
+
+# To use several batch servers, list them in this file, see Clusters below.
+# Without it qconnect uses the default server with the options above
+cluster_file = '~/.config/qconnect/clusters.ini'
+
+# Interactive Node Options
+default_cores     = 1
+default_nodes     = 1   # Sessions can span several nodes with --nodes
+default_max_cores = 8   # Used for calculating memory request, set to total cores on node
+default_max_mem   = 32  # In GB, used to calculate a default memory based on number of cores
+
+# How to find the node names in exec_host, e.g. node01/0-3+node02/0-3. For
+# each '+' separated entry the first pattern that matches gives the name, its
+# first group if it has one. The default is the host name up to the first '/'
+# or '.', add patterns in front for nodes named differently
+node_patterns = [r'^([^/.]+)']
+
+# Default VNC geometry
+vnc_geometry = '1280x1024'
+
+# Seconds a queue scan is reused by later qconnect runs, 0 disables the cache
+cache_ttl = 15
+
+# Waiting for queued jobs. 'backoff' starts checking every wait_initial
+# seconds and slows down to wait_max, 'fixed' always waits wait_initial
+wait_strategy = 'backoff'
+wait_initial  = 1
+wait_max      = 60
+
+# SSH connections to a compute node are shared by every command qconnect
+# runs against it, and closed after ssh_persist idle seconds. 0 disables this
+ssh_persist = 600
+
+# Remote work (qstat -f batches, node probes) runs in parallel, at most
+# max_parallel commands at once. Any single command is abandoned after
+# command_timeout seconds, so one hung node can't stall qconnect
+max_parallel    = 4
+command_timeout = 30
+
+# Largest number of job ids passed to a single qstat -f
+qstat_batch = 100
+
+# Use the XML output of qstat -f (qstat -x), falls back to text if unsupported.
+# The text parser is faster, XML is only worth it if wrapped lines get mangled
+qstat_xml = False
+
+# Directory on the shared filesystem where jobs report that they are ready.
+# Lets qconnect attach the moment a session is usable, set to '' to disable
+state_dir = '~/.qconnect'
+
+# Directory for your own job templates, see --template and --dry-run
+template_dir = '~/.config/qconnect/templates'
+
+# Jobs run 'qconnect --agent' on the compute node to supervise the session.
+# This is the path to qconnect on the nodes, '' means the path of this script.
+# If it isn't executable on the node the job falls back to a shell loop
+agent_path = ''
+
+# Keep up to pool_size idle tmux sessions running, so that qconnect attaches
+# to one at once instead of waiting for a new job to start. A replacement is
+# submitted in the background whenever one is used, and unused sessions end
+# after pool_idle_timeout seconds. 0 disables the pool, which needs state_dir
+pool_size         = 0
+pool_idle_timeout = 3600
+
+# Socket of the login node daemon (qconnect --serve), which scans the queue
+# every daemon_interval seconds for all users and answers their qconnect runs.
+# Without a daemon qconnect asks the scheduler itself. '' disables both
+daemon_socket   = '/run/qconnect/qconnect.sock'
+daemon_interval = 10
+
+# Remember what the last history_size sessions actually used, in state_dir.
+# --auto-size then requests the auto_size_percentile of the peak memory (times
+# auto_size_headroom) and of the average core use per node of finished
+# sessions with the same name, once there are at least auto_size_min of them
+history_size         = 200
+auto_size_percentile = 90
+auto_size_headroom   = 1.2
+auto_size_min        = 3
+
+# A session is idle while no tmux or xpra client is attached and its processes
+# use less than idle_cpu of a core, the agent checks every idle_check seconds.
+# Sessions idle for idle_warn seconds are flagged, and qconnect --reap ends
+# them after idle_reap seconds, as does the agent itself if idle_agent_reap
+# is set. 0 disables each of these
+idle_check      = 60
+idle_cpu        = 0.05
+idle_warn       = 4 * 3600
+idle_reap       = 24 * 3600
+idle_agent_reap = False
+
+# Queue waits, attach times and scheduler command times are recorded as JSON
+# lines in <state_dir>/events.jsonl, which is rotated to events.jsonl.1 every
+# metrics_max_events or so (0 disables this). qconnect --metrics adds new
+# events to Prometheus histograms with these bucket bounds in seconds, kept
+# in <state_dir>/metrics.json. metrics_sources is a glob of the event files it
+# reads, e.g. '/home/*/.qconnect/events.jsonl' for all users, '' reads your own
+metrics_max_events      = 10000
+metrics_sources         = ''
+metrics_wait_buckets    = [10, 30, 60, 120, 300, 600, 1800, 3600, 4 * 3600, 24 * 3600]
+metrics_latency_buckets = [0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30]
+
+# Debuging - prints a bunch of stuff
+debug = False
+
+##############################################
+#                                            #
+#      Do Not Edit Below This Line           #
+#                                            #
+##############################################
+
+## Imports
+import subprocess
+import sys, os
+import json
+import re
+import threading
+import signal
+import shlex
+import contextvars
+
+# Aliases
+from re          import findall      as find
+from collections import OrderedDict
+from functools   import lru_cache
+from sys         import stderr
+from os          import getuid
+from pwd         import getpwuid
+from time        import sleep, time, perf_counter
+
+## Global Variables
+
+# Get user name, no subprocess required
+uid = getpwuid(getuid()).pw_name
+
+# Version string
+version = '1.8.1'
+
+# Append a JSON line for every external command to this file, '' to disable
+profile_log = ''
+
+## Command Runner
+# Every external command qconnect runs goes through Popen, run, call,
+# check_call or rn below. They behave like their subprocess namesakes, and
+# also record the wall time, exit code and output size of each command
+# against the phase (see phase()) that qconnect was in when it started.
+# --profile prints a breakdown of these at exit.
+
+_started  = perf_counter()
+_commands = []
+_phases   = OrderedDict()
+_phase    = {'name': 'startup', 'since': _started}
+_record   = {'commands': True}
+
+# The scheduler's own commands, only these are sent to the server of the
+# cluster in use (see Clusters)
+scheduler_commands = ('qstat', 'qselect', 'qsub', 'qdel', 'qalter', 'squeue', 'sbatch', 'scancel', 'scontrol',
+                      'sacct')
+
+class Popen(subprocess.Popen):
+    """ subprocess.Popen that records itself once it has been waited for.
+        Set output_bytes before waiting if the caller reads the output. """
+    def __init__(self, args, **kwargs):
+        self.output_bytes = 0
+        self.record       = None
+        self._start       = perf_counter()
+        self._phase       = _phase['name']
+        self._cluster     = current_cluster()
+        # Scheduler commands go to the server of the cluster in use. Nothing
+        # else gets its variables: sessions started on a node must keep the
+        # environment of their own job
+        program = args.split()[:1] if isinstance(args, str) else list(args[:1])
+        if ('env' not in kwargs and program and os.path.basename(program[0]) in scheduler_commands
+                and self._cluster.env()):
+            kwargs['env'] = dict(os.environ, **self._cluster.env())
+        super().__init__(args, **kwargs)
+
+    def wait(self, timeout=None):
+        returncode = super().wait(timeout)
+        if self.record is None:
+            self.record = OrderedDict([('time', time()), ('phase', self._phase),
+                                       ('cluster', self._cluster.name),
+                                       ('command', self.args if isinstance(self.args, str) else ' '.join(self.args)),
+                                       ('wall', perf_counter() - self._start),
+                                       ('returncode', returncode), ('bytes', self.output_bytes)])
+            if _record['commands']:
+                _commands.append(self.record)
+        return returncode
+
+def run(command, input=None, timeout=None, check=False, **kwargs):
+    """ subprocess.run through the recording Popen """
+    if input is not None:
+        kwargs['stdin'] = subprocess.PIPE
+    with Popen(command, **kwargs) as process:
+        try:
+            stdout, stderr_out = process.communicate(input, timeout=timeout)
+        except subprocess.TimeoutExpired:
+            process.kill()
+            process.communicate()
+            raise
+        process.record['bytes'] = len(stdout or '') + len(stderr_out or '')
+    if check and process.returncode:
+        raise subprocess.CalledProcessError(process.returncode, command, stdout, stderr_out)
+    return subprocess.CompletedProcess(command, process.returncode, stdout, stderr_out)
+
+def call(command, timeout=None, **kwargs):
+    """ subprocess.call through the recording Popen """
+    with Popen(command, **kwargs) as process:
+        try:
+            return process.wait(timeout=timeout)
+        except subprocess.TimeoutExpired:
+            process.kill()
+            process.wait()
+            raise
+
+def check_call(command, **kwargs):
+    """ subprocess.check_call through the recording Popen """
+    returncode = call(command, **kwargs)
+    if returncode:
+        raise subprocess.CalledProcessError(returncode, command)
+    return 0
+
+def rn(command, **kwargs):
+    """ subprocess.check_output through the recording Popen """
+    return run(command, stdout=subprocess.PIPE, check=True, **kwargs).stdout
+
+class _CountingReader(object):
+    """ Wrap a process output stream to count the bytes read from it """
+    def __init__(self, process):
+        self.process = process
+        self.stream  = process.stdout
+
+    def read(self, size=-1):
+        data = self.stream.read(size)
+        self.process.output_bytes += len(data)
+        return data
+
+    def __iter__(self):
+        for line in self.stream:
+            self.process.output_bytes += len(line)
+            yield line
+
+def _switch_phase(name):
+    now = perf_counter()
+    _phases[_phase['name']] = _phases.get(_phase['name'], 0) + now - _phase['since']
+    _phase['name']  = name
+    _phase['since'] = now
+
+class phase(object):
+    """ Context manager (or decorator) that attributes time, and the
+        commands run, to the named phase of a qconnect run """
+    def __init__(self, name):
+        self.name = name
+
+    def __enter__(self):
+        self.previous = _phase['name']
+        _switch_phase(self.name)
+        return self
+
+    def __exit__(self, *args):
+        _switch_phase(self.previous)
+
+    def __call__(self, function):
+        from functools import wraps
+        @wraps(function)
+        def wrapper(*args, **kwargs):
+            with phase(self.name):
+                return function(*args, **kwargs)
+        return wrapper
+
+def stop_recording():
+    """ Keep no more commands, for the daemon and the node agent, which run
+        for days and would hold every command they ran in memory """
+    _record['commands'] = False
+    del _commands[:]
+
+def print_profile(file=stderr):
+    """ Print the time spent in each phase and in external commands """
+    _switch_phase(_phase['name'])
+    print("\nqconnect profile, {:.3f}s total".format(perf_counter() - _started), file=file)
+    print("Phase".ljust(13) + "Wall".rjust(10) + "Commands".rjust(10) + "Cmd_Time".rjust(10), file=file)
+    print("=".ljust(11, '=') + "  " + "=".ljust(8, '=') + "  " + "=".ljust(8, '=') + "  " + "=".ljust(8, '='), file=file)
+    for name, wall in _phases.items():
+        commands = [i for i in _commands if i['phase'] == name]
+        print(name.ljust(13) + "{:9.3f}s".format(wall) + str(len(commands)).rjust(10) +
+              "{:9.3f}s".format(sum(i['wall'] for i in commands)), file=file)
+
+    if _commands:
+        print("\nSlowest commands", file=file)
+        for i in sorted(_commands, key=lambda i: -i['wall'])[:10]:
+            print("{:8.3f}s  rc={:<4} {:>9} B  [{}] {}".format(i['wall'], str(i['returncode']), i['bytes'],
+                                                               i['phase'], i['command'][:80]), file=file)
+
+def write_profile_log(path):
+    """ Append every recorded command, and a summary of the run, to path
+        as JSON lines """
+    _switch_phase(_phase['name'])
+    try:
+        with open(os.path.expanduser(path), 'a') as fout:
+            for i in _commands:
+                fout.write(json.dumps(i) + '\n')
+            fout.write(json.dumps(OrderedDict([('time', time()), ('run', ' '.join(sys.argv[1:])),
+                                               ('wall', perf_counter() - _started),
+                                               ('phases', _phases)])) + '\n')
+    except OSError as err:
+        print("Could not write profile log {}: {}".format(path, err), file=stderr)
+
+## Lazy Initialization
+# Nothing in this section runs at import time. Everything is computed the
+# first time it is needed and then remembered for the rest of the run, so
+# that --version and --help never touch the PATH or the PBS server.
+
+@lru_cache(maxsize=None)
+def installed(program):
+    """ Return True if program is in the PATH. The PATH is searched
+        in-process and only once per program. """
+    from shutil import which
+    return which(program) is not None
+
+def xpra_installed():
+    """ Is xpra available for GUI sessions """
+    return installed('xpra')
+
+def vnc_installed():
+    """ Is vncviewer available for VNC sessions """
+    return installed('vncviewer')
+
+@lru_cache(maxsize=None)
+def runtime_dir():
+    """ Return a private per-user directory for local state, or '' if no
+        safe directory is available """
+    if os.environ.get('XDG_RUNTIME_DIR'):
+        path = os.path.join(os.environ['XDG_RUNTIME_DIR'], 'qconnect')
+    else:
+        path = os.path.join('/tmp', 'qconnect-' + str(getuid()))
+    try:
+        os.makedirs(path, mode=0o700, exist_ok=True)
+        if not os.stat(path).st_uid == getuid():
+            return ''
+    except OSError:
+        return ''
+    return path
+
+## Job Cache
+# The parsed job list is kept on disk with a timestamp so that qconnect runs
+# in quick succession share one queue scan. All access goes through an
+# exclusive lock, so concurrent runs wait for a scan in progress instead of
+# starting their own.
+
+class _FileLock(object):
+    """ Exclusive flock on the file path, does nothing if path is None """
+    def __init__(self, path):
+        self.path = path
+
+    def __enter__(self):
+        self.lock = None
+        if self.path:
+            import fcntl
+            self.lock = open(self.path, 'w')
+            fcntl.flock(self.lock, fcntl.LOCK_EX)
+        return self
+
+    def __exit__(self, *args):
+        if self.lock:
+            self.lock.close()
+
+class _CacheLock(_FileLock):
+    """ Exclusive lock on the job cache, does nothing if there is no cache """
+    def __init__(self):
+        super().__init__(os.path.join(runtime_dir(), 'jobs.lock') if cache_ttl and runtime_dir() else None)
+
+def _cache_file():
+    return os.path.join(runtime_dir(), 'jobs.json')
+
+def _load_cache():
+    """ Return the cached {'user', 'time', 'jobs'} dictionary or None """
+    if not cache_ttl or not runtime_dir():
+        return None
+    try:
+        with open(_cache_file()) as fin:
+            cache = json.load(fin, object_pairs_hook=OrderedDict)
+    except (OSError, ValueError):
+        return None
+    if not cache.get('user') == uid:
+        return None
+    _queue_lengths.update(cache.get('queued') or {})
+    try:
+        cache['jobs'] = OrderedDict((k, Job(**v)) for k, v in cache['jobs'].items())
+    except (TypeError, KeyError, AttributeError):
+        # Written by an older qconnect
+        return None
+    return cache
+
+def _write_cache(jobs, timestamp=None):
+    """ Atomically replace the cache with jobs """
+    if not cache_ttl or not runtime_dir():
+        return
+    tmp = _cache_file() + '.' + str(os.getpid())
+    try:
+        with open(tmp, 'w') as fout:
+            json.dump({'user': uid, 'time': timestamp or time(), 'queued': _queue_lengths,
+                       'jobs': OrderedDict((k, v.to_dict()) for k, v in jobs.items())}, fout)
+        os.replace(tmp, _cache_file())
+    except OSError as err:
+        if debug:
+            print("Could not write job cache: {}".format(err), file=stderr)
+
+def drop_cache():
+    """ Forget the cached scan, so that the next run sees jobs submitted
+        since """
+    if not cache_ttl or not runtime_dir():
+        return
+    with _CacheLock():
+        try:
+            os.remove(_cache_file())
+        except OSError:
+            pass
+
+@phase('queue scan')
+def get_jobs(refresh=False):
+    """ Return the interactive job list for this user. A cached scan is
+        used if it is younger than cache_ttl, unless refresh is True.
+        Otherwise the daemon is asked, and the queue only if there is none.
+        None if no cluster answered. """
+    failed = []
+    with _CacheLock():
+        cache = None if refresh else _load_cache()
+        if cache and time() - cache['time'] < cache_ttl:
+            return cache['jobs']
+        jobs = daemon_jobs(refresh)
+        if jobs is None:
+            jobs, failed = check_queue(uid)
+        if not failed:
+            _write_cache(jobs)
+    if failed:
+        # The jobs of the clusters that failed are missing, so this list
+        # must neither be cached nor mark them as done in the history
+        return None if len(failed) == len(get_clusters()) else jobs
+    record_history(jobs)
+    return jobs
+
+def update_cached_job(job_id, state):
+    """ Record a state change seen outside of a full scan. Jobs that left
+        the queue are dropped, as are jobs that started running, as their
+        node is not known until the next scan. """
+    with _CacheLock():
+        cache = _load_cache()
+        if not cache or not cache['jobs'] or job_id not in cache['jobs']:
+            return
+        jobs = cache['jobs']
+        if jobs[job_id].state == state:
+            return
+        if state in ('Q', 'H', 'W'):
+            jobs[job_id].state = state
+        else:
+            del jobs[job_id]
+        _write_cache(jobs, cache['time'])
+
+## Session History
+# What sessions actually used, from the resources_used attributes of queue
+# scans, kept in <state_dir>/history.json as {job_id: record}. Every fresh
+# scan raises the peak usage of running sessions, and marks the sessions that
+# have left the queue as done. Only done sessions count for --auto-size.
+# Usage is for the whole job, nodes is the number of nodes it ran on.
+
+def history_file():
+    """ Path of the session history """
+    return os.path.join(os.path.expanduser(state_dir), 'history.json')
+
+def history_key(job_name, type):
+    """ Sessions are sized by type and name, e.g. tmux/work or gui/rstudio """
+    return type + '/' + job_name
+
+def load_history():
+    """ Return the session history, {} if there is none """
+    if not history_size or not state_dir:
+        return {}
+    try:
+        with open(history_file()) as fin:
+            return json.load(fin)
+    except (OSError, ValueError):
+        return {}
+
+def record_history(jobs):
+    """ Update the history from jobs, the result of a fresh queue scan.
+        Concurrent runs take turns, and it is only written if it changed. """
+    if not history_size or not state_dir:
+        return
+    try:
+        os.makedirs(os.path.dirname(history_file()), exist_ok=True)
+        with _FileLock(history_file() + '.lock'):
+            _update_history(jobs)
+    except OSError as err:
+        if debug:
+            print("Could not write session history: {}".format(err), file=stderr)
+
+def _update_history(jobs):
+    history = load_history()
+    changed = False
+    for job_id, record in history.items():
+        if not record['done'] and job_id not in jobs:
+            record['done'] = True
+            changed        = True
+    for job_id, job in jobs.items():
+        if not job.state == 'R':
+            continue
+        record = history.setdefault(job_id, {'key': history_key(job.job_name, job.type),
+                                             'cores': job.cores, 'mem': job.mem, 'mem_used': 0,
+                                             'cput': 0, 'walltime': 0, 'nodes': job.node_count})
+        before = dict(record)
+        record.update(done=False,
+                      mem_used=max(record['mem_used'], job.mem_used),
+                      cput=max(record['cput'], job.cput_used),
+                      walltime=max(record['walltime'], job.walltime_used))
+        if not record == before:
+            record['time'] = int(time())
+            changed        = True
+    if not changed:
+        return
+
+    # Keep the most recently seen sessions
+    if len(history) > history_size:
+        keep    = sorted(history, key=lambda i: history[i]['time'])[-history_size:]
+        history = {i: history[i] for i in keep}
+    tmp = history_file() + '.' + str(os.getpid())
+    with open(tmp, 'w') as fout:
+        json.dump(history, fout)
+    os.replace(tmp, history_file())
+
+def _percentile(values, percent):
+    """ Nearest rank percentile of a non-empty list of numbers """
+    values = sorted(values)
+    rank   = -(-len(values) * percent // 100)
+    return values[min(max(rank, 1), len(values)) - 1]
+
+def auto_size(job_name, type):
+    """ Return (cores, mem_gb) per node for a new session from the done
+        sessions of the same name and type, None if there are fewer than
+        auto_size_min with usage recorded """
+    from math import ceil
+    key  = history_key(job_name, type)
+    done = [i for i in load_history().values() if i['key'] == key and i['done'] and i['mem_used']]
+    if len(done) < auto_size_min:
+        return None
+
+    # Sessions from before nodes was recorded ran on one node
+    mem   = [i['mem_used'] / i.get('nodes', 1) for i in done]
+    mem   = _percentile(mem, auto_size_percentile) * auto_size_headroom
+    mem   = min(max(1, ceil(mem / 1024 ** 3)), default_max_mem)
+
+    # Average cores in use, from sessions that ran long enough to tell
+    load  = [i['cput'] / i['walltime'] / i.get('nodes', 1) for i in done if i['walltime'] >= 60]
+    cores = ceil(_percentile(load, auto_size_percentile)) if load else default_cores
+    cores = min(max(1, cores), default_max_cores)
+    return cores, mem
+
+## Metrics
+# Events are single JSON lines appended to <state_dir>/events.jsonl:
+#
+#   queue_wait  seconds from submitting a session to first attaching to it
+#   attach      seconds attach_job took to get the session on screen, or
+#               ok=false if it could not
+#   command     wall time of one scheduler command (qstat, qsub, squeue...)
+#
+# Every line carries the time, user and cluster. Appends take a lock on the
+# file, which is renamed to events.jsonl.1 once it holds about
+# metrics_max_events. qconnect --metrics adds the events of metrics_sources
+# that it hasn't seen yet to the histograms and counters in
+# <state_dir>/metrics.json, which stores how far it has read each source, so
+# totals keep counting up across rotations. It adds the sessions running on
+# each node from a fresh scan of all users, and writes them all in the
+# Prometheus text format.
+
+# {job id: time} of the jobs submitted by this run, their queue wait starts
+# then rather than at the scheduler's qtime
+_submitted = {}
+
+def events_file():
+    """ Path of this user's events """
+    return os.path.join(os.path.expanduser(state_dir), 'events.jsonl')
+
+def record_events(events):
+    """ Append events, dictionaries with at least 'event', to the events file """
+    if not metrics_max_events or not state_dir or not events:
+        return
+    import fcntl
+    lines = ''
+    for event in events:
+        event = OrderedDict([('time', round(event.pop('time', time()), 3)), ('user', uid),
+                             ('cluster', current_cluster().name)], **event)
+        lines += json.dumps(event) + '\n'
+    path = events_file()
+    try:
+        os.makedirs(os.path.expanduser(state_dir), exist_ok=True)
+        while True:
+            fout = open(path, 'a')
+            fcntl.flock(fout, fcntl.LOCK_EX)
+            try:
+                if os.path.samestat(os.fstat(fout.fileno()), os.stat(path)):
+                    break
+            except OSError:
+                pass
+            # Rotated while waiting for the lock
+            fout.close()
+        with fout:
+            fout.write(lines)
+            fout.flush()
+            # Lines are about 150 bytes. Rotating rather than cutting the
+            # file back keeps the offsets that --metrics has read up to
+            if fout.tell() > metrics_max_events * 150:
+                os.replace(path, path + '.1')
+    except OSError as err:
+        if debug:
+            print("Could not record events: {}".format(err), file=stderr)
+
+def record_event(event, **fields):
+    """ Append one event, see record_events() """
+    record_events([OrderedDict([('event', event)], **fields)])
+
+def record_command_events():
+    """ Record the scheduler commands run so far, at exit """
+    record_events([OrderedDict([('time', i['time']), ('event', 'command'), ('cluster', i['cluster']),
+                                ('command', i['command'].split()[0]), ('seconds', round(i['wall'], 4)),
+                                ('ok', not i['returncode'])])
+                   for i in _commands if os.path.basename(i['command'].split()[0]) in scheduler_commands])
+
+def _read_events(path, offset):
+    """ Return (events, offset) for the complete lines of path after
+        offset, and the offset they end at. Unparseable lines are skipped. """
+    events = []
+    with open(path, 'rb') as fin:
+        fin.seek(offset)
+        for line in fin:
+            if not line.endswith(b'\n'):
+                # Still being appended, read it next time
+                break
+            offset += len(line)
+            try:
+                events.append(json.loads(line.decode()))
+            except ValueError:
+                continue
+    return events, offset
+
+def load_events(offsets):
+    """ The events in metrics_sources after offsets, {path: [inode, offset]},
+        which is updated to the end of what was read. A source rotated since
+        is read to its end as <path>.1 first, as is all of <path>.1 for a new
+        source. Unreadable files are skipped. """
+    from glob import glob
+    files  = sorted(glob(os.path.expanduser(metrics_sources))) if metrics_sources else [events_file()]
+    events = []
+    for path in files:
+        try:
+            inode = os.stat(path).st_ino
+            # Never read before, so start with what is left of the last rotation
+            last, offset = offsets.get(path, (None, 0))
+            if last is None:
+                try:
+                    events += _read_events(path + '.1', 0)[0]
+                except OSError:
+                    pass
+            elif not inode == last:
+                try:
+                    if os.stat(path + '.1').st_ino == last:
+                        events += _read_events(path + '.1', offset)[0]
+                except OSError:
+                    # Rotated twice, those events are lost
+                    pass
+                offset = 0
+            elif os.path.getsize(path) < offset:
+                # Cut back by something else, start over
+                offset = 0
+            read, offset = _read_events(path, offset)
+        except OSError:
+            continue
+        events      += read
+        offsets[path] = [inode, offset]
+    return events
+
+def metrics_state_file():
+    """ Path of the cumulative metrics """
+    return os.path.join(os.path.expanduser(state_dir), 'metrics.json')
+
+def load_metrics_state():
+    """ Return the cumulative metrics, {} if there are none """
+    if not state_dir:
+        return {}
+    try:
+        with open(metrics_state_file()) as fin:
+            return json.load(fin)
+    except (OSError, ValueError):
+        return {}
+
+def save_metrics_state(state):
+    """ Write the cumulative metrics, atomically """
+    if not state_dir:
+        return
+    tmp = metrics_state_file() + '.' + str(os.getpid())
+    try:
+        os.makedirs(os.path.dirname(tmp), exist_ok=True)
+        with open(tmp, 'w') as fout:
+            json.dump(state, fout)
+        os.replace(tmp, metrics_state_file())
+    except OSError as err:
+        print("Could not write metrics state: {}".format(err), file=stderr)
+
+class Histogram(object):
+    """ Cumulative Prometheus histogram, one series per set of labels """
+    __slots__ = ('name', 'help', 'buckets', 'series')
+
+    def __init__(self, name, help, buckets):
+        self.name    = name
+        self.help    = help
+        self.buckets = sorted(buckets)
+        self.series  = OrderedDict()
+
+    def observe(self, value, **labels):
+        key    = tuple(sorted(labels.items()))
+        series = self.series.setdefault(key, {'buckets': [0] * len(self.buckets), 'sum': 0, 'count': 0})
+        for i, bound in enumerate(self.buckets):
+            if value <= bound:
+                series['buckets'][i] += 1
+        series['sum']   += value
+        series['count'] += 1
+
+    def state(self):
+        """ JSON for load(), with the buckets it was counted in """
+        return {'buckets': self.buckets, 'series': [[k, v] for k, v in self.series.items()]}
+
+    def load(self, state):
+        """ Carry on from state(), unless the buckets have changed since """
+        if state and state.get('buckets') == self.buckets:
+            self.series = OrderedDict((_key(k), v) for k, v in state['series'])
+
+    def lines(self):
+        out = ['# HELP {} {}'.format(self.name, self.help), '# TYPE {} histogram'.format(self.name)]
+        for key, series in self.series.items():
+            for bound, count in zip(self.buckets + ['+Inf'], series['buckets'] + [series['count']]):
+                out.append('{}_bucket{} {}'.format(self.name, _labels(key + (('le', _number(bound)),)), count))
+            out.append('{}_sum{} {}'.format(self.name, _labels(key), _number(round(series['sum'], 4))))
+            out.append('{}_count{} {}'.format(self.name, _labels(key), series['count']))
+        return out
+
+def _number(value):
+    """ Prometheus number, without a needless .0 """
+    return str(int(value)) if isinstance(value, float) and value.is_integer() else str(value)
+
+def _labels(key):
+    """ {a="1",b="2"} for ((a, 1), (b, 2)), labels with empty values left out """
+    labels = ['{}="{}"'.format(k, str(v).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n'))
+              for k, v in key if not v == '']
+    return '{' + ','.join(labels) + '}' if labels else ''
+
+def _key(pairs):
+    """ Labels key from JSON, where it became a list of lists """
+    return tuple(tuple(i) for i in pairs)
+
+def _gauge(name, help, values):
+    """ Lines of a gauge from {labels key: value} """
+    out = ['# HELP {} {}'.format(name, help), '# TYPE {} gauge'.format(name)]
+    out += ['{}{} {}'.format(name, _labels(k), v) for k, v in values.items()]
+    return out
+
+def metrics_text():
+    """ All metrics in the Prometheus text format """
+    waits    = Histogram('qconnect_queue_wait_seconds',
+                         'Time from submitting a session to first attaching to it', metrics_wait_buckets)
+    attaches = Histogram('qconnect_attach_seconds',
+                         'Time from asking to attach to a running session to being attached', metrics_latency_buckets)
+    commands = Histogram('qconnect_scheduler_command_seconds',
+                         'Wall time of scheduler commands run by qconnect', metrics_latency_buckets)
+    state    = load_metrics_state()
+    counters = state.get('counters', {})
+    failures = OrderedDict((_key(k), v) for k, v in counters.get('attach_failures', []))
+    errors   = OrderedDict((_key(k), v) for k, v in counters.get('command_errors', []))
+    for histogram in (waits, attaches, commands):
+        histogram.load(state.get('histograms', {}).get(histogram.name))
+    offsets  = state.get('sources', {})
+
+    for event in load_events(offsets):
+        try:
+            cluster = event.get('cluster', '')
+            if event['event'] == 'queue_wait':
+                waits.observe(event['seconds'], cluster=cluster)
+            elif event['event'] == 'attach' and event.get('ok', True):
+                attaches.observe(event['seconds'], cluster=cluster, type=event.get('type', ''))
+            elif event['event'] == 'attach':
+                key = (('cluster', cluster), ('type', event.get('type', '')))
+                failures[key] = failures.get(key, 0) + 1
+            elif event['event'] == 'command':
+                commands.observe(event['seconds'], cluster=cluster, command=event['command'])
+                if not event.get('ok', True):
+                    key = (('cluster', cluster), ('command', event['command']))
+                    errors[key] = errors.get(key, 0) + 1
+        except (KeyError, TypeError, AttributeError):
+            continue
+    save_metrics_state({'sources': offsets,
+                        'histograms': {i.name: i.state() for i in (waits, attaches, commands)},
+                        'counters': {'attach_failures': [[k, v] for k, v in failures.items()],
+                                     'command_errors': [[k, v] for k, v in errors.items()]}})
+
+    # Sessions now, from a scan of everyone's jobs
+    sessions = OrderedDict()
+    queued   = OrderedDict()
+    for job in scan_clusters(None)[0]:
+        if job.state == 'R':
+            for node in job.nodes:
+                key = (('cluster', job.cluster), ('node', node))
+                sessions[key] = sessions.get(key, 0) + 1
+        elif job.state in queued_states:
+            key = (('cluster', job.cluster),)
+            queued[key] = queued.get(key, 0) + 1
+
+    out  = waits.lines() + attaches.lines() + commands.lines()
+    out += ['# HELP qconnect_attach_failures_total Attaches that found no session to attach to',
+            '# TYPE qconnect_attach_failures_total counter']
+    out += ['qconnect_attach_failures_total{} {}'.format(_labels(k), v) for k, v in failures.items()]
+    out += ['# HELP qconnect_scheduler_command_errors_total Scheduler commands that failed',
+            '# TYPE qconnect_scheduler_command_errors_total counter']
+    out += ['qconnect_scheduler_command_errors_total{} {}'.format(_labels(k), v) for k, v in errors.items()]
+    out += _gauge('qconnect_sessions', 'Interactive sessions running on each node', sessions)
+    out += _gauge('qconnect_sessions_queued', 'Interactive sessions waiting to start', queued)
+    return '\n'.join(out) + '\n'
+
+def write_metrics(path):
+    """ Write metrics_text() to path, atomically so that a collector never
+        reads half a file, or to stdout if path is '-' """
+    text = metrics_text()
+    if path == '-':
+        sys.stdout.write(text)
+        return
+    path = os.path.expanduser(path)
+    tmp  = path + '.' + str(os.getpid())
+    try:
+        with open(tmp, 'w') as fout:
+            fout.write(text)
+        os.chmod(tmp, 0o644)
+        os.replace(tmp, path)
+    except OSError as err:
+        print("Could not write metrics to {}: {}".format(path, err), file=stderr)
+        sys.exit(1)
+
+## Parallel Execution
+# One thread pool of max_parallel workers is shared by everything, which is
+# what enforces the global limit. Work submitted to it must not submit more
+# work and wait on it, or it could deadlock. Work runs on the cluster in use
+# when it was submitted.
+
+@lru_cache(maxsize=None)
+def _executor():
+    from concurrent.futures import ThreadPoolExecutor
+    return ThreadPoolExecutor(max_workers=max_parallel)
+
+def run_parallel(function, items, timeout=None):
+    """ Call function(item) for every item on the shared pool, return an
+        OrderedDict of {item: result} in the order of items. Calls that raise
+        or don't finish within timeout seconds (default command_timeout)
+        map to the exception instead. """
+    from concurrent.futures import TimeoutError
+    timeout = command_timeout if timeout is None else timeout
+    items   = list(items)
+
+    # Don't bother with threads for a single call
+    if len(items) == 1:
+        try:
+            return OrderedDict([(items[0], function(items[0]))])
+        except Exception as err:
+            return OrderedDict([(items[0], err)])
+
+    futures  = OrderedDict((i, _executor().submit(contextvars.copy_context().run, function, i))
+                           for i in items)
+    deadline = time() + timeout
+    results  = OrderedDict()
+    for item, future in futures.items():
+        try:
+            results[item] = future.result(timeout=max(0, deadline - time()))
+        except TimeoutError as err:
+            future.cancel()
+            results[item] = err
+        except Exception as err:
+            results[item] = err
+    return results
+
+def _kill_after(process, timeout=None):
+    """ Start a timer that kills process after timeout seconds (default
+        command_timeout), cancel the returned timer once it is done """
+    timer = threading.Timer(command_timeout if timeout is None else timeout, process.kill)
+    timer.daemon = True
+    timer.start()
+    return timer
+
+## qstat Parsing
+# All qstat output is parsed here into Job records. Patterns are compiled once
+# at import, and qstat -f output is streamed so that large queues are never
+# held in memory as text.
+
+# qstat <job_id> status rows. Header and separator lines don't match.
+_status_row  = re.compile(r'^(?P<job_id>[0-9]+\S*)\s+(?P<name>\S+)\s+(?P<user>\S+)\s+'
+                          r'\S+\s+(?P<state>[A-Z])\s+(?P<queue>\S+)\s*$')
+
+# qstat -f lines
+_job_header  = re.compile(r'^Job Id:\s*(\S+)')
+_attribute   = re.compile(r'^\s+([\w.]+) = (.*)$')
+
+
+# Job_Name suffixes that mark qconnect jobs
+job_types = {'int_tmux': 'tmux', 'int_vnc': 'vnc', 'int_gui': 'gui'}
+
+class Job(object):
+    """ One interactive job, built from qstat -f attributes.
+        Times are in seconds, qtime and start_time are epoch seconds,
+        mem_used is in bytes. nodes are the nodes the job runs on, node_count
+        the number of nodes it asked for. """
+    __slots__ = ('job_id', 'job_name', 'type', 'queue', 'nodes', 'state', 'owner',
+                 'cores', 'mem', 'walltime', 'walltime_used', 'mem_used', 'cput_used',
+                 'qtime', 'start_time', 'cluster', 'node_count')
+
+    # The qstat -f attributes from_attributes reads, the parsers can skip
+    # the others
+    attributes = frozenset(('Job_Name', 'Job_Owner', 'queue', 'job_state', 'exec_host', 'qtime', 'start_time',
+                            'Resource_List.mem', 'Resource_List.walltime', 'Resource_List.nodes',
+                            'Resource_List.ncpus', 'Resource_List.procs', 'Resource_List.select',
+                            'Resource_List.nodect', 'resources_used.walltime', 'resources_used.mem',
+                            'resources_used.cput'))
+
+    def __init__(self, job_id, job_name, type, queue, nodes=(), state='', owner='',
+                 cores=0, mem='', walltime=0, walltime_used=0, mem_used=0, cput_used=0,
+                 qtime=0, start_time=0, cluster='', node_count=1):
+        self.job_id        = job_id
+        self.job_name      = job_name
+        self.type          = type
+        self.queue         = queue
+        self.nodes         = tuple(nodes)
+        self.state         = state
+        self.owner         = owner
+        self.cores         = cores
+        self.mem           = mem
+        self.walltime      = walltime
+        self.walltime_used = walltime_used
+        self.mem_used      = mem_used
+        self.cput_used     = cput_used
+        self.qtime         = qtime
+        self.start_time    = start_time
+        self.cluster       = cluster
+        self.node_count    = node_count
+
+    @property
+    def node(self):
+        """ The node the job runs on, '' if it isn't running """
+        return self.nodes[0] if self.nodes else ''
+
+    def used(self, now=None):
+        """ Walltime used so far, counted from the start time if known so
+            that it stays current without asking the queue again """
+        if self.state == 'R' and self.start_time:
+            return max(0, int((now or time()) - self.start_time))
+        return self.walltime_used
+
+    def remaining(self, now=None):
+        """ Walltime left, None if the job has no walltime limit """
+        if not self.walltime:
+            return None
+        return max(0, self.walltime - self.used(now))
+
+    def queued(self, now=None):
+        """ Seconds spent waiting in the queue, up to now if still queued """
+        if not self.qtime:
+            return None
+        end = self.start_time if self.start_time and not self.state == 'Q' else (now or time())
+        return max(0, int(end - self.qtime))
+
+    @classmethod
+    def from_attributes(cls, job_id, attributes):
+        """ Build a Job from a qstat -f attribute dictionary, return None if
+            this isn't a qconnect job """
+        name, type = split_job_name(attributes.get('Job_Name', ''))
+        if not type:
+            return None
+
+        cluster = current_cluster()
+        return cls(qualify(short_id(job_id), cluster), name, type,
+                   attributes.get('queue', ''), parse_exec_host(attributes.get('exec_host', '')),
+                   attributes.get('job_state', ''),
+                   attributes.get('Job_Owner', '').split('@')[0],
+                   cores         = _parse_cores(attributes),
+                   mem           = attributes.get('Resource_List.mem', ''),
+                   walltime      = _parse_duration(attributes.get('Resource_List.walltime', '')),
+                   walltime_used = _parse_duration(attributes.get('resources_used.walltime', '')),
+                   mem_used      = _parse_size(attributes.get('resources_used.mem', '')),
+                   cput_used     = _parse_duration(attributes.get('resources_used.cput', '')),
+                   qtime         = _parse_time(attributes.get('qtime', '')),
+                   start_time    = _parse_time(attributes.get('start_time', '')),
+                   cluster       = cluster.name,
+                   node_count    = _parse_node_count(attributes))
+
+    def to_dict(self):
+        """ Plain dictionary for storing in the cache """
+        return OrderedDict((i, getattr(self, i)) for i in self.__slots__)
+
+    def __repr__(self):
+        return 'Job({})'.format(', '.join('{}={!r}'.format(i, getattr(self, i)) for i in self.__slots__))
+
+def split_job_name(job_name):
+    """ Return (name, type) for a qconnect job name, the type suffix is
+        stripped and the bare type is the default name. type is None if
+        qconnect didn't create the job. """
+    names = job_name.split('_')
+    type  = job_types.get('_'.join(names[-2:]))
+    if not type:
+        return job_name, None
+    return '_'.join(names[:-2]) or type, type
+
+def made_by_qconnect(job_name):
+    """ Did qconnect create the job called job_name """
+    return split_job_name(job_name)[1] is not None
+
+@lru_cache(maxsize=None)
+def _node_patterns(patterns):
+    return [re.compile(i) for i in patterns]
+
+def parse_exec_host(exec_host):
+    """ Node names in exec_host in order, each once: node01/0-3+node02/0-3
+        -> ['node01', 'node02'] """
+    nodes = []
+    for host in exec_host.split('+'):
+        for pattern in _node_patterns(tuple(current_cluster().node_patterns)):
+            match = pattern.search(host.strip())
+            if match:
+                node = match.group(1) if pattern.groups else match.group(0)
+                if node and node not in nodes:
+                    nodes.append(node)
+                break
+    return nodes
+
+@lru_cache(maxsize=4096)
+def _parse_duration(value):
+    """ [[HH:]MM:]SS -> seconds, 0 if empty or unparseable. Cached, as
+        every job of a queue has the same few walltimes """
+    seconds = 0
+    try:
+        for part in value.split(':'):
+            seconds = seconds * 60 + int(part)
+    except ValueError:
+        return 0
+    return seconds
+
+_size       = re.compile(r'^([0-9]+)([kmgt]?)(b|w)?$', re.I)
+_size_units = {'': 1, 'k': 1024, 'm': 1024 ** 2, 'g': 1024 ** 3, 't': 1024 ** 4}
+
+def _parse_size(value):
+    """ PBS sizes -> bytes: 2048kb -> 2097152, 0 if empty or unparseable.
+        Sizes in words are taken to be 8 bytes a word. """
+    size = _size.match(value.strip())
+    if not size:
+        return 0
+    number, unit, word = size.groups()
+    return int(number) * _size_units[unit.lower()] * (8 if word and word.lower() == 'w' else 1)
+
+def _parse_time(value):
+    """ qstat times -> epoch seconds. The XML output has epoch seconds,
+        the text output has e.g. 'Wed Jan 14 10:00:00 2015'. """
+    if not value:
+        return 0
+    if value.isdigit():
+        return int(value)
+    return _parse_date(value)
+
+_months = {name: i for i, name in enumerate(
+    ('Jan', 'Feb', 'Mar', 'Apr', 'May', 'Jun', 'Jul', 'Aug', 'Sep', 'Oct', 'Nov', 'Dec'), 1)}
+
+@lru_cache(maxsize=4096)
+def _parse_date(value):
+    """ 'Wed Jan 14 10:00:00 2015' -> epoch seconds, 0 if unparseable.
+        Jobs submitted together share their times, so these are cached, and
+        split by hand as strptime is slow enough to show on large queues. """
+    from time import mktime
+    try:
+        weekday, month, day, clock, year = value.split()
+        hour, minute, second = clock.split(':')
+        return int(mktime((int(year), _months[month], int(day), int(hour), int(minute), int(second),
+                           0, 0, -1)))
+    except (ValueError, KeyError, OverflowError):
+        return 0
+
+_ppn = re.compile(r'(?:^|\+)(?:(\d+)|[^:+]+)(?::ppn=(\d+))?')
+
+def _parse_cores(attributes):
+    """ Total cores requested: nodes=2:ppn=4 -> 8, else ncpus or procs """
+    nodes = attributes.get('Resource_List.nodes', '')
+    if nodes:
+        cores = 0
+        for count, ppn in _ppn.findall(nodes):
+            cores += int(count or 1) * int(ppn or 1)
+        return cores
+    for key in ('Resource_List.ncpus', 'Resource_List.procs'):
+        if attributes.get(key, '').isdigit():
+            return int(attributes[key])
+    return 0
+
+def _parse_node_count(attributes):
+    """ Nodes requested: nodes=2:ppn=4+node05 -> 3, PBS Pro's
+        select=2:ncpus=4 -> 2, else nodect, 1 if none of them are set """
+    for key in ('Resource_List.nodes', 'Resource_List.select'):
+        if attributes.get(key):
+            return sum(int(count or 1) for count, ppn in _ppn.findall(attributes[key])) or 1
+    if attributes.get('Resource_List.nodect', '').isdigit():
+        return int(attributes['Resource_List.nodect'])
+    return 1
+
+def format_duration(seconds):
+    """ seconds -> H:MM:SS, '--' for None """
+    if seconds is None:
+        return '--'
+    return '{}:{:02d}:{:02d}'.format(int(seconds) // 3600, int(seconds) % 3600 // 60, int(seconds) % 60)
+
+def short_id(job_id):
+    """ Strip the server name from a job id: 1234.server -> 1234 """
+    return job_id.split('.')[0]
+
+def split_qstat_full(lines, wanted=None, keep=None):
+    """ Split the output of qstat -f into per-job records.
+        Takes any iterable of lines, yields (job_id, {attribute: value}).
+        Attributes wrapped onto tab-indented continuation lines are joined.
+        Jobs whose Job_Name wanted (if given) returns False for are skipped
+        as soon as the name is read, and only the attributes in keep (if
+        given) are collected. """
+    job_id     = ''
+    attributes = {}
+    key        = ''
+    skip       = False
+
+    # Attribute lines are by far the most common, so they are checked first
+    # with plain string operations, the patterns only see the rest
+    for line in lines:
+        if skip:
+            # Torque lists Job_Name first, so this is most of the job
+            if not line.startswith('Job Id:'):
+                continue
+            skip = False
+        if line.startswith('    '):
+            name, sep, value = line.partition(' = ')
+            if sep:
+                key = name.strip()
+                if keep and key not in keep:
+                    key = ''
+                    continue
+                attributes[key] = value.rstrip()
+                if key == 'Job_Name' and wanted and not wanted(attributes[key]):
+                    job_id = ''
+                    skip   = True
+                continue
+        if line.startswith('\t'):
+            if key:
+                attributes[key] = attributes[key] + line.strip()
+            continue
+
+        header = _job_header.match(line)
+        if header:
+            if job_id:
+                yield job_id, attributes
+            job_id     = header.group(1)
+            attributes = {}
+            key        = ''
+            continue
+
+        attribute = _attribute.match(line)
+        if attribute:
+            key, value = attribute.groups()
+            if keep and key not in keep:
+                key = ''
+                continue
+            attributes[key] = value.rstrip()
+
+    if job_id:
+        yield job_id, attributes
+
+def split_qstat_xml(stream, wanted=None, keep=None):
+    """ Split the output of qstat -f -x into per-job records.
+        Takes a binary file object, yields (job_id, {attribute: value}).
+        Nested resource attributes are flattened to e.g. Resource_List.mem.
+        Jobs whose Job_Name wanted (if given) returns False for are skipped,
+        and only the attributes in keep (if given) are collected. """
+    from xml.etree.ElementTree import iterparse
+
+    for event, element in iterparse(stream):
+        if not element.tag == 'Job':
+            continue
+        if wanted and not wanted((element.findtext('Job_Name') or '').strip()):
+            element.clear()
+            continue
+        job_id     = (element.findtext('Job_Id') or '').strip()
+        attributes = {}
+        for child in element:
+            if len(child):
+                for resource in child:
+                    key = child.tag + '.' + resource.tag
+                    if not keep or key in keep:
+                        attributes[key] = (resource.text or '').strip()
+            elif not keep or child.tag in keep:
+                attributes[child.tag] = (child.text or '').strip()
+        attributes.pop('Job_Id', None)
+        element.clear()
+        yield job_id, attributes
+
+def split_qstat_json(data):
+    """ Split the output of PBS Pro's qstat -f -F json into per-job records.
+        Yields (job_id, {attribute: value}) like split_qstat_full, nested
+        resource attributes are flattened and stime is also start_time.
+        Raises ValueError if data isn't valid JSON. """
+    for job_id, job in json.loads(data).get('Jobs', {}).items():
+        attributes = {}
+        for key, value in job.items():
+            if isinstance(value, dict):
+                for resource, resource_value in value.items():
+                    attributes[key + '.' + resource] = str(resource_value)
+            else:
+                attributes[key] = str(value)
+        attributes.setdefault('start_time', attributes.get('stime', ''))
+        yield job_id, attributes
+
+def parse_qstat_full(records):
+    """ Turn (job_id, attributes) records into Job objects, skipping jobs
+        that qconnect didn't create """
+    for job_id, attributes in records:
+        job = Job.from_attributes(job_id, attributes)
+        if job:
+            yield job
+
+def qstat_full(job_ids, query=None):
+    """ Yield (job_id, attributes) for every job in job_ids. Up to
+        qstat_batch ids go to a single qstat -f (or the given query
+        function), larger sets are split into batches that are queried in
+        parallel. Raises SchedulerError if any of them fails. """
+    query   = query or _qstat_full
+    job_ids = list(job_ids)
+    if len(job_ids) <= qstat_batch:
+        for record in query(job_ids):
+            yield record
+        return
+
+    batches = [tuple(job_ids[i:i + qstat_batch]) for i in range(0, len(job_ids), qstat_batch)]
+    for batch, records in run_parallel(lambda i: list(query(i)), batches).items():
+        if isinstance(records, Exception):
+            raise SchedulerError("qstat failed for {} jobs: {}".format(len(batch), records))
+        for record in records:
+            yield record
+
+def _qstat_full(job_ids, xml=None):
+    """ Run one qstat -f for all job_ids (or queue names, to get every job
+        in a queue) and yield (job_id, attributes) for every job record as
+        the output streams in. Jobs that have left the
+        queue in the meantime are silently skipped by qstat. Uses the XML
+        output if xml (default qstat_xml) is set, falling back to text if
+        that fails. qstat is killed if it takes longer than command_timeout.
+        Only jobs qconnect created are yielded. Raises SchedulerError if
+        qstat fails. """
+    job_ids = list(job_ids)
+    if not job_ids:
+        return
+    if xml is None:
+        xml = qstat_xml
+
+    if xml:
+        from xml.etree.ElementTree import ParseError
+        qstat = Popen(['qstat', '-f', '-x'] + job_ids, stdout=subprocess.PIPE,
+                      stderr=subprocess.PIPE)
+        timer = _kill_after(qstat)
+        count = 0
+        try:
+            for record in split_qstat_xml(_CountingReader(qstat), made_by_qconnect, Job.attributes):
+                count += 1
+                yield record
+            parsed = True
+        except ParseError:
+            # Empty output just means no jobs, anything else means that
+            # this qstat can't do XML, so try again with text
+            parsed = bool(count)
+        finally:
+            timer.cancel()
+            qstat.stdout.close()
+            qstat.wait()
+            errors = qstat.stderr.read()
+            qstat.stderr.close()
+        if parsed:
+            check_qstat(qstat, errors)
+            return
+
+    qstat = Popen(['qstat', '-f'] + job_ids, stdout=subprocess.PIPE,
+                  stderr=subprocess.PIPE, universal_newlines=True)
+    timer = _kill_after(qstat)
+    try:
+        for record in split_qstat_full(_CountingReader(qstat), made_by_qconnect, Job.attributes):
+            yield record
+    finally:
+        timer.cancel()
+        qstat.stdout.close()
+        qstat.wait()
+        errors = qstat.stderr.read()
+        qstat.stderr.close()
+    check_qstat(qstat, errors)
+
+def check_qstat(qstat, errors):
+    """ Raise SchedulerError if the finished qstat (or squeue) failed, other
+        than for jobs that have left the queue, given what it wrote to
+        stderr """
+    if not qstat.returncode:
+        return
+    if qstat.returncode < 0:
+        raise SchedulerError("{} was killed after {} s".format(qstat.args[0], command_timeout))
+    if isinstance(errors, bytes):
+        errors = errors.decode(errors='replace')
+    errors = [i.strip() for i in errors.splitlines() if i.strip()]
+    failed = [i for i in errors if not _unknown_job.search(i)]
+    if failed or not errors:
+        raise SchedulerError(failed[0] if failed else "{} exited with {}".format(
+                             qstat.args[0], qstat.returncode))
+
+## Schedulers
+# Everything that depends on the batch system goes through the object
+# returned by get_scheduler(), chosen by the scheduler option. Each backend
+# lists jobs, gets jobs by id, submits job scripts, and waits for a job to
+# leave the queue, and translates its job states to the Torque letters (Q, R,
+# C, ...) that the rest of qconnect uses. Each uses the cheapest bulk query
+# its scheduler offers.
+
+# Job states that mean the job is still waiting to run
+queued_states = ('Q', 'H', 'W', 'T')
+
+# What qstat and squeue say for jobs that have left the queue
+_unknown_job = re.compile(r'Unknown Job|Invalid job id')
+
+class SchedulerError(Exception):
+    """ A scheduler query failed, so its answer says nothing about the jobs """
+
+# qstat -Q -f, e.g. state_count = Transit:0 Queued:5 Held:0 ...
+_queued_count = re.compile(r'state_count = .*\bQueued:([0-9]+)')
+
+class Torque(object):
+    """ Torque: qselect picks the user's active interactive jobs on the
+        server, and only those are fetched with qstat -f """
+    # Job script header template, and a shell expression for the job id
+    header       = 'header'
+    job_id_shell = '${PBS_JOBID%%.*}'
+    # The job's nodes, head node first, separated by spaces
+    nodes_shell  = '$(cut -d. -f1 "$PBS_NODEFILE" | awk \'!seen[$0]++\' | paste -sd \' \')'
+
+    # Every job state but completed, for qselect -s
+    active_states = 'QRHWTSE'
+
+    def _query(self, args):
+        """ Yield (job_id, attributes) records from one qstat -f """
+        return _qstat_full(args)
+
+    def select(self, user):
+        """ Ids of user's jobs (everyone's if user is None) in the
+            interactive queue that have not completed, and are under
+            job_account if it is set. None if qselect failed. """
+        cluster = current_cluster()
+        command = ['qselect', '-q', cluster.queue, '-s', self.active_states]
+        if user:
+            command += ['-u', user]
+        if cluster.account:
+            command += ['-A', cluster.account]
+        try:
+            qselect = run(command, stdout=subprocess.PIPE, stderr=subprocess.DEVNULL,
+                          timeout=command_timeout)
+        except (subprocess.SubprocessError, OSError):
+            return None
+        if qselect.returncode:
+            return None
+        return qselect.stdout.decode().split()
+
+    def list_jobs(self, user=None):
+        """ Yield a Job for every qconnect job of user's (or everyone's) in
+            the interactive queue. Backends might return more jobs than
+            that, the caller still has to check. """
+        # -t lists the individual jobs of job arrays
+        queue   = current_cluster().queue
+        job_ids = self.select(user)
+        if job_ids is None or len(job_ids) > qstat_batch:
+            # No usable qselect, or so many jobs that one qstat of the
+            # whole queue is cheaper than several batches
+            records = self._query(['-t', queue])
+        elif job_ids:
+            records = self._query(['-t'] + job_ids)
+        else:
+            return
+        for job in parse_qstat_full(records):
+            if job.queue == queue:
+                yield job
+
+    def queued_count(self):
+        """ Number of jobs waiting in the interactive queue, None if it
+            can't be told """
+        try:
+            output = run(['qstat', '-Q', '-f', current_cluster().queue], stdout=subprocess.PIPE,
+                         stderr=subprocess.DEVNULL, timeout=command_timeout).stdout.decode()
+        except (subprocess.SubprocessError, OSError):
+            return None
+        count = _queued_count.search(output)
+        return int(count.group(1)) if count else None
+
+    def get_jobs(self, job_ids):
+        """ Yield a Job for every qconnect job in job_ids that is still
+            known to the scheduler """
+        return parse_qstat_full(qstat_full([bare_id(i) for i in job_ids], self._query))
+
+    def _status(self, job_id, options=()):
+        """ Output of qstat for a single job, '' if the server doesn't know
+            the job and None if qstat failed """
+        try:
+            qstat = run(['qstat'] + list(options) + [job_id], stdout=subprocess.PIPE,
+                        stderr=subprocess.PIPE, timeout=command_timeout)
+        except (subprocess.SubprocessError, OSError):
+            return None
+        if qstat.returncode:
+            return '' if b'Unknown Job' in qstat.stderr else None
+        return qstat.stdout.decode()
+
+    def job_state(self, job_id):
+        """ State of job_id, '' if the scheduler doesn't know it and None if
+            it couldn't be asked """
+        status = self._status(bare_id(job_id))
+        if status is None:
+            return None
+        for line in status.split('\n'):
+            row = _status_row.match(line)
+            if row:
+                return row.group('state')
+        return ''
+
+    def wait_for_state(self, job_id, strategy, ready=False, notify=None):
+        """ Wait until job_id leaves the queued states, pausing before every
+            check as long as strategy says. Returns (state, ready), where ready
+            is True once the job has dropped its ready marker. notify(state)
+            is called whenever the job is found still queued. If the scheduler
+            can't be asked, the job is checked again after the next wait. """
+        stale  = False
+        failed = False
+        while True:
+            if not ready or stale:
+                ready = strategy.wait(job_id, marker=not stale) or ready
+            state = check_job(job_id)
+            if state is not None and state not in queued_states:
+                return state, ready
+            # A ready marker of a job that is still queued is left over from
+            # a requeue or a crashed node, it must not cut the waits short
+            stale = ready
+            if state is None and not failed:
+                print("Could not get the state of job {}, still trying".format(job_id), file=stderr)
+            failed = state is None
+            if notify and state:
+                notify(state)
+
+    def submit(self, script):
+        """ Submit script with qsub, return (job_id, '') on success or
+            ('', error message) on failure """
+        try:
+            pbs_submit = run(['qsub'], input=script.encode(), stdout=subprocess.PIPE,
+                             stderr=subprocess.STDOUT, timeout=command_timeout)
+        except (subprocess.SubprocessError, OSError) as err:
+            return '', str(err)
+
+        # Get job number, array jobs come back as 1234[]
+        message = pbs_submit.stdout.decode().rstrip()
+        job_no  = find(r'^[0-9]+(?:\[\])?', message)
+        if pbs_submit.returncode or not job_no:
+            return '', message
+        return qualify(job_no[0]), ''
+
+    def rename(self, job_id, name):
+        """ Change the name of job_id, return True on success """
+        try:
+            return call(['qalter', '-N', name, bare_id(job_id)], stdout=subprocess.DEVNULL,
+                        stderr=subprocess.DEVNULL, timeout=command_timeout) == 0
+        except (subprocess.SubprocessError, OSError):
+            return False
+
+    def delete(self, job_id):
+        """ End job_id, return True on success """
+        try:
+            return call(['qdel', bare_id(job_id)], stdout=subprocess.DEVNULL,
+                        stderr=subprocess.DEVNULL, timeout=command_timeout) == 0
+        except (subprocess.SubprocessError, OSError):
+            return False
+
+    def array_ids(self, job_id, count):
+        """ The ids of the count jobs in the job array job_id """
+        return [job_id.replace('[]', '[{}]'.format(i)) for i in range(count)]
+
+    def job_id_from_environment(self):
+        """ Id of the job we are running in, '' outside of a job """
+        return short_id(os.environ.get('PBS_JOBID', ''))
+
+class PBSPro(Torque):
+    """ PBS Pro: like Torque, but qstat -f -F json replaces the XML, which
+        qstat -x means something else here, and finished jobs need -x """
+    header = 'header_pbspro'
+
+    # B is an array that has started
+    active_states = 'QRHWTSEB'
+
+    def _query(self, args):
+        try:
+            qstat = run(['qstat', '-f', '-F', 'json'] + list(args), stdout=subprocess.PIPE,
+                        stderr=subprocess.PIPE, timeout=command_timeout)
+        except (subprocess.SubprocessError, OSError) as err:
+            raise SchedulerError("qstat failed: {}".format(err))
+        check_qstat(qstat, qstat.stderr)
+        if not qstat.stdout.strip():
+            return []
+        try:
+            return list(split_qstat_json(qstat.stdout.decode()))
+        except ValueError:
+            # Some versions don't escape everything in Variable_List
+            return _qstat_full(args, xml=False)
+
+    def _status(self, job_id, options=()):
+        # -x includes finished jobs
+        return super(PBSPro, self)._status(job_id, ('-x',) + tuple(options))
+
+    def job_state(self, job_id):
+        state = super(PBSPro, self).job_state(job_id)
+        # Finished, or a finished job of an array
+        return 'C' if state in ('F', 'X') else state
+
+# Slurm job states as Torque letters, anything not here has ended
+slurm_states = {'PENDING': 'Q', 'CONFIGURING': 'Q', 'REQUEUED': 'Q', 'RESIZING': 'Q',
+                'REQUEUE_HOLD': 'H', 'REQUEUE_FED': 'Q', 'RUNNING': 'R', 'SUSPENDED': 'S',
+                'STOPPED': 'S', 'SIGNALING': 'R', 'COMPLETING': 'E', 'STAGE_OUT': 'E'}
+
+_hostlist = re.compile(r'([^,\[]+)(?:\[([^\]]*)\])?')
+
+def expand_hostlist(hosts):
+    """ Expand a Slurm node list: node[01-03,07],gpu1 -> [node01, node02,
+        node03, node07, gpu1] """
+    nodes = []
+    for prefix, ranges in _hostlist.findall(hosts):
+        if not ranges:
+            nodes.append(prefix)
+            continue
+        for part in ranges.split(','):
+            start, sep, end = part.partition('-')
+            for i in range(int(start), int(end or start) + 1):
+                nodes.append(prefix + str(i).zfill(len(start)))
+    return nodes
+
+def _slurm_number(value):
+    """ Slurm JSON numbers are plain from older versions and
+        {'set': ..., 'infinite': ..., 'number': ...} from newer ones """
+    if isinstance(value, dict):
+        if not value.get('set', True) or value.get('infinite'):
+            return 0
+        return value.get('number', 0) or 0
+    return value or 0
+
+def parse_squeue_json(data):
+    """ Turn the output of squeue --json into Job objects, skipping jobs
+        that qconnect didn't create """
+    for job in json.loads(data).get('jobs', []):
+        name, type = split_job_name(job.get('name', ''))
+        if not type:
+            continue
+
+        # Jobs in an array are known by <array id>_<task id>
+        job_id = str(job.get('job_id', ''))
+        array  = _slurm_number(job.get('array_job_id'))
+        if array:
+            task = job.get('array_task_id')
+            if task is None or isinstance(task, dict) and not task.get('set'):
+                # Tasks that are still pending together
+                job_id = '{}_[{}]'.format(array, job.get('array_task_string', ''))
+            else:
+                job_id = '{}_{}'.format(array, _slurm_number(task))
+
+        state = job.get('job_state', '')
+        if isinstance(state, list):
+            state = state[0] if state else ''
+
+        state = slurm_states.get(state, 'C')
+        cores = _slurm_number(job.get('cpus'))
+
+        # In MB, per node or per cpu
+        mem = _slurm_number(job.get('memory_per_node')) or _slurm_number(job.get('memory_per_cpu')) * cores
+        if mem:
+            mem = '{}gb'.format(mem // 1024) if not mem % 1024 else '{}mb'.format(mem)
+
+        # Pending jobs have the expected start time
+        start = _slurm_number(job.get('start_time')) if state in ('R', 'S', 'E') else 0
+
+        yield Job(qualify(job_id), name, type, job.get('partition', ''),
+                  expand_hostlist(job.get('nodes', '') or ''), state, job.get('user_name', ''),
+                  cores         = cores,
+                  mem           = mem or '',
+                  walltime      = _slurm_number(job.get('time_limit')) * 60,
+                  qtime         = _slurm_number(job.get('submit_time')),
+                  start_time    = start,
+                  cluster       = current_cluster().name,
+                  node_count    = _slurm_number(job.get('node_count')) or 1)
+
+class Slurm(Torque):
+    """ Slurm: one squeue --json filtered by user and partition on the
+        server, sacct for jobs that have left the queue """
+    header       = 'header_slurm'
+    job_id_shell = '${SLURM_ARRAY_JOB_ID:-$SLURM_JOB_ID}${SLURM_ARRAY_TASK_ID:+_$SLURM_ARRAY_TASK_ID}'
+    nodes_shell  = '$(scontrol show hostnames "$SLURM_JOB_NODELIST" | paste -sd \' \')'
+
+    def _squeue(self, args):
+        """ Run squeue --json with args and yield the qconnect jobs. Raises
+            SchedulerError if squeue fails. """
+        try:
+            squeue = run(['squeue', '--json'] + args, stdout=subprocess.PIPE,
+                         stderr=subprocess.PIPE, timeout=command_timeout)
+        except (subprocess.SubprocessError, OSError) as err:
+            raise SchedulerError("squeue failed: {}".format(err))
+        check_qstat(squeue, squeue.stderr)
+        try:
+            return list(parse_squeue_json(squeue.stdout.decode()))
+        except ValueError:
+            raise SchedulerError("squeue --json is not supported, Slurm 21.08 or newer is needed")
+
+    def list_jobs(self, user=None):
+        # squeue only lists active jobs. Some versions ignore filters with
+        # --json, so check again here
+        cluster = current_cluster()
+        args    = ['--partition=' + cluster.queue]
+        if user:
+            args.append('--user=' + user)
+        if cluster.account:
+            args.append('--account=' + cluster.account)
+        for job in self._squeue(args):
+            if job.queue == cluster.queue:
+                yield job
+
+    def queued_count(self):
+        try:
+            output = run(['squeue', '--noheader', '--states=PENDING', '--format=%i',
+                          '--partition=' + current_cluster().queue], stdout=subprocess.PIPE,
+                         stderr=subprocess.DEVNULL, timeout=command_timeout)
+        except (subprocess.SubprocessError, OSError):
+            return None
+        return None if output.returncode else len(output.stdout.split())
+
+    def get_jobs(self, job_ids):
+        job_ids = set(job_ids)
+        for job in self._squeue(['--jobs=' + ','.join(sorted(bare_id(i) for i in job_ids))]):
+            if job.job_id in job_ids:
+                yield job
+
+    def job_state(self, job_id):
+        try:
+            squeue = run(['squeue', '--noheader', '--jobs=' + bare_id(job_id), '--format=%T'],
+                         stdout=subprocess.PIPE, stderr=subprocess.PIPE, timeout=command_timeout)
+            if squeue.returncode and b'Invalid job id' not in squeue.stderr:
+                return None
+            state = squeue.stdout.decode().strip()
+            if not state:
+                # Gone from the queue, sacct still knows how it ended
+                sacct = run(['sacct', '--noheader', '--allocations', '--parsable2',
+                             '--jobs=' + bare_id(job_id), '--format=State'],
+                            stdout=subprocess.PIPE, stderr=subprocess.DEVNULL, timeout=command_timeout)
+                if sacct.returncode:
+                    return None
+                state = sacct.stdout.decode().strip()
+        except (subprocess.SubprocessError, OSError):
+            return None
+        if not state:
+            return ''
+        # e.g. 'CANCELLED by 1234'
+        return slurm_states.get(state.split('\n')[0].split(' ')[0], 'C')
+
+    def submit(self, script):
+        """ Submit script with sbatch, return (job_id, '') on success or
+            ('', error message) on failure """
+        try:
+            sbatch = run(['sbatch', '--parsable'], input=script.encode(), stdout=subprocess.PIPE,
+                         stderr=subprocess.STDOUT, timeout=command_timeout)
+        except (subprocess.SubprocessError, OSError) as err:
+            return '', str(err)
+
+        # <job id>[;<cluster>]
+        message = sbatch.stdout.decode().rstrip()
+        job_no  = find(r'^[0-9]+', message.split('\n')[-1])
+        if sbatch.returncode or not job_no:
+            return '', message
+        return qualify(job_no[0]), ''
+
+    def rename(self, job_id, name):
+        try:
+            return call(['scontrol', 'update', 'JobId=' + bare_id(job_id), 'JobName=' + name],
+                        stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL,
+                        timeout=command_timeout) == 0
+        except (subprocess.SubprocessError, OSError):
+            return False
+
+    def delete(self, job_id):
+        try:
+            return call(['scancel', bare_id(job_id)], stdout=subprocess.DEVNULL,
+                        stderr=subprocess.DEVNULL, timeout=command_timeout) == 0
+        except (subprocess.SubprocessError, OSError):
+            return False
+
+    def array_ids(self, job_id, count):
+        return ['{}_{}'.format(job_id, i) for i in range(count)]
+
+    def job_id_from_environment(self):
+        if os.environ.get('SLURM_ARRAY_TASK_ID'):
+            return '{}_{}'.format(os.environ.get('SLURM_ARRAY_JOB_ID', ''), os.environ['SLURM_ARRAY_TASK_ID'])
+        return os.environ.get('SLURM_JOB_ID', '')
+
+schedulers = {'torque': Torque, 'pbspro': PBSPro, 'slurm': Slurm}
+
+def get_scheduler():
+    """ The backend for the scheduler of the cluster in use """
+    return _get_scheduler(current_cluster().scheduler)
+
+@lru_cache(maxsize=None)
+def _get_scheduler(name):
+    try:
+        return schedulers[name]()
+    except KeyError:
+        print("Unknown scheduler '{}', choose one of {}".format(name, ', '.join(sorted(schedulers))),
+              file=stderr)
+        sys.exit(1)
+
+## Clusters
+# Several batch servers can be used from one login node by listing them in
+# cluster_file, one section per cluster, the first is the default:
+#
+#   [alpha]
+#   server        = pbs-alpha.example.org
+#   queue         = interactive
+#   scheduler     = torque
+#   account       =
+#   node_patterns = ^(cn[0-9]+)
+#   timeout       = 10
+#
+# Everything but server defaults to the option of the same name at the top of
+# this file (queue to interactive_queue, account to job_account, timeout to
+# command_timeout). Without a cluster_file there is one cluster made of those
+# options. Scheduler commands run against the cluster in use, see on_cluster(),
+# whose server they find through the environment. Queue scans cover every
+# cluster at once, and each Job records the cluster it came from.
+#
+# With several clusters the same job number can turn up on more than one, so
+# qconnect knows jobs as cluster/number, e.g. alpha/1234, which is also what
+# it lists and takes on the command line. The scheduler backends take and
+# return these ids and only send the number to the scheduler. Files and tmux
+# sessions are named by job_key(), and xpra displays by xpra_display().
+
+class Cluster(object):
+    """ One batch server and its interactive queue """
+    __slots__ = ('name', 'server', 'scheduler', 'queue', 'account', 'node_patterns', 'timeout')
+
+    def __init__(self, name, server, scheduler, queue, account, node_patterns, timeout):
+        self.name          = name
+        self.server        = server
+        self.scheduler     = scheduler
+        self.queue         = queue
+        self.account       = account
+        self.node_patterns = node_patterns
+        self.timeout       = timeout
+
+    def env(self):
+        """ Environment variables that send scheduler commands to server """
+        if not self.server:
+            return {}
+        if self.scheduler == 'slurm':
+            return {'SLURM_CLUSTERS': self.server, 'SBATCH_CLUSTERS': self.server}
+        return {'PBS_DEFAULT': self.server}
+
+_cluster = contextvars.ContextVar('cluster', default=None)
+
+# {cluster name: number of jobs waiting in its interactive queue} from the
+# latest scan
+_queue_lengths = {}
+
+@lru_cache(maxsize=None)
+def get_clusters():
+    """ The configured clusters, the default first """
+    import configparser
+    parser = configparser.ConfigParser(interpolation=None)
+    try:
+        parser.read(os.path.expanduser(cluster_file) if cluster_file else [])
+    except configparser.Error as err:
+        print("Cannot read {}: {}".format(cluster_file, err), file=stderr)
+        sys.exit(1)
+
+    clusters = []
+    for name in parser.sections():
+        section = parser[name]
+        try:
+            clusters.append(Cluster(name, section.get('server', ''), section.get('scheduler', scheduler),
+                                    section.get('queue', interactive_queue), section.get('account', job_account),
+                                    section.get('node_patterns', '').split() or node_patterns,
+                                    section.getfloat('timeout', command_timeout)))
+        except ValueError as err:
+            print("Cannot read cluster {} in {}: {}".format(name, cluster_file, err), file=stderr)
+            sys.exit(1)
+    return clusters or [Cluster('', '', scheduler, interactive_queue, job_account, node_patterns, command_timeout)]
+
+def current_cluster():
+    """ The cluster scheduler commands run against """
+    return _cluster.get() or get_clusters()[0]
+
+def cluster_named(name):
+    """ The cluster called name, the default cluster if there is none """
+    for cluster in get_clusters():
+        if cluster.name == name:
+            return cluster
+    return get_clusters()[0]
+
+class on_cluster(object):
+    """ Context manager that runs scheduler commands on cluster, a Cluster
+        or its name """
+    def __init__(self, cluster):
+        self.cluster = cluster if isinstance(cluster, Cluster) else cluster_named(cluster)
+
+    def __enter__(self):
+        self.token = _cluster.set(self.cluster)
+        return self.cluster
+
+    def __exit__(self, *args):
+        _cluster.reset(self.token)
+
+def qualify(job_id, cluster=None):
+    """ The id qconnect knows the scheduler's job_id on cluster (default the
+        one in use) by: 1234 -> alpha/1234 if there are clusters to tell
+        apart, else 1234 """
+    if len(get_clusters()) == 1:
+        return job_id
+    return (cluster or current_cluster()).name + '/' + job_id
+
+def bare_id(job_id):
+    """ The scheduler's id of job_id: alpha/1234 -> 1234 """
+    return job_id.rpartition('/')[2]
+
+def job_key(job_id):
+    """ job_id as a name for files and tmux sessions: alpha/1234 -> alpha@1234 """
+    return job_id.replace('/', '@')
+
+def xpra_display(job_id):
+    """ Number of the xpra display of job_id. This is the job number, with
+        several clusters the numbers of each cluster are interleaved, so
+        that job 1234 on the second of three clusters gets display 3703. """
+    clusters = get_clusters()
+    number   = bare_id(job_id)
+    if len(clusters) == 1 or not number.isdigit():
+        return number
+    return str(int(number) * len(clusters) + clusters.index(cluster_of(job_id)))
+
+def cluster_of(job_id):
+    """ The cluster job_id belongs to, from its cluster/ prefix, the
+        default cluster if it has none """
+    return cluster_named(job_id.split('/')[0] if '/' in job_id else '')
+
+def _scan_cluster(cluster, user):
+    """ Return (jobs, queued): the jobs of user's (everyone's if user is
+        None) on cluster, and how many jobs wait in its interactive queue.
+        The queue is only counted if there are clusters to choose from. """
+    with on_cluster(cluster):
+        jobs   = list(get_scheduler().list_jobs(user))
+        queued = get_scheduler().queued_count() if len(get_clusters()) > 1 else None
+    return jobs, queued
+
+def scan_clusters(user):
+    """ Scan every cluster at once, each for at most its timeout, and return
+        (jobs, failed): all the jobs found, and the names of the clusters
+        that failed or timed out, which are reported and skipped. """
+    clusters = get_clusters()
+    if len(clusters) == 1:
+        try:
+            return _scan_cluster(clusters[0], user)[0], []
+        except SchedulerError as err:
+            print("The scheduler did not answer: {}".format(err), file=stderr)
+            return [], [clusters[0].name]
+
+    # Separate threads, as scans use the shared pool themselves
+    from concurrent.futures import ThreadPoolExecutor
+    pool    = ThreadPoolExecutor(max_workers=len(clusters))
+    futures = [(i, pool.submit(_scan_cluster, i, user)) for i in clusters]
+    pool.shutdown(wait=False)
+
+    start  = time()
+    jobs   = []
+    failed = []
+    for cluster, future in futures:
+        try:
+            found, queued = future.result(timeout=max(0, start + cluster.timeout - time()))
+        except Exception as err:
+            print("Cluster {} did not answer: {}".format(
+                  cluster.name, 'timed out' if isinstance(err, TimeoutError) else err), file=stderr)
+            _queue_lengths.pop(cluster.name, None)
+            failed.append(cluster.name)
+            continue
+        _queue_lengths[cluster.name] = queued
+        jobs += found
+    return jobs, failed
+
+def place_job():
+    """ The cluster for a new session: the one with the fewest jobs waiting
+        in its interactive queue as of the latest scan, in the order of
+        cluster_file for equal queues. Clusters that didn't answer that scan
+        are avoided, if no scan counted the queues the default is used.
+        Without a scan in this run, the cached one is used if it is recent,
+        and otherwise the queues are counted now. """
+    clusters = get_clusters()
+    if len(clusters) == 1:
+        return clusters[0]
+    if not _queue_lengths:
+        cache = _load_cache()
+        if not cache or time() - cache['time'] >= cache_ttl or not _queue_lengths:
+            count_queues()
+    counted = [i for i in clusters if _queue_lengths.get(i.name) is not None]
+    if not counted:
+        return clusters[0]
+    return min(counted, key=lambda i: _queue_lengths[i.name])
+
+def count_queues():
+    """ Count the jobs waiting on every cluster at once, for place_job """
+    def count(cluster):
+        with on_cluster(cluster):
+            return get_scheduler().queued_count()
+    for cluster, queued in run_parallel(count, get_clusters()).items():
+        _queue_lengths[cluster.name] = None if isinstance(queued, Exception) else queued
+
+def _placed(cluster, count):
+    """ Count count new jobs on cluster until the next scan """
+    if _queue_lengths.get(cluster.name) is not None:
+        _queue_lengths[cluster.name] += count
+
+## Queue
+
+def check_queue(uid):
+    """ Check the queue for any uid string, return an OrderedDict of Job
+        records with running node information, sorted by job id, and the
+        names of the clusters that failed (see scan_clusters).
+        The scheduler backend only fetches uid's active interactive jobs
+        where it can select them on the server. Covers every cluster. """
+    jobs = {}
+    found, failed = scan_clusters(uid)
+    for job in found:
+        # Skip other people's jobs
+        if job.owner == uid and active_session(job):
+            jobs[job.job_id] = job
+
+    # Sort the dictionary
+    return OrderedDict(sorted(jobs.items())), failed
+
+def active_session(job):
+    """ Is job a session qconnect can list and attach to """
+    return not job.state == 'C'
+
+def find_job_id(job_id, job_list):
+    """ The id qconnect knows job_id from the command line by. That can be
+        alpha/1234, the scheduler's 1234.server, or just 1234 if only one
+        cluster in job_list has that job. Exits if it is on several. """
+    clusters = get_clusters()
+    if '/' in job_id or len(clusters) == 1:
+        if '/' in job_id and job_id.split('/')[0] not in [i.name for i in clusters]:
+            print("There is no cluster {}, choose one of {}".format(
+                  job_id.split('/')[0], ', '.join(i.name for i in clusters)), file=stderr)
+            sys.exit(1)
+        return short_id(job_id)
+
+    number, _, server = job_id.partition('.')
+    for cluster in clusters:
+        if server and server.split('.')[0] == cluster.server.split('.')[0]:
+            return qualify(number, cluster)
+    found = [i for i in job_list if bare_id(i) == number]
+    if len(found) > 1:
+        print("Job {} is on clusters {}, use one of {}".format(
+              number, ', '.join(cluster_of(i).name for i in found), ', '.join(found)), file=stderr)
+        sys.exit(1)
+    return found[0] if found else qualify(number, clusters[0])
+
+def check_job(job_id):
+    """ Return the state of job_id, False if the scheduler doesn't know it
+        and None if the scheduler couldn't be asked. Asks the daemon if one
+        is running, unless it doesn't know the job. """
+    response = daemon_request({'op': 'job', 'job_id': job_id})
+    if response and response.get('known'):
+        state = response['state']
+    else:
+        state = get_scheduler().job_state(job_id)
+    if state is None:
+        return None
+    update_cached_job(job_id, state or False)
+    return state or False
+
+## Daemon
+# qconnect --serve runs on the login node as a service. One thread scans the
+# interactive queue for all users every daemon_interval seconds, and every
+# qconnect run asks it over daemon_socket instead of the scheduler, so the
+# scheduler load no longer grows with the number of users and waiting clients.
+# Requests and replies are single lines of JSON. The daemon identifies the
+# user on the other end of the socket with SO_PEERCRED and only ever answers
+# with that user's jobs. Every reply carries the time of the scan it comes
+# from, and clients ask the scheduler themselves instead once that is older
+# than a few daemon_intervals, so a daemon whose scans fail, or that hasn't
+# scanned yet, is never trusted with an empty queue.
+
+_daemon = {'up': True}
+
+def daemon_request(request, timeout=None):
+    """ Send request to the daemon and return its reply, None if there is
+        no daemon. After the first failure the daemon is not tried again
+        during this run. """
+    if not daemon_socket or not _daemon['up']:
+        return None
+    import socket
+    try:
+        with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as sock:
+            sock.settimeout(timeout or command_timeout)
+            sock.connect(daemon_socket)
+            sock.sendall((json.dumps(request) + '\n').encode())
+            reply = json.loads(sock.makefile().readline())
+    except (OSError, ValueError):
+        _daemon['up'] = False
+        return None
+    if 'error' in reply:
+        print("qconnect daemon: " + reply['error'], file=stderr)
+        return None
+    if time() - reply.get('time', 0) > 3 * daemon_interval + command_timeout:
+        _daemon['up'] = False
+        if reply.get('time'):
+            print("qconnect daemon: the last queue scan is {} old, asking the scheduler".format(
+                  format_duration(time() - reply['time'])), file=stderr)
+        return None
+    return reply
+
+def daemon_jobs(refresh=False):
+    """ Job list for this user from the daemon, None if there is no daemon.
+        With refresh the daemon scans again unless its scan is very recent. """
+    reply = daemon_request({'op': 'jobs', 'refresh': refresh})
+    if reply is None:
+        return None
+    _queue_lengths.update(reply.get('queued') or {})
+    return OrderedDict((i['job_id'], Job(**i)) for i in reply['jobs'])
+
+class JobIndex(object):
+    """ The daemon's latest queue scan, by user and by job id. Waiting
+        threads are woken through changed after every scan. """
+    def __init__(self):
+        self.by_user = {}
+        self.by_id   = {}
+        self.time    = 0
+        self.scans   = 0
+        self.queued  = {}
+        self.refresh = False
+        self.changed = threading.Condition()
+
+    def update(self, jobs, queued=None):
+        """ Replace the index with jobs from a new scan, and the queue
+            lengths of the clusters """
+        by_user = {}
+        by_id   = {}
+        for job in sorted(jobs, key=lambda i: i.job_id):
+            by_user.setdefault(job.owner, OrderedDict())[job.job_id] = job
+            by_id[job.job_id] = job
+        with self.changed:
+            self.by_user = by_user
+            self.by_id   = by_id
+            self.queued  = queued or {}
+            self.time    = time()
+            self.refresh = False
+            self.changed.notify_all()
+
+    def scanned(self):
+        """ Count a scan attempt, successful or not """
+        with self.changed:
+            self.scans  += 1
+            self.refresh = False
+            self.changed.notify_all()
+
+    def wait_first(self, timeout):
+        """ Wait until the first scan has been tried """
+        with self.changed:
+            self.changed.wait_for(lambda: self.scans, timeout)
+
+    def state(self, user, job_id):
+        """ State of job_id, '' if it isn't a job of user's in the index """
+        job = self.by_id.get(job_id)
+        return job.state if job and job.owner == user else ''
+
+    def scan_now(self, timeout=None):
+        """ Have the scan thread scan now, and wait until it has. False if
+            that scan failed. """
+        with self.changed:
+            last         = self.time
+            scans        = self.scans
+            self.refresh = True
+            self.changed.notify_all()
+            self.changed.wait_for(lambda: self.scans > scans, command_timeout if timeout is None else timeout)
+            return self.time > last
+
+def _scan_loop(index):
+    """ Scan the queue into index forever, every daemon_interval seconds or
+        whenever a client asks for a refresh """
+    while True:
+        try:
+            jobs, failed = scan_clusters(None)
+            if not failed:
+                # Otherwise the index keeps the last full scan, and clients
+                # see from its age that it is stale
+                index.update([i for i in jobs if active_session(i)], dict(_queue_lengths))
+        except Exception as err:
+            print("Queue scan failed: {}".format(err), file=stderr)
+        finally:
+            index.scanned()
+        with index.changed:
+            index.changed.wait_for(lambda: index.refresh, daemon_interval)
+
+def handle_request(index, user, request):
+    """ Answer one client request for user, return the reply """
+    op     = request.get('op')
+    job_id = str(request.get('job_id', ''))
+
+    if op == 'ping':
+        return {'time': index.time}
+
+    # Just started, answer from the first scan rather than an empty index
+    if not index.scans:
+        index.wait_first(command_timeout)
+
+    if op == 'jobs':
+        # Scans are shared, so a refresh within 2 seconds of the last scan
+        # gets that scan
+        if request.get('refresh') and time() - index.time > 2 and not index.scan_now():
+            return {'error': 'the queue scan failed'}
+        jobs = index.by_user.get(user, OrderedDict())
+        return {'time': index.time, 'jobs': [i.to_dict() for i in jobs.values()], 'queued': index.queued}
+
+    if op == 'job':
+        return {'time': index.time, 'known': job_id in index.by_user.get(user, {}),
+                'state': index.state(user, job_id)}
+
+    if op == 'wait':
+        # Block until the state differs from the one the client last saw
+        deadline = time() + min(float(request.get('timeout') or daemon_interval), 60)
+        with index.changed:
+            index.changed.wait_for(lambda: not index.state(user, job_id) == request.get('state'),
+                                   max(0, deadline - time()))
+        return {'time': index.time, 'known': job_id in index.by_user.get(user, {}),
+                'state': index.state(user, job_id)}
+
+    return {'error': 'unknown request {}'.format(op)}
+
+def serve():
+    """ Run the daemon on daemon_socket until killed """
+    import socket, socketserver, struct
+
+    if not daemon_socket:
+        print("daemon_socket is not set", file=stderr)
+        sys.exit(1)
+    stop_recording()
+
+    index = JobIndex()
+
+    class Handler(socketserver.StreamRequestHandler):
+        def handle(self):
+            try:
+                credentials = self.request.getsockopt(socket.SOL_SOCKET, socket.SO_PEERCRED,
+                                                      struct.calcsize('3i'))
+                user = getpwuid(struct.unpack('3i', credentials)[1]).pw_name
+            except (AttributeError, OSError, KeyError):
+                self.wfile.write(b'{"error": "cannot identify the client"}\n')
+                return
+            # A client that never sends its request, or never reads the
+            # reply, must not hold a thread forever
+            self.request.settimeout(command_timeout)
+            try:
+                request = json.loads(self.rfile.readline().decode())
+            except ValueError:
+                request = None
+            except OSError:
+                return
+            reply = handle_request(index, user, request) if isinstance(request, dict) else {'error': 'bad request'}
+            try:
+                self.wfile.write((json.dumps(reply) + '\n').encode())
+            except OSError:
+                pass
+
+    class Server(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+        daemon_threads = True
+
+    # A socket left behind by a daemon that is gone
+    if os.path.exists(daemon_socket):
+        with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as sock:
+            try:
+                sock.connect(daemon_socket)
+                print("A daemon is already running on " + daemon_socket, file=stderr)
+                sys.exit(1)
+            except OSError:
+                os.remove(daemon_socket)
+
+    os.makedirs(os.path.dirname(daemon_socket), exist_ok=True)
+    server = Server(daemon_socket, Handler)
+    os.chmod(daemon_socket, 0o666)
+
+    scanner = threading.Thread(target=_scan_loop, args=(index,))
+    scanner.daemon = True
+    scanner.start()
+
+    # Stopping the service should remove the socket too
+    signal.signal(signal.SIGTERM, lambda *args: sys.exit(0))
+
+    print("Serving on", daemon_socket, flush=True)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        os.remove(daemon_socket)
+
+## Node Connections
+# Every command that runs on a compute node goes through ssh_command(), which
+# routes it through an OpenSSH ControlMaster for that node. The first command
+# starts the master, later ones reuse its authenticated connection, and ssh
+# itself closes the master once it has been idle for ssh_persist seconds.
+
+def ssh_options():
+    """ ssh options that share one master connection per node """
+    if not ssh_persist or not runtime_dir():
+        return []
+    return ['-o', 'ControlMaster=auto',
+            '-o', 'ControlPath=' + os.path.join(runtime_dir(), 'ssh-%C'),
+            '-o', 'ControlPersist=' + str(ssh_persist)]
+
+def ssh_command(node, *command, tty=False):
+    """ Return the argument list to run command on node """
+    return ['ssh'] + ssh_options() + (['-t'] if tty else []) + [node] + list(command)
+
+def xpra_ssh_option():
+    """ xpra option to make 'xpra attach ssh:...' use the shared master """
+    options = ssh_options()
+    return ['--ssh=' + ' '.join(['ssh'] + options)] if options else []
+
+def ssh_connected(node):
+    """ Is there a live master connection to node """
+    if not ssh_options():
+        return False
+    return call(['ssh'] + ssh_options() + ['-O', 'check', node],
+                stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL) == 0
+
+def ssh_connect(node):
+    """ Start the master connection to node if it isn't running yet.
+        Returns once authentication is complete. """
+    if not ssh_options() or ssh_connected(node):
+        return
+    call(['ssh'] + ssh_options() + ['-f', '-N', node],
+         stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+
+def ssh_disconnect(node):
+    """ Close the master connection to node now, rather than when idle """
+    if ssh_options():
+        call(['ssh'] + ssh_options() + ['-O', 'exit', node],
+             stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+
+def node_run(node, command):
+    """ Run the shell command on node and return its output """
+    return rn(ssh_command(node, command)).decode()
+
+def node_call(node, *command, tty=False):
+    """ Run command on node attached to our terminal, return exit code """
+    return call(ssh_command(node, *command, tty=tty))
+
+## GUI Sessions
+# The xpra attach that runs next to a tmux attach is a child process we hold
+# a handle to, so it can be checked on and is always terminated when the
+# tmux attach ends, however it ends.
+
+class GuiSession(object):
+    """ xpra attach to the display of job_id on node, in the background.
+        Use as a context manager to stop it on leaving the block. xpra runs
+        in its own session, out of reach of Ctrl-C and of a hangup, so
+        SIGHUP and SIGTERM stop it and exit while in the block. """
+    def __init__(self, node, job_id):
+        self.node     = node
+        self.job_id   = job_id
+        self.process  = None
+        self.handlers = {}
+
+    def start(self):
+        """ Start xpra attach, return True if it is running """
+        try:
+            self.process = Popen(['xpra', 'attach'] + xpra_ssh_option() +
+                                 ['ssh:' + uid + '@' + self.node + ':' + xpra_display(self.job_id)],
+                                 stdin=subprocess.DEVNULL, stdout=subprocess.DEVNULL,
+                                 stderr=subprocess.DEVNULL, start_new_session=True)
+        except OSError:
+            self.process = None
+        return self.alive()
+
+    def alive(self):
+        """ Is xpra attach still running """
+        return self.process is not None and self.process.poll() is None
+
+    def stop(self, timeout=5):
+        """ Terminate xpra attach, kill it if it hasn't exited after timeout
+            seconds """
+        if not self.alive():
+            return
+        self.process.terminate()
+        try:
+            self.process.wait(timeout=timeout)
+        except subprocess.TimeoutExpired:
+            self.process.kill()
+            self.process.wait()
+
+    def __enter__(self):
+        for sig in (signal.SIGTERM, signal.SIGHUP):
+            self.handlers[sig] = signal.signal(sig, self._exit)
+        self.start()
+        return self
+
+    def _exit(self, *args):
+        # Right away, the block might be waiting for ssh, which wasn't told
+        self.stop()
+        sys.exit(0)
+
+    def __exit__(self, *args):
+        try:
+            self.stop()
+        finally:
+            for sig, handler in self.handlers.items():
+                signal.signal(sig, handler)
+
+@lru_cache(maxsize=None)
+def xpra_displays():
+    """ The live xpra displays on this machine, as numbers without the
+        colon. xpra list runs once, call xpra_displays.cache_clear() after
+        starting or stopping a display. """
+    try:
+        output = run(['xpra', 'list'], stdout=subprocess.PIPE, stderr=subprocess.DEVNULL,
+                     timeout=command_timeout, universal_newlines=True).stdout
+    except (subprocess.SubprocessError, OSError):
+        return frozenset()
+    return frozenset(line.rsplit(':', 1)[1].strip() for line in output.split('\n')
+                     if 'LIVE' in line and ':' in line)
+
+## Node Probes
+
+class Probe(object):
+    """ What is alive on a node for one job """
+    __slots__ = ('job_id', 'node', 'tmux', 'xpra', 'error')
+
+    def __init__(self, job_id, node, tmux=False, xpra=False, error=''):
+        self.job_id    = job_id
+        self.node      = node
+        self.tmux      = tmux
+        self.xpra      = xpra
+        self.error     = error
+
+    def summary(self):
+        """ Short description for job tables """
+        if self.error:
+            return 'unreachable'
+        alive = [i for i in ('tmux', 'xpra') if getattr(self, i)]
+        return '+'.join(alive) if alive else 'none'
+
+def probe_node(node, job_id):
+    """ Check in a single ssh round trip whether the tmux session and xpra
+        display for job_id are alive on node """
+    script = ("(" + tmux_remote(job_id, 'has-session', '-t', job_key(job_id)) + ") >/dev/null 2>&1 && echo tmux:yes; "
+              "xpra list 2>/dev/null | grep -q 'LIVE.*:{0}$' && echo xpra:yes; true").format(xpra_display(job_id))
+    try:
+        output = run(ssh_command(node, script), stdout=subprocess.PIPE,
+                     stderr=subprocess.DEVNULL, timeout=command_timeout,
+                     check=True, universal_newlines=True).stdout
+    except (subprocess.SubprocessError, OSError) as err:
+        return Probe(job_id, node, error=str(err))
+
+    lines = output.split('\n')
+    return Probe(job_id, node, 'tmux:yes' in lines, 'xpra:yes' in lines)
+
+def probe_jobs(job_list):
+    """ Probe every running job in job_list in parallel, return
+        {job_id: Probe} """
+    running = [(k, v.node) for k, v in job_list.items() if v.state == 'R' and v.node]
+    probes  = OrderedDict()
+    for (job_id, node), probe in run_parallel(lambda i: probe_node(i[1], i[0]), running).items():
+        if isinstance(probe, Exception):
+            probe = Probe(job_id, node, error=str(probe) or 'timed out')
+        probes[job_id] = probe
+    return probes
+
+_vnc_pid_file = re.compile(r'^([^:]+):([0-9]+)\.pid$')
+
+def vnc_servers(node):
+    """ {display: pid} for the vncserver pid files of node in $HOME/.vnc,
+        read locally, as $HOME is shared with the nodes """
+    servers = OrderedDict()
+    try:
+        files = sorted(os.listdir(os.path.expanduser('~/.vnc')))
+    except OSError:
+        return servers
+    for name in files:
+        match = _vnc_pid_file.match(name)
+        if not match or not match.group(1).split('.')[0] == node:
+            continue
+        try:
+            with open(os.path.join(os.path.expanduser('~/.vnc'), name)) as fin:
+                servers[match.group(2)] = int(fin.read().strip())
+        except (OSError, ValueError):
+            continue
+    return servers
+
+def vnc_display(job_id, node):
+    """ Return the VNC display number of job_id on node, '' if none is
+        running. The agent records it in the status file, so usually this
+        needs no ssh. Otherwise the pid files in $HOME/.vnc are checked on
+        the node with a single ssh, skipping stale ones, and the server
+        started by job_id is picked if there are several. """
+    status = read_status(job_id)
+    if status and status.get('state') == 'ready' and status.get('display'):
+        return status['display'].lstrip(':')
+
+    servers = vnc_servers(node)
+    if not servers:
+        return ''
+
+    # Print display:job id for every live server
+    script = ''.join(
+        'if kill -0 {0} 2>/dev/null; then echo "live:{1}:$(tr "\\0" "\\n" < /proc/{0}/environ 2>/dev/null'
+        ' | grep -E "^(PBS_JOBID|SLURM_JOB_ID)=" | head -1 | cut -d= -f2)"; fi; '.format(pid, display)
+        for display, pid in servers.items())
+    try:
+        output = node_run(node, script + 'true')
+    except (subprocess.SubprocessError, OSError) as err:
+        print("Cannot reach {}: {}".format(node, err), file=stderr)
+        return ''
+
+    live = OrderedDict()
+    for line in output.split('\n'):
+        if line.startswith('live:'):
+            display, job = line[5:].split(':', 1)
+            live[display] = short_id(job)
+    mine = [k for k, v in live.items() if v == bare_id(job_id)]
+    if mine:
+        return mine[0]
+    if len(live) == 1:
+        return list(live)[0]
+    if live:
+        print("There are {} vnc servers running for you on {} (displays {}), and none of".format(
+              len(live), node, ', '.join(live)))
+        print("them says which job started it. Connect with vncviewer {}:<display>".format(node))
+    return ''
+
+## Node Agent
+# qconnect --agent runs inside the job on the compute node in place of a shell
+# polling loop. It starts the session, blocks until the session ends without
+# starting any further processes, cleans up after xpra, and keeps
+# <state_dir>/<job_id>.status current so the login node can see what is
+# running by reading a file.
+#
+# tmux sessions started by the agent get their own tmux server, on the socket
+# from tmux_socket(), so that the server exits exactly when the session does.
+
+def own_job_id():
+    """ qconnect id of the job we are running in, '' outside of a job. The
+        job script exports the cluster it was submitted to as $QCONNECT_CLUSTER """
+    with on_cluster(os.environ.get('QCONNECT_CLUSTER', '')):
+        job_id = get_scheduler().job_id_from_environment()
+        return qualify(job_id) if job_id else ''
+
+def tmux_socket(job_id):
+    """ Name of the tmux socket (tmux -L) used by the agent for job_id """
+    return 'qconnect-' + job_key(job_id)
+
+def tmux_remote(job_id, *command):
+    """ Shell command that runs tmux command on the agent's server for job_id,
+        or on the default server for jobs started without the agent """
+    command = ' '.join(shlex.quote(i) for i in command)
+    return ('if tmux -L {0} has-session 2>/dev/null; then tmux -L {0} {1}; '
+            'else tmux {1}; fi').format(tmux_socket(job_id), command)
+
+def status_file(job_id):
+    """ Path of the status file the agent keeps for job_id """
+    return os.path.join(os.path.expanduser(state_dir), job_key(job_id) + '.status')
+
+def read_status(job_id):
+    """ Return the agent status for job_id as a dictionary, None if there
+        isn't one """
+    if not state_dir:
+        return None
+    try:
+        with open(status_file(job_id)) as fin:
+            return json.load(fin)
+    except (OSError, ValueError):
+        return None
+
+def idle_time(job_id, now=None):
+    """ Seconds since the session of job_id was last in use, None if its
+        agent doesn't report it """
+    status = read_status(job_id)
+    if not status or not status.get('active') or not status.get('state') == 'ready':
+        return None
+    return max(0, int((now or time()) - status['active']))
+
+def _write_status(status):
+    """ Atomically replace the status file for status['job_id'] """
+    if not state_dir:
+        return
+    status['time'] = int(time())
+    tmp = status_file(status['job_id']) + '.' + str(os.getpid())
+    with open(tmp, 'w') as fout:
+        json.dump(status, fout)
+    os.replace(tmp, status_file(status['job_id']))
+
+def wait_for_pid(pid, timeout=None):
+    """ Block until pid, which need not be our child, exits or timeout
+        seconds have passed, return True if it exited. Uses a pidfd where the
+        kernel and python support it, otherwise checks every 5 seconds with
+        a signal 0, which doesn't start a process. """
+    try:
+        fd = os.pidfd_open(pid)
+    except (AttributeError, OSError):
+        fd = None
+
+    if fd is not None:
+        import select
+        poller = select.poll()
+        poller.register(fd, select.POLLIN)
+        exited = bool(poller.poll(None if timeout is None else int(timeout * 1000)))
+        os.close(fd)
+        return exited
 
-# Default VNC geometry
-vnc_geometry = '1280x1024'
+    deadline = None if timeout is None else time() + timeout
+    while True:
+        try:
+            os.kill(pid, 0)
+        except ProcessLookupError:
+            return True
+        except PermissionError:
+            pass
+        if deadline is not None and time() >= deadline:
+            return False
+        sleep(5 if deadline is None else max(0, min(5, deadline - time())))
 
-# Debuging - prints a bunch of stuff
-debug = False
+def wait_for_claim(job_id, timeout, pid):
+    """ Wait for a user to claim this pool session. Returns True once it is
+        claimed, False if the session ended, or if nobody claimed it within
+        timeout seconds, in which case it is claimed here so nobody can. """
+    deadline = time() + timeout
+    while not os.path.exists(claim_marker(job_id)):
+        if time() >= deadline and claim_job(job_id, 'expired'):
+            return False
+        try:
+            os.kill(pid, 0)
+        except ProcessLookupError:
+            return False
+        except PermissionError:
+            pass
+        sleep(5)
+    return claimed_by(job_id) == 'user'
 
-##############################################
-#                                            #
-#      Do Not Edit Below This Line           #
-#                                            #
-##############################################
+def process_tree_cpu(pid):
+    """ CPU seconds used by pid and all of its descendants, including their
+        children that have exited, read from /proc """
+    children = {}
+    ticks    = {}
+    for entry in os.listdir('/proc'):
+        if not entry.isdigit():
+            continue
+        try:
+            with open('/proc/' + entry + '/stat') as fin:
+                # The command name is in brackets and may contain spaces
+                fields = fin.read().rsplit(')', 1)[1].split()
+        except (OSError, IndexError):
+            continue
+        children.setdefault(int(fields[1]), []).append(int(entry))
+        ticks[int(entry)] = sum(int(i) for i in fields[11:15])
 
-## Imports
-import subprocess
-import sys, os
+    total = 0
+    todo  = [pid]
+    while todo:
+        current = todo.pop()
+        total  += ticks.get(current, 0)
+        todo   += children.get(current, [])
+    return total / os.sysconf('SC_CLK_TCK')
 
-# Aliases
-from subprocess  import check_output as rn
-from re          import findall      as find
-from re          import split        as s
-from collections import OrderedDict
-from sys         import stderr
-from os          import getuid
-from pwd         import getpwuid
-from time        import sleep
+def xpra_clients(display):
+    """ Number of clients connected to the xpra display on this node, 0
+        if it can't be told """
+    try:
+        output = run(['xpra', 'info', display], stdout=subprocess.PIPE, stderr=subprocess.DEVNULL,
+                     timeout=command_timeout, universal_newlines=True).stdout
+    except (subprocess.SubprocessError, OSError):
+        return 0
+    for line in output.split('\n'):
+        if line.startswith('clients=') and line[8:].strip().isdigit():
+            return int(line[8:])
+    return 0
 
-## Global Variables
+class IdleTracker(object):
+    """ Keeps track of when a session on this node was last in use: a tmux
+        client attached or typing, an xpra client connected, or the
+        session's processes using more than idle_cpu of a core """
+    def __init__(self, job_id, type, pid, display=''):
+        self.job_id  = job_id
+        self.type    = type
+        self.pid     = pid
+        self.display = display
+        self.active  = time()
+        self.checked = time()
+        self.cpu     = process_tree_cpu(pid)
+        self.warned  = False
 
-# Get UID
-uidno = rn('echo $UID', shell=True).decode('utf8').rstrip()
-uid   = getpwuid(getuid()).pw_name
+    def _tmux(self, *command):
+        return ['tmux', '-L', tmux_socket(self.job_id)] + list(command)
 
-# Check for installed options
-xpra_installed = True if subprocess.getstatusoutput('which xpra')[0] == 0 else False
-vnc_installed  = True if subprocess.getstatusoutput('which vncviewer')[0] == 0 else False
+    def attached(self):
+        """ Is a client attached, also notes the last tmux input """
+        if self.type == 'tmux':
+            try:
+                attached, activity = rn(self._tmux('display-message', '-p', '-t', job_key(self.job_id),
+                                                   '#{session_attached} #{session_activity}')).split()
+                self.active = max(self.active, int(activity))
+                if int(attached):
+                    return True
+            except (subprocess.SubprocessError, OSError, ValueError):
+                pass
+        return bool(self.display) and xpra_clients(self.display) > 0
 
-# Version string
-version = '1.8.1'
+    def check(self):
+        """ Update and return the time the session was last in use """
+        now  = time()
+        cpu  = process_tree_cpu(self.pid)
+        busy = cpu - self.cpu > idle_cpu * (now - self.checked)
+        self.cpu     = cpu
+        self.checked = now
+        if self.attached() or busy:
+            self.active = now
+        return self.active
 
-## Functions
+    def warn(self, on=True):
+        """ Show or clear an idle warning in the tmux status line, where it
+            is seen on attaching """
+        if not self.type == 'tmux' or on == self.warned:
+            return
+        if on:
+            command = self._tmux('set-option', '-t', job_key(self.job_id), 'status-right',
+                                 'qconnect: idle, may be ended')
+        else:
+            command = self._tmux('set-option', '-u', '-t', job_key(self.job_id), 'status-right')
+        call(command, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+        self.warned = on
 
-def check_queue(uid):
-    """ Check the queue for any uid string, return job list with running
-        node information. """
-    from re import compile as mkregex
+def free_display(start=1):
+    """ Lowest X display number from start up that is not in use on this
+        node """
+    display = start
+    while os.path.exists('/tmp/.X{}-lock'.format(display)) or \
+            os.path.exists('/tmp/.X11-unix/X{}'.format(display)):
+        display += 1
+    return display
 
-    qstat = rn(['qstat', '-u', uid, '-n', '-1']).decode('utf8').rstrip().split('\n')[5:]
+def start_vncserver(attempts=10):
+    """ Start vncserver in the foreground on a free display, return
+        (process, display) once it listens. If another server takes the
+        display first, vncserver exits and the next free one is tried. """
+    display = free_display()
+    for attempt in range(attempts):
+        process  = Popen(['vncserver', ':' + str(display), '-geometry', vnc_geometry, '-fg'])
+        deadline = time() + 10
+        while process.poll() is None and time() < deadline:
+            if os.path.exists('/tmp/.X11-unix/X{}'.format(display)):
+                return process, display
+            sleep(0.1)
+        if process.poll() is None:
+            # Still starting, assume it got the display
+            return process, display
+        display = free_display(display + 1)
+    print("vncserver failed to start", file=stderr)
+    sys.exit(1)
 
-    # If there are no job return nothing
-    if not qstat:
-        return
+def run_agent(type, command=''):
+    """ Supervise a tmux, gui or vnc session on the compute node until it
+        ends. command is the program to run for gui sessions. tmux sessions
+        wait in the session pool if $QCONNECT_POOL is set to a timeout. """
+    job_id = own_job_id()
+    if not job_id:
+        print("qconnect --agent must run inside a job, no job id in the environment", file=stderr)
+        sys.exit(1)
+    stop_recording()
 
-    jobs = {}
-    for i in qstat:
-        f = s(r' +', i.rstrip())
+    # The scheduler signals the job when it is deleted or out of time,
+    # turn that into a normal exit so that the cleanup below runs
+    for sig in (signal.SIGTERM, signal.SIGHUP):
+        signal.signal(sig, lambda *args: sys.exit(0))
 
-        # Only look at jobs in the interactive queue
-        if not f[2] == short_queue_name:
-            continue
+    from socket import gethostname
+    if state_dir:
+        os.makedirs(os.path.expanduser(state_dir), exist_ok=True)
+    pool   = int(os.environ.get('QCONNECT_POOL') or 0) if type == 'tmux' and state_dir else 0
+    status = {'job_id': job_id, 'type': type, 'node': gethostname().split('.')[0],
+              'state': 'starting', 'pid': 0, 'display': '', 'xpra': False, 'pool': bool(pool)}
+    _write_status(status)
 
-        # Skip completed jobs
-        if f[9] == 'C':
-            continue
+    process = None
+    try:
+        # GUI display, optional for tmux sessions
+        if type in ('tmux', 'gui') and installed('xpra'):
+            if call(['xpra', 'start', ':' + xpra_display(job_id)],
+                    stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL) == 0:
+                os.environ['DISPLAY'] = ':' + xpra_display(job_id)
+                status['xpra']    = True
+                status['display'] = ':' + xpra_display(job_id)
+        if type == 'gui' and not status['xpra']:
+            print("xpra failed to start, cannot run " + command, file=stderr)
+            sys.exit(1)
 
-        # Get node name, if there is one
-        if f[11] == '--':
-            node = ''
+        # Start the session
+        if type == 'tmux':
+            check_call(['tmux', '-L', tmux_socket(job_id), 'new-session', '-d', '-s', job_key(job_id)])
+            status['pid'] = int(rn(['tmux', '-L', tmux_socket(job_id), 'display-message', '-p', '#{pid}']))
+        elif type == 'gui':
+            process = Popen(command, shell=True)
+        elif type == 'vnc':
+            process, display  = start_vncserver()
+            status['display'] = ':' + str(display)
         else:
-            nodes = set(find(r'node[0-9][0-9]', f[11]))
-            if len(nodes) > 1:
-                continue
-            node = str(list(nodes)[0])
+            print("Unknown session type " + type, file=stderr)
+            sys.exit(1)
+        if process:
+            status['pid'] = process.pid
 
-        # Get job number
-        job_id = find(r'[0-9]+', f[0])[0]
+        status['state'] = 'ready'
+        _write_status(status)
+        if state_dir:
+            open(ready_marker(job_id), 'w').close()
 
-        # Now that we have a limited job set, use qstat -f to get the
-        # complete job and queue name
-        find_queue = mkregex(r'queue = (.*)$')
-        find_name  = mkregex(r'Job_Name = (.*)$')
+        # Unclaimed pool sessions end here
+        if pool and not wait_for_claim(job_id, pool, status['pid']):
+            return
 
-        for i in subprocess.check_output(['qstat', '-f', job_id]).decode().rstrip().split('\n'):
-            # Get Queue Name
-            if find_queue.search(i):
+        # Block until the session ends, checking every idle_check seconds
+        # whether it is still in use
+        tracker = IdleTracker(job_id, type, status['pid'], status['display'] if status['xpra'] else '')
+        status['active'] = int(tracker.active)
+        _write_status(status)
+        while True:
+            if process:
                 try:
-                    queue = find_queue.findall(i)[0]
-                except IndexError:
-                    # Queue parsing failed, report this and continue
-                    print("Failed to parse queue for job number:{:^3}\nskipping".format(job_id), file=stderr)
-                    continue
-                if not queue == interactive_queue:
-                    continue
-            elif find_name.search(i):
+                    process.wait(timeout=idle_check or None)
+                    break
+                except subprocess.TimeoutExpired:
+                    pass
+            elif wait_for_pid(status['pid'], idle_check or None):
+                break
+
+            active = int(tracker.check())
+            if not active == status['active']:
+                status['active'] = active
+                _write_status(status)
+            idle = time() - active
+            tracker.warn(bool(idle_warn) and idle >= idle_warn)
+            if idle_agent_reap and idle_reap and idle >= idle_reap:
+                print("Ending the session, it has been idle for " + format_duration(idle), file=stderr)
+                break
+
+    finally:
+        if process and process.poll() is None:
+            process.terminate()
+        if type == 'tmux':
+            call(['tmux', '-L', tmux_socket(job_id), 'kill-server'],
+                 stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+        if status['xpra']:
+            call(['xpra', 'stop', status['display']],
+                 stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+            try:
+                os.remove(os.path.expanduser('~/.xpra/' + status['display'] + '.log'))
+            except OSError:
+                pass
+        if state_dir:
+            for marker in (ready_marker(job_id), claim_marker(job_id)):
                 try:
-                    names = find_name.findall(i)[0].split('_')
-                except IndexError:
-                    # Queue parsing failed, report this and continue
-                    print("Failed to parse queue for job number:{:^3}\nskipping".format(job_id), file=stderr)
-                    continue
+                    os.remove(marker)
+                except OSError:
+                    pass
+        status['state'] = 'exited'
+        _write_status(status)
+
+## Job Templates
+# Job scripts are rendered from named templates. {{name}} is replaced by the
+# value of name, and {{if name}}...{{end}} (or {{if not name}}) keeps its
+# contents only if name is non-empty (or empty). Blocks do not nest. Templates
+# in template_dir named <name>.pbs override or add to the built in ones, and
+# can be selected with --template. Compiled templates and rendered scripts are
+# cached, so submitting many identical jobs renders the script once.
+#
+# Every built in template hands over to the node agent if it is installed on
+# the node, and otherwise runs a shell loop itself. {{header}} is the header
+# template of the configured scheduler. Jobs on several nodes run on the
+# first, with the names of all of them in $QCONNECT_NODES.
+
+job_templates = {
+'header': """#!/bin/bash
+#PBS -S /bin/bash
+#PBS -q {{queue}}
+#PBS -N {{job_name}}
+#PBS -l nodes={{nodes}}:ppn={{cores}}
+#PBS -l mem={{mem}}
+#PBS -e {{error_path}}
+#PBS -o /dev/null
+{{if account}}#PBS -A {{account}}
+{{end}}{{if array}}#PBS -t {{array}}
+{{end}}""",
+
+'header_pbspro': """#!/bin/bash
+#PBS -S /bin/bash
+#PBS -q {{queue}}
+#PBS -N {{job_name}}
+#PBS -l select={{nodes}}:ncpus={{cores}}:mem={{mem_gb}}gb
+{{if multinode}}#PBS -l place=scatter
+{{end}}#PBS -e {{error_path}}
+#PBS -o /dev/null
+{{if account}}#PBS -A {{account}}
+{{end}}{{if array}}#PBS -J {{array}}
+{{end}}""",
+
+'header_slurm': """#!/bin/bash
+#SBATCH --partition={{queue}}
+#SBATCH --job-name={{job_name}}
+#SBATCH --nodes={{nodes}}
+#SBATCH --ntasks-per-node=1
+#SBATCH --cpus-per-task={{cores}}
+#SBATCH --mem={{mem_gb}}G
+#SBATCH --error={{error_path}}
+#SBATCH --output=/dev/null
+{{if account}}#SBATCH --account={{account}}
+{{end}}{{if array}}#SBATCH --array={{array}}
+{{end}}""",
+
+'tmux': """{{header}}
+export QCONNECT=tmux
+{{if cluster}}export QCONNECT_CLUSTER={{cluster}}
+{{end}}{{if multinode}}export QCONNECT_NODES="{{node_list}}"
+{{end}}
+if [ -x {{agent}} ]; then
+  {{if pool}}export QCONNECT_POOL={{pool}}
+  {{end}}exec {{agent}} --agent tmux
+fi
+
+session_id={{job_id}}
+{{if xpra}}display={{display}}
+if xpra start :$display >/dev/null 2>&1; then
+  export DISPLAY=:$display
+fi
+{{end}}tmux new-session -s $session_id -d
+PID=$(tmux display-message -p '#{pid}')
+{{if state_dir}}mkdir -p {{state_dir}}
+trap "rm -f {{state_dir}}/$session_id.ready {{state_dir}}/$session_id.claimed" EXIT
+touch {{state_dir}}/$session_id.ready
+{{end}}{{if pool}}pool_deadline=$(( $(date +%s) + {{pool}} ))
+{{end}}while kill -0 $PID >/dev/null 2>&1 && tmux has-session -t $session_id >/dev/null 2>&1; do
+  {{if pool}}if [ $(date +%s) -ge $pool_deadline ] && (set -C; echo expired > {{state_dir}}/$session_id.claimed) 2>/dev/null; then
+    tmux kill-session -t $session_id
+    break
+  fi
+  {{end}}sleep 5
+done
+{{if xpra}}xpra stop :$display >/dev/null 2>&1
+rm -f ~/.xpra/:$display.log
+{{end}}exit 0
+""",
+
+'gui': """{{header}}
+export QCONNECT=gui
+{{if cluster}}export QCONNECT_CLUSTER={{cluster}}
+{{end}}{{if multinode}}export QCONNECT_NODES="{{node_list}}"
+{{end}}
+if [ -x {{agent}} ]; then
+  export QCONNECT_COMMAND={{command_quoted}}
+  exec {{agent}} --agent gui
+fi
 
-        # Check that this is actually one of our jobs
-        identifier = '_'.join(names[-2:])
-        if identifier == 'int_tmux':
-            type = 'tmux'
-        elif identifier == 'int_vnc':
-            type = 'vnc'
-        elif identifier == 'int_gui':
-            type = 'gui'
+job_id={{job_id}}
+display={{display}}
+xpra start :$display
+export DISPLAY=:$display
+{{if state_dir}}mkdir -p {{state_dir}}
+trap "rm -f {{state_dir}}/$job_id.ready" EXIT
+touch {{state_dir}}/$job_id.ready
+{{end}}{{command}} &
+wait $!
+xpra stop :$display
+rm -f ~/.xpra/:$display.log
+exit 0
+""",
+
+'vnc': """{{header}}
+export QCONNECT=vnc
+{{if cluster}}export QCONNECT_CLUSTER={{cluster}}
+{{end}}{{if multinode}}export QCONNECT_NODES="{{node_list}}"
+{{end}}
+if [ -x {{agent}} ]; then
+  exec {{agent}} --agent vnc
+fi
+
+{{if state_dir}}job_id={{job_id}}
+display=1
+while [ -e /tmp/.X$display-lock ] || [ -e /tmp/.X11-unix/X$display ]; do
+  display=$((display + 1))
+done
+vncserver :$display -geometry {{vnc_geometry}} -fg &
+mkdir -p {{state_dir}}
+trap "rm -f {{state_dir}}/$job_id.status" EXIT
+printf '{"job_id": "%s", "type": "vnc", "node": "%s", "state": "ready", "display": ":%s", "pid": %s}\\n' \\
+  $job_id $(hostname -s) $display $! > {{state_dir}}/$job_id.status
+wait
+{{end}}{{if not state_dir}}vncserver -geometry {{vnc_geometry}} -fg
+{{end}}""",
+}
+
+_template_tag = re.compile(r'{{\s*end\s*}}|{{\s*(if\s+not\s+|if\s+)?(\w+)\s*}}')
+
+def load_template(name):
+    """ Return the text of the named template, user templates first """
+    if template_dir:
+        path = os.path.join(os.path.expanduser(template_dir), name + '.pbs')
+        if os.path.isfile(path):
+            with open(path) as fin:
+                return fin.read()
+    if name in job_templates:
+        return job_templates[name]
+    raise ValueError("no template named '{}'".format(name))
+
+def template_names():
+    """ All template names, built in and from template_dir """
+    names = set(i for i in job_templates if not i.startswith('header'))
+    if template_dir and os.path.isdir(os.path.expanduser(template_dir)):
+        names.update(i[:-4] for i in os.listdir(os.path.expanduser(template_dir)) if i.endswith('.pbs'))
+    return sorted(names)
+
+def compile_template(text):
+    """ Split template text into a list of parts: plain strings, and
+        (name,) for substitutions or (name, negate, parts) for blocks """
+    parts = []
+    block = None
+    last  = 0
+    for tag in _template_tag.finditer(text):
+        target = block[2] if block else parts
+        if tag.start() > last:
+            target.append(text[last:tag.start()])
+        last = tag.end()
+        condition, name = tag.groups()
+        if condition:
+            if block:
+                raise ValueError("{{if}} blocks cannot be nested")
+            block = (name, 'not' in condition, [])
+        elif name:
+            target.append((name,))
         else:
-            continue
+            if not block:
+                raise ValueError("{{end}} without {{if}}")
+            parts.append(block)
+            block = None
+    if block:
+        raise ValueError("{{if " + block[0] + "}} is never closed")
+    parts.append(text[last:])
+    return parts
 
-        # Fix queue name
-        name = '_'.join(names[:-2])
-        name = name if name else type
+@lru_cache(maxsize=None)
+def _compiled_template(name):
+    return compile_template(load_template(name))
 
-        # Assemble the dictionary
-        jobs[job_id] = {'queue'    : queue,
-                        'job_name' : name,
-                        'type'     : type,
-                        'node'     : node,
-                        'state'    : f[9]}
+def _render(parts, params):
+    out = []
+    for part in parts:
+        if isinstance(part, str):
+            out.append(part)
+        elif len(part) == 1:
+            out.append(params[part[0]])
+        elif bool(params[part[0]]) != part[1]:
+            out.append(_render(part[2], params))
+    return ''.join(out)
 
-    # Sort the dictionary
-    jobs = OrderedDict(sorted(jobs.items()))
+@lru_cache(maxsize=64)
+def _render_cached(name, params):
+    return _render(_compiled_template(name), dict(params))
 
-    return(jobs)
+def render_template(name, **params):
+    """ Render the named template with params. Raises KeyError for
+        variables that aren't in params and ValueError for bad templates """
+    return _render_cached(name, tuple(sorted(params.items())))
 
-def check_job(job_id):
-    """ Check a job_id, if it is running return state, else return False """
-    qstat = rn(['qstat', job_id]).decode('utf8').split('\n')[2:3]
+## Waiting
 
-    if not qstat:
-        return(False)
+class FixedWait(object):
+    """ Check the queue every interval seconds """
+    def __init__(self, interval=wait_initial):
+        self.interval = interval
+
+    def next_delay(self):
+        return self.interval
+
+    def wait(self, job_id, marker=True):
+        """ Sleep until the next check, return True if the job reported
+            that it is ready in the meantime. With marker False the ready
+            marker is ignored. """
+        sleep(self.next_delay())
+        return False
+
+class BackoffWait(FixedWait):
+    """ Exponential backoff with jitter, starting at initial seconds and
+        capped at maximum. Each wait is randomly between half and all of
+        the current delay so that many clients don't check in lockstep. """
+    def __init__(self, initial=wait_initial, maximum=wait_max, factor=2):
+        self.initial = initial
+        self.maximum = maximum
+        self.factor  = factor
+        self.delay   = initial
+
+    def next_delay(self):
+        from random import uniform
+        delay      = uniform(self.delay / 2, self.delay)
+        self.delay = min(self.delay * self.factor, self.maximum)
+        return delay
+
+class MarkerWait(object):
+    """ Wrap another strategy and return early as soon as the job script
+        drops its ready marker into state_dir. Checking for the file is a
+        local stat, so it can be done often without touching pbs_server. """
+    def __init__(self, strategy, check_interval=0.25):
+        self.strategy       = strategy
+        self.check_interval = check_interval
+
+    def next_delay(self):
+        return self.strategy.next_delay()
+
+    def wait(self, job_id, marker=True):
+        if not marker:
+            return self.strategy.wait(job_id)
+        deadline = time() + self.next_delay()
+        while not job_ready(job_id):
+            remaining = deadline - time()
+            if remaining <= 0:
+                return False
+            sleep(min(self.check_interval, remaining))
+        return True
+
+class DaemonWait(object):
+    """ Have the daemon wake us as soon as its scans see the job change
+        state, checking for the ready marker every check_interval seconds
+        meanwhile. None of this touches the scheduler. """
+    def __init__(self, timeout=wait_max, check_interval=1):
+        self.timeout        = timeout
+        self.check_interval = check_interval
+        self.state          = None
+
+    def next_delay(self):
+        return self.timeout
+
+    def wait(self, job_id, marker=True):
+        ready    = job_ready if marker else lambda job_id: False
+        deadline = time() + self.timeout
+        while time() < deadline:
+            if ready(job_id):
+                return True
+            reply = daemon_request({'op': 'wait', 'job_id': job_id, 'state': self.state,
+                                    'timeout': self.check_interval}, timeout=self.check_interval + 5)
+            if reply is None:
+                # The daemon went away, the next check asks the scheduler
+                sleep(self.check_interval)
+                return ready(job_id)
+            if not reply['state'] == self.state:
+                self.state = reply['state']
+                return ready(job_id)
+        return False
+
+wait_strategies = {'fixed': FixedWait, 'backoff': BackoffWait}
+
+def make_wait_strategy():
+    """ Build the configured wait strategy, or wait on the daemon if there
+        is one """
+    if daemon_request({'op': 'ping'}) is not None:
+        return DaemonWait()
+    strategy = wait_strategies[wait_strategy]()
+    return MarkerWait(strategy) if state_dir else strategy
+
+def ready_marker(job_id):
+    """ Path of the file a job creates once its session is usable """
+    return os.path.join(os.path.expanduser(state_dir), job_key(job_id) + '.ready')
+
+def job_ready(job_id):
+    """ Has job_id reported that it is ready """
+    return bool(state_dir) and os.path.exists(ready_marker(job_id))
+
+## Session Pool
+# With pool_size set, idle tmux jobs named pool_name are kept running. A
+# session is taken out of the pool by creating its claim marker in state_dir
+# with O_EXCL, so that two qconnect runs can't claim the same one. The agent of
+# a session that nobody claimed within pool_idle_timeout claims it itself
+# before it exits, so a session is either used or retired, never both.
+
+pool_name = 'pool'
+
+def claim_marker(job_id):
+    """ Path of the file that marks pool session job_id as claimed """
+    return os.path.join(os.path.expanduser(state_dir), job_key(job_id) + '.claimed')
+
+def claim_job(job_id, by='user'):
+    """ Atomically claim pool session job_id, return True if we got it """
+    try:
+        fd = os.open(claim_marker(job_id), os.O_CREAT | os.O_EXCL | os.O_WRONLY, 0o644)
+    except OSError:
+        return False
+    os.write(fd, by.encode())
+    os.close(fd)
+    return True
+
+def claimed_by(job_id):
+    """ Who claimed pool session job_id, 'user' or 'expired', '' if nobody """
+    try:
+        with open(claim_marker(job_id)) as fin:
+            return fin.read().strip() or 'user'
+    except OSError:
+        return ''
+
+def pooled(job_id, job):
+    """ Is job an idle session waiting in the pool """
+    return job.job_name == pool_name and job.type == 'tmux' and bool(state_dir) \
+        and not os.path.exists(claim_marker(job_id))
+
+def claim_pool_job(job_list):
+    """ Claim a running pool session that is ready, return its id or '' """
+    for job_id, job in job_list.items():
+        if job.state == 'R' and pooled(job_id, job) and job_ready(job_id) and claim_job(job_id):
+            return job_id
+    return ''
+
+def refill_pool():
+    """ Run qconnect --pool in the background to replace used sessions """
+    Popen([sys.executable, os.path.realpath(__file__), '--pool'], stdin=subprocess.DEVNULL,
+          stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL, start_new_session=True)
+
+def fill_pool():
+    """ Give claimed pool sessions the name of a normal tmux job, and submit
+        new ones until pool_size are waiting. Does nothing if another
+        qconnect is already doing this. """
+    if not pool_size or not state_dir:
+        print("The session pool is disabled, set pool_size and state_dir", file=stderr)
+        return
+    lock = None
+    if runtime_dir():
+        import fcntl
+        lock = open(os.path.join(runtime_dir(), 'pool.lock'), 'w')
+        try:
+            fcntl.flock(lock, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except OSError:
+            lock.close()
+            return
+
+    try:
+        jobs = get_jobs(refresh=True)
+        if jobs is None:
+            # Without a scan the idle sessions can't be counted
+            return
+        idle = 0
+        for job_id, job in jobs.items():
+            if not job.job_name == pool_name or not job.type == 'tmux':
+                continue
+            if pooled(job_id, job):
+                idle += 1
+            elif job.state == 'R' and claimed_by(job_id) == 'user':
+                with on_cluster(job.cluster):
+                    get_scheduler().rename(job_id, 'int_tmux')
+        if idle < pool_size:
+            create_jobs(pool_size - idle, name=pool_name, pool=True)
+    finally:
+        if lock:
+            lock.close()
+
+## Attach Pipeline
+# Getting from a job id to an attached session means waiting on the
+# scheduler, the node's sshd and the job script in turn. prepare_attach runs
+# these steps as asyncio tasks so that they overlap: the agent's status file
+# names the node as soon as the job starts, usually before the scheduler is
+# asked again, and the ssh connection to it is warmed right away while the
+# job is looked up. The session is then watched for in the status file and
+# probed over ssh at the same time. Blocking calls run in daemon threads, so
+# Ctrl-C returns at once without waiting for them, and never touches the job.
+# asyncio is only imported here, it takes longer to import than the rest of
+# qconnect together.
+
+def _in_thread(function, *args):
+    """ Run function(*args) in a daemon thread, return an asyncio future
+        for its result """
+    import asyncio
+    loop    = asyncio.get_running_loop()
+    future  = loop.create_future()
+    context = contextvars.copy_context()
+
+    def settle(result, error):
+        if future.done():
+            return
+        if error is None:
+            future.set_result(result)
+        else:
+            future.set_exception(error)
+
+    def target():
+        try:
+            outcome = (context.run(function, *args), None)
+        except BaseException as err:
+            outcome = (None, err)
+        try:
+            loop.call_soon_threadsafe(settle, *outcome)
+        except RuntimeError:
+            # Nobody is waiting any more
+            pass
+
+    threading.Thread(target=target, daemon=True).start()
+    return future
+
+def find_job(job_id):
+    """ The Job for job_id if it is one of this user's sessions, else None.
+        Uses the cached scan if that knows the node, and otherwise the
+        daemon, or the scheduler for this one job, instead of a full scan. """
+    job_list = get_jobs()
+    if job_list and job_id in job_list and job_list[job_id].node:
+        return job_list[job_id]
+    jobs = daemon_jobs(refresh=True)
+    if jobs is not None:
+        return jobs.get(job_id)
+    try:
+        jobs = list(get_scheduler().get_jobs([job_id]))
+    except SchedulerError as err:
+        print("The scheduler did not answer: {}".format(err), file=stderr)
+        return None
+    for job in jobs:
+        if job.owner == uid and job.queue == current_cluster().queue and active_session(job):
+            return job
+    return None
+
+async def _status_node(job_id, interval=0.25):
+    """ Wait until the agent's status file for job_id says which node the
+        job runs on, and return it. Never returns without state_dir. """
+    import asyncio
+    while True:
+        status = read_status(job_id) if state_dir else None
+        if status and status.get('node') and not status.get('state') == 'exited':
+            return status['node']
+        await asyncio.sleep(interval if state_dir else 3600)
+
+async def _wait_running(job_id, notify=None):
+    """ Wait with the configured strategy until job_id leaves the queued
+        states, return its state, False if the scheduler doesn't know it """
+    strategy = make_wait_strategy()
+    state, _ = await _in_thread(get_scheduler().wait_for_state, job_id, strategy, job_ready(job_id), notify)
+    return state
+
+async def _wait_ready(job, timeout=10, interval=0.25):
+    """ Wait up to timeout seconds for the session of the running job to
+        come up, and return a Probe of what is alive. The status file is
+        checked every interval seconds while the node is probed over ssh,
+        whichever sees the session first wins. """
+    import asyncio
+    want     = 'xpra' if job.type == 'gui' else 'tmux'
+    deadline = time() + timeout
+    probe    = Probe(job.job_id, job.node)
+    check    = None
+    while time() < deadline:
+        status = read_status(job.job_id)
+        if status and status.get('state') == 'ready':
+            return Probe(job.job_id, job.node, tmux=job.type == 'tmux', xpra=status.get('xpra', False))
+        if status and status.get('state') == 'exited':
+            return Probe(job.job_id, job.node)
+        if check is None:
+            check = _in_thread(probe_node, job.node, job.job_id)
+        done, _ = await asyncio.wait([check], timeout=interval)
+        if done:
+            probe, check = check.result(), None
+            if probe.error or getattr(probe, want):
+                return probe
+    return probe
 
-    return(s(r' +', qstat[0].rstrip())[4])
+async def prepare_attach(job_id, wait=False, notify=None):
+    """ Get job_id ready to attach, waiting for it to start if wait is set.
+        Returns (state, job, probe): job is None if job_id is not a running
+        session of ours, probe is None for VNC jobs, which don't need ssh.
+        notify(state) is called while the job is still queued. """
+    import asyncio
+    warming = {}
 
+    def warm(node):
+        """ Start the master connection to node, once """
+        if node not in warming:
+            warming[node] = _in_thread(ssh_connect, node)
+        return warming[node]
+
+    # Connect as soon as the status file names the node
+    early = asyncio.ensure_future(_status_node(job_id))
+    early.add_done_callback(lambda task: task.cancelled() or warm(task.result()))
+    waiting = None
+    try:
+        if wait:
+            def still_queued(state):
+                # The waiting thread outlives the wait if the status file
+                # told us first, stay quiet then
+                if notify and not waiting.done():
+                    notify(state)
+
+            waiting = asyncio.ensure_future(_wait_running(job_id, still_queued))
+            await asyncio.wait([waiting, early], return_when=asyncio.FIRST_COMPLETED)
+            if waiting.done() and not waiting.result() == 'R':
+                return waiting.result(), None, None
+
+        job = await _in_thread(find_job, job_id)
+        if wait and job and job.state in queued_states and not waiting.done():
+            # The status file was ahead of the scheduler
+            state = await waiting
+            if not state == 'R':
+                return state, None, None
+            job = await _in_thread(find_job, job_id)
+        if not job or not job.state == 'R' or job.type == 'vnc':
+            return (job.state if job else False), job, None
+
+        await warm(job.node)
+        probe = await _wait_ready(job)
+        if not (probe.error or probe.tmux or probe.xpra):
+            # Nothing came up, check the job didn't die meanwhile. If that
+            # can't be told, attaching reports what is missing
+            state = await _in_thread(check_job, job_id)
+            return ('R' if state is None else state), job, probe
+        return 'R', job, probe
+    finally:
+        early.cancel()
+        if waiting:
+            waiting.cancel()
+
+@phase('wait')
 def try_to_attach(job_id, attempt_gui=False):
-    """ Try to attach to job_id every two seconds until success or error """
+    """ Wait for job_id to start using the configured wait strategy and
+        attach as soon as it is ready """
+    asked = time()
     try:
         print("Waiting to attach. If the queue is long, you can safely Ctrl-C")
         print("and come back when the job is running. Then just run qconnect " + job_id)
         print("to attach\n")
 
-        count = 1
-        while 1:
-            count = count - 1
-            sleep(1)
-            s = check_job(job_id)
-            if s:
-                if s == 'Q':
-                    if count == 0:
-                        print("Job is still queueing, we will attach ASAP")
-                        count = 20
-                    continue
-                elif s == 'C':
-                    print("Job error, job already completed. Either you completed it normally")
-                    print("Or it errored out and failed. Check `qstat -f " + job_id + "` for more")
-                    print("details. Exiting")
-                    sys.exit(3)
-                elif s == 'R':
-                    sleep(1)
-                    s = check_job(job_id)
-                    if s == 'R':
-                        attach_job(job_id, attempt_gui)
-                    else:
-                        print("Job died before it even started. Sorry")
-                        sys.exit(3)
-                    return
-                else:
-                    print("Job ID {} is not in the queue.\nCheck the number and try again\n\n".format(job_id))
-                    print_jobs
-                    sys.exit(10)
-            else:
-                print("Queue appears empty, perhaps try running again, or check qstat. It may")
-                print("be necessary to adjust the sleep length")
+        notified = 0
+
+        def notify(state):
+            nonlocal notified
+            if time() - notified > 60:
+                print("Job is still queueing, we will attach ASAP")
+                notified = time()
+
+        import asyncio
+        with on_cluster(cluster_of(job_id)):
+            state, job, probe = asyncio.run(prepare_attach(job_id, wait=True, notify=notify))
+        if state == 'R':
+            # Only the first attach ends the queue wait, not attaching again
+            # to a job that was already running
+            waited = job_id in _submitted or not job.start_time or job.start_time >= asked
+            attach_job(job_id, attempt_gui, job, probe,
+                       queued_since=(_submitted.get(job_id) or job.qtime) if waited else None,
+                       asked=min(max(asked, job.start_time), time()))
+        elif job:
+            print("Job died before it even started. Sorry")
+            sys.exit(3)
+        elif state in ('C', 'E'):
+            print("Job error, job already completed. Either you completed it normally")
+            print("Or it errored out and failed. Check `qstat -f " + job_id + "` for more")
+            print("details. Exiting")
+            sys.exit(3)
+        else:
+            print("Job ID {} is not in the queue.\nCheck the number and try again\n\n".format(job_id))
+            job_list = get_jobs(refresh=True)
+            if job_list:
+                print_jobs(job_list)
+            sys.exit(10)
 
     except KeyboardInterrupt:
-        if xpra_installed:
+        if xpra_installed():
             print("\nGoodbye! To reconnect run qconnect [or --connect-gui] " + job_id)
         else:
             print("\nGoodbye! To reconnect run qconnect " + job_id)
 
-def check_list_and_run(job_list, cores=default_cores, mem='', name='', gui='', vnc=False):
+def check_list_and_run(job_list, cores=default_cores, mem='', name='', gui='', vnc=False, template='',
+                       nodes=default_nodes):
     """ Take a list of existing jobs, and attach if possible.
         If no jobs running, create one.
-        Default is tumx, adding gui="Some program" enables gui jobs """
+        Default is tumx, adding gui="Some program" enables gui jobs.
+        Sessions are only reused if they asked for the same number of nodes """
     if gui:
-        if not xpra_installed:
+        if not xpra_installed():
             print("It appears that xpra is not in your PATH, I cannot run GUI jobs", file=stderr)
             print("Exiting", file=stderr)
             sys.exit(-1)
@@ -231,167 +3435,273 @@ def check_list_and_run(job_list, cores=default_cores, mem='', name='', gui='', v
     else:
         job_type = 'tmux'
 
-    # Attach first job that matches request
+    # Attach first job that matches request, idle pool sessions are only
+    # used below if nothing else is running
     queued_job = ''
     if job_list:
         for k,v in job_list.items():
-            if v['type'] == job_type:
-                if v['state'] == 'Q':
+            if pooled(k, v):
+                continue
+            if not v.node_count == nodes:
+                continue
+            if v.type == job_type:
+                if v.state == 'Q':
                     queued_job = k
-                elif v['state'] == 'R':
+                elif v.state == 'R':
                     try_to_attach(k)
                     return
         if queued_job:
             try_to_attach(queued_job)
+            return
         # If there is a non-tmux job running, attach to that
         # instead, but only if it is running already
         if not job_type == 'tmux':
             for k,v in job_list.items():
-                if v['state'] == 'R':
+                if v.state == 'R' and v.node_count == nodes and not pooled(k, v):
                     try_to_attach(k)
                     return
 
+    # Take a session from the pool if a default tmux session was asked for,
+    # and replace it in the background
+    if pool_size and state_dir and job_type == 'tmux' and cores == default_cores \
+            and nodes == default_nodes and not (mem or name or template):
+        job_id = claim_pool_job(job_list or OrderedDict())
+        refill_pool()
+        if job_id:
+            print("Attaching to pooled session", job_id)
+            attach_job(job_id)
+            return
+
     # If that fails, there are no running jobs, so make one
-    job_id = create_job(cores=cores, mem=mem, gui=gui, name=name, vnc=vnc)
+    job_id = create_job(cores=cores, mem=mem, gui=gui, name=name, vnc=vnc, template=template, nodes=nodes)
     try_to_attach(job_id)
     return
 
-def create_job(cores=default_cores, mem='', gui='', name='', vnc=False):
-    """ Create a job in the queue, wait for it to run, and then attach
-        Ctl-C after submission will not kill job, it will only kill attach
-        queue """
+def make_job_name(name='', gui='', vnc=False):
+    """ Return (job_name, type) for a new job """
+    if gui:
+        gui_name = gui.split(' ')[0]
+        return (name + '_' + gui_name + '_int_gui' if name else gui_name + '_int_gui'), 'gui'
+    elif vnc:
+        return (name + '_int_vnc' if name else 'int_vnc'), 'vnc'
+    return (name + '_int_tmux' if name else 'int_tmux'), 'tmux'
+
+def job_script(cores=default_cores, mem='', gui='', name='', vnc=False, template='', array=0, pool=False,
+               nodes=default_nodes):
+    """ Return (job_name, script) for a new job. The script is rendered from
+        the named template, by default the one matching the job type.
+        If array is set, the script submits a job array of that many jobs.
+        If pool is set, the session waits in the pool to be claimed.
+        cores and mem are per node. """
 
     # Figure out memory request
     try:
-        mem = str(int(cores*default_max_mem/default_max_cores)) + 'GB' if not mem else str(int(mem)) + 'GB'
+        mem_gb = str(int(cores*default_max_mem/default_max_cores)) if not mem else str(int(mem))
     except ValueError:
         print("Incorrect formatting for memory request, please submit an integer multiple in GB")
         sys.exit(1)
 
-    # Create job name
-    if gui:
-        gui_name = gui.split(' ')[0]
-        job_name = name + '_' + gui_name + '_int_gui' if name else gui_name + '_int_gui'
-    elif vnc:
-        job_name = name + '_int_vnc' if name else 'int_vnc'
-    else:
-        job_name = name + '_int_tmux' if name else 'int_tmux'
+    job_name, type = make_job_name(name, gui, vnc)
 
-    # Prep the job
-    template = "#!/bin/bash\n#PBS -S /bin/bash\n"
-    template = ''.join([template, "#PBS -q ", interactive_queue,
-                        "\n#PBS -N ", job_name,
-                        '\n#PBS -l nodes=1:ppn=' + str(cores),
-                        '\n#PBS -l mem=' + mem,
-                        '\n#PBS -e ' + os.environ['HOME'] + '/.' + job_name + '.error',
-                        '\n#PBS -o /dev/null'])
+    # The job names its files, sessions and display the way job_key() and
+    # xpra_display() do, from the scheduler's id
+    clusters = get_clusters()
+    number   = get_scheduler().job_id_shell
+    job_id   = number
+    display  = number
+    if len(clusters) > 1:
+        job_id  = shlex.quote(current_cluster().name) + '@' + number
+        display = '$(( {} * {} + {} ))'.format(number, len(clusters), clusters.index(current_cluster()))
 
-    if gui:
-        template = template + ("\n\nexport QCONNECT=gui"
-                               "\n\njob_id=$(echo $PBS_JOBID | sed 's#\..*##g')\n"
-                               "xpra start :$job_id\n"
-                               "export DISPLAY=:${job_id}\n"
-                               "sleep 1\n" +
-                               gui + "\n"
-                               "PID=$!\n"
-                               "sleep 1\n"
-                               "while true\n"
-                               "do\n"
-                               "  if kill -0 $PID > /dev/null 2>&1; then\n"
-                               "    sleep 5\n"
-                               "  else\n"
-                               "    xpra stop :${job_id}\n"
-                               "    xpra list >/dev/null 2>/dev/null\n"
-                               "    rm ~/.xpra/:${job_id}.log 2>/dev/null\n"
-                               "    exit 0\n"
-                               "  fi\n"
-                               "done\n")
+    params = {'queue'        : current_cluster().queue,
+              'job_name'     : job_name,
+              'cores'        : str(cores),
+              'nodes'        : str(nodes),
+              'multinode'    : 'yes' if nodes > 1 else '',
+              'node_list'    : get_scheduler().nodes_shell,
+              # Torque's mem is for the whole job
+              'mem'          : str(int(mem_gb) * nodes) + 'GB',
+              'mem_gb'       : mem_gb,
+              'error_path'   : os.path.join(os.environ['HOME'], '.' + job_name + '.error'),
+              'type'         : type,
+              'command'      : gui or '',
+              'command_quoted': shlex.quote(gui or ''),
+              'agent'        : shlex.quote(agent_path or os.path.realpath(__file__)),
+              'job_id'       : job_id,
+              'display'      : display,
+              'cluster'      : shlex.quote(current_cluster().name) if len(clusters) > 1 else '',
+              'state_dir'    : os.path.expanduser(state_dir),
+              'vnc_geometry' : vnc_geometry,
+              'array'        : '0-' + str(array - 1) if array else '',
+              'account'      : current_cluster().account,
+              'pool'         : str(pool_idle_timeout) if pool and state_dir else '',
+              # xpra displays must be numbers, which array job ids are not
+              'xpra'         : 'yes' if xpra_installed() and not array else ''}
+    params['header'] = render_template(get_scheduler().header, **params)
 
-    elif vnc:
-        if not vnc_installed:
-            print("It appears that vncviewer is not in your PATH, I cannot create a VNC connection", file=stderr)
-            print("Exiting", file=stderr)
-            sys.exit(-1)
+    try:
+        script = render_template(template or type, **params)
+    except KeyError as err:
+        print("Cannot use job template {}: unknown variable {}".format(template or type, err), file=stderr)
+        sys.exit(1)
+    except ValueError as err:
+        print("Cannot use job template {}: {}".format(template or type, err), file=stderr)
+        sys.exit(1)
 
-        template = template + ("\n\nexport QCONNECT=vnc\n\nvncserver -geometry " + vnc_geometry + " -fg\n")
+    return job_name, script
 
-    else:
-        template = template + ( "\n\nexport QCONNECT=tmux"
-                                "\n\nsession_id=$(echo $PBS_JOBID | sed 's#\..*##g')\n")
-        if xpra_installed:
-            template = template + ("if xpra start :$session_id >/dev/null 2>/dev/null; then\n"
-                                   "    export DISPLAY=:$session_id\n"
-                                   "fi\n")
-
-        template = template + ( "CMD=\"tmux new-session -s $session_id -d\"\n"
-                                "$CMD\n"
-                                "PID=$(ps axo pid,user,cmd | grep tmux | grep $USER | grep -v grep | awk '{print $1}')\n"
-                                "while true\n"
-                                "do\n"
-                                "  if kill -0 $PID > /dev/null 2>&1; then\n"
-                                "    if [[ ! $(tmux ls | grep $session_id) ]]; then\n")
-        if xpra_installed:
-            template = template + ("      xpra stop :$session_id >/dev/null 2>/dev/null\n"
-                                   "      xpra list >/dev/null 2>/dev/null\n"
-                                   "      rm ~/.xpra/:$session_id.log 2>/dev/null\n")
-
-        template = template + ( "      exit 0\n"
-                                "    else\n"
-                                "      sleep 5\n"
-                                "    fi\n"
-                                "  else\n")
-    if xpra_installed:
-        template = template + ("      xpra stop :$session_id >/dev/null 2>/dev/null\n"
-                                "      xpra list >/dev/null 2>/dev/null\n"
-                                "      rm ~/.xpra/:$session_id.log 2>/dev/null\n")
-
-        template = template + ( "    exit 0\n"
-                                "  fi\n"
-                                "done\n")
-    if debug:
-        print(template)
-
-    pbs_command = (['qsub'])
-
-    # Submit the job
-    pbs_submit = subprocess.Popen(pbs_command, stdin=subprocess.PIPE, stdout=subprocess.PIPE)
-    pbs_submit.stdin.write(template.encode())
-    pbs_submit.stdin.close()
-
-    # Get job number
-    job_no = (pbs_submit.stdout.read().decode().rstrip())
-    try:
-        job_no = find(r'[0-9]+', job_no)[0]
-    except IndexError:
-        print("PBS Submission failed with message:\n{}".format(job_no), file=stderr)
+@phase('submit')
+def create_job(cores=default_cores, mem='', gui='', name='', vnc=False, template='', nodes=default_nodes):
+    """ Create a job in the queue, wait for it to run, and then attach
+        Ctl-C after submission will not kill job, it will only kill attach
+        queue """
+
+    if vnc and not vnc_installed():
+        print("It appears that vncviewer is not in your PATH, I cannot create a VNC connection", file=stderr)
+        print("Exiting", file=stderr)
+        sys.exit(-1)
+
+    # Submit the job, to the cluster with the shortest queue
+    with on_cluster(place_job()) as cluster:
+        job_name, template = job_script(cores, mem, gui, name, vnc, template, nodes=nodes)
+        if debug:
+            print(template)
+        job_no, message = get_scheduler().submit(template)
+    if not job_no:
+        print("Job submission failed with message:\n{}".format(message), file=stderr)
         sys.exit(1)
+    _submitted[job_no] = time()
+    _placed(cluster, 1)
+    drop_cache()
     print("Job", job_name, "created with job id", job_no, "\n")
-    sleep(1)
 
     return(job_no)
 
-def attach_job(job_id, attempt_gui=False):
+@phase('submit')
+def create_jobs(count, cores=default_cores, mem='', gui='', name='', vnc=False, template='', array=False, pool=False,
+                nodes=default_nodes):
+    """ Create count identical jobs without attaching to any of them.
+        The script is rendered once and submitted by up to max_parallel
+        concurrent submissions, or as a single job array if array is True.
+        pool jobs wait in the session pool, see fill_pool().
+        Returns the list of job ids that were created. """
+    from concurrent.futures import as_completed
+
+    if vnc and not vnc_installed():
+        print("It appears that vncviewer is not in your PATH, I cannot create a VNC connection", file=stderr)
+        print("Exiting", file=stderr)
+        sys.exit(-1)
+
+    # All of them go to the cluster with the shortest queue
+    cluster = place_job()
+    if array:
+        with on_cluster(cluster):
+            job_name, script = job_script(cores, mem, gui, name, vnc, template, array=count, nodes=nodes)
+            job_no, message  = get_scheduler().submit(script)
+            if not job_no:
+                print("Submission of a {} job array failed with message:\n{}".format(count, message), file=stderr)
+                return []
+            job_ids = get_scheduler().array_ids(job_no, count)
+        _placed(cluster, len(job_ids))
+        drop_cache()
+        print("Job array", job_name, "created with job id", job_no, "({} jobs)".format(count))
+        return job_ids
+
+    with on_cluster(cluster):
+        job_name, script = job_script(cores, mem, gui, name, vnc, template, pool=pool, nodes=nodes)
+        futures = [_executor().submit(contextvars.copy_context().run, get_scheduler().submit, script)
+                   for i in range(count)]
+    job_ids  = []
+    failures = []
+    for future in as_completed(futures):
+        job_no, message = future.result()
+        if job_no:
+            job_ids.append(job_no)
+            _submitted[job_no] = time()
+            print("Job", job_name, "created with job id", job_no)
+        else:
+            failures.append(message)
+
+    _placed(cluster, len(job_ids))
+    if job_ids:
+        drop_cache()
+    if failures:
+        print("\n{} of {} submissions failed, the first error was:\n{}".format(
+              len(failures), count, failures[0]), file=stderr)
+    return sorted(job_ids, key=lambda i: int(find(r'[0-9]+', bare_id(i))[0]))
+
+@phase('attach')
+def attach_job(job_id, attempt_gui=False, job=None, probe=None, queued_since=None, asked=None):
     """ Attach to a currently running job, default is tmux.
-        To attach to a GUI running in tmux, pass attempt_gui """
+        To attach to a GUI running in tmux, pass attempt_gui. job and probe
+        come from prepare_attach, which is run here if they are not given.
+        For the metrics, asked is when attaching became possible if that was
+        before this call, and queued_since is when a job that was waited for
+        was submitted """
+    asked = asked or time()
 
-    # Get details
-    job_list = check_queue(uid)
-    try:
-        node  = job_list[job_id]['node']
-        type  = job_list[job_id]['type']
-        state = job_list[job_id]['state']
-    except KeyError:
+    # Find the node, connect to it and check the session, all at once
+    if job is None:
+        import asyncio
+        with on_cluster(cluster_of(job_id)):
+            state, job, probe = asyncio.run(prepare_attach(job_id))
+    if job is None:
         print("Sorry, that job number doesn't exist. Please try again")
-        print_jobs(job_list)
+        job_list = get_jobs(refresh=True)
+        if job_list:
+            print_jobs(job_list)
         sys.exit(1)
+    node  = job.node
+    type  = job.type
+    state = job.state
 
     if not state == 'R':
         print("Job not running, cannot attach")
         return
 
+    def attached(ok=True):
+        """ Record the attach, just before the session takes over the terminal """
+        now    = time()
+        events = [{'event': 'attach', 'cluster': job.cluster, 'job_id': job_id, 'type': type,
+                   'seconds': round(now - asked, 3), 'ok': ok}]
+        if ok and queued_since:
+            events.append({'event': 'queue_wait', 'cluster': job.cluster, 'job_id': job_id,
+                           'seconds': round(now - queued_since, 3)})
+        record_events(events)
+
+    # Attaching to a pool session by id takes it out of the pool
+    if job.job_name == pool_name and state_dir:
+        claim_job(job_id)
+
+    # VNC viewers connect to the node directly, ssh is only needed if the
+    # display isn't recorded
+    if type == 'vnc':
+        if not vnc_installed():
+            print("It appears that vncviewer is not in your PATH, I cannot run connect to a VNC session", file=stderr)
+            print("Exiting", file=stderr)
+            sys.exit(-1)
+
+        display = vnc_display(job_id, node)
+        if not display:
+            print("It appears no VNC server of job {} is running on {}.".format(job_id, node))
+            print("If the job is still running in the queue, there is a problem.")
+            print("Try clearing out the *.log and *.pid files in $HOME/.vnc, and killing")
+            print("the running VNC queue job")
+            attached(ok=False)
+            return
+
+        attached()
+        call(['vncviewer', node + ':' + display])
+        return
+
+    if probe.error:
+        print("Cannot reach {}: {}".format(node, probe.error), file=stderr)
+        attached(ok=False)
+        return
+
     if type == 'gui' or attempt_gui:
         # Confirm GUI Possible
-        if not xpra_installed:
+        if not xpra_installed():
             print("It appears that xpra is not in your PATH, I cannot run GUI jobs", file=stderr)
             print("Exiting", file=stderr)
             sys.exit(-1)
@@ -404,12 +3714,13 @@ def attach_job(job_id, attempt_gui=False):
         sleep(1)
 
         # Actually attach to the session!
-        subprocess.call(['xpra', 'attach', 'ssh:' + uid + '@' + node + ':' + job_id])
+        attached()
+        call(['xpra', 'attach'] + xpra_ssh_option() + ['ssh:' + uid + '@' + node + ':' + xpra_display(job_id)])
         return
 
     elif type == 'tmux':
         # Do not attach if running from within a tmux session already
-        if rn('echo $TMUX', shell=True).decode().rstrip():
+        if os.environ.get('TMUX'):
             print("You are already running a tmux session, sessions should be nested with care")
             print("To force run, unset the $TMUX variable, but I suggest you just detatch your")
             print("current session and try the same command again")
@@ -417,92 +3728,184 @@ def attach_job(job_id, attempt_gui=False):
 
         # Attempt to initially attach to xpra, fail gracefully without
         # notifying user
-        if xpra_installed:
-            GUI_PID=''
-            if subprocess.call("xpra attach ssh:" + uid + "@" + node + ":" + job_id + " >/dev/null 2>/dev/null &", shell=True) == 0:
-                GUI_PID = subprocess.check_output('ps axo pid,user,cmd | grep "xpra attach" | grep "' + job_id + '$"| awk \'{print $1}\'', shell=True).decode().rstrip()
-
-        # Actually attach to the session!
-        job_string = ' '.join(['ssh', node, '-t', 'DISPLAY=:' + job_id, 'tmux', 'a', '-t', job_id])
-        subprocess.call(job_string, shell=True)
-
-        # Kill GUI if open
-        if xpra_installed and GUI_PID:
-            subprocess.call(['kill', GUI_PID])
-
-    elif type == 'vnc':
-        # Check that vnc can run
-        if not vnc_installed:
-            print("It appears that vncviewer is not in your PATH, I cannot run connect to a VNC session", file=stderr)
-            print("Exiting", file=stderr)
-            sys.exit(-1)
-
-        # Get VNC Port
-        ports = []
-        files = subprocess.check_output('ssh ' + node + ' "ls $HOME/.vnc"', shell=True).decode().rstrip().split('\n')
-        for i in files:
-            if i.startswith(node) and i.endswith('pid'):
-                    port = find(r':([0-9]+)\.pid', i)[0]
-                    ports.append(port)
-
-        if not ports:
-            print("It appears no VNC servers are running on the selected server.")
-            print("If the job is still running in the queue, there is a problem.")
-            print("Try clearing out the *.log and *.pid files in $HOME/.vnc, and killing")
-            print("the running VNC queue job")
-            return
-
-        if len(ports) > 1:
-            print("There is more than one vnc server running for you on that node.")
-            print("That isn't allowed and I don't know which one to join. It may")
-            print("be that your last session exited without cleaning $HOME/.vnc")
-            print("Check in there and clean out log files for vnc servers that")
-            print("aren't running to prevent problems")
+        if not probe.tmux:
+            print("The tmux session for job {} is not running on {}, the job".format(job_id, node))
+            print("may still be starting or may be exiting")
+            attached(ok=False)
             return
 
-        subprocess.call(['vncviewer', node + ':' + ports[0]])
-        return
+        # Actually attach to the session! The GUI, if there is one, is
+        # attached alongside and closed when tmux detaches
+        command = 'export DISPLAY=:' + xpra_display(job_id) + '; ' + tmux_remote(job_id, 'a', '-t', job_key(job_id))
+        if len(job.nodes) > 1:
+            # New windows get the node list too, whichever way the job started
+            command = tmux_remote(job_id, 'set-environment', '-t', job_key(job_id), 'QCONNECT_NODES',
+                                  ' '.join(job.nodes)) + '; ' + command
+            print("Job {} runs on {}, attaching on {}. $QCONNECT_NODES lists them all".format(
+                  job_id, ', '.join(job.nodes), node))
+        attached()
+        if xpra_installed() and probe.xpra:
+            with GuiSession(node, job_id):
+                node_call(node, command, tty=True)
+        else:
+            node_call(node, command, tty=True)
 
     else:
         print("I don't understand the job type")
         return
 
-def print_jobs(job_list):
-    """ Pretty print a list of running interactive jobs from create_queue """
+def print_jobs(job_list, probes=None):
+    """ Pretty print a list of running interactive jobs from create_queue.
+        If probes from probe_jobs are given, add what is alive on the node """
 
+    id_len   = 6
     name_len = 10
+    node_len = 6
+    now      = time()
 
+    # Ids are cluster/number if there are several clusters
     for k, v in job_list.items():
-        name_len = max([name_len, len(v['job_name'])])
+        id_len   = max([id_len, len(k)])
+        name_len = max([name_len, len(v.job_name)])
+        node_len = max([node_len, len(','.join(v.nodes))])
+    id_len   = id_len + 2
     name_len = name_len + 2
+    node_len = node_len + 2
 
     # Print the thing
-    print("Job_ID".ljust(8) + "Job_Name".ljust(name_len) + "Job_Type".ljust(10) + "Queue".ljust(13) + "Node".ljust(8) + "State".ljust(7))
-    print("=".ljust(6, '=') + "  " + "=".ljust(name_len - 2, '=') + "  " + "=".ljust(8, '=') + "  " + "=".ljust(11, '=') + "  " + "=".ljust(6, '=') + "  " + "=".ljust(5, '='))
+    print("Job_ID".ljust(id_len) + "Job_Name".ljust(name_len) + "Job_Type".ljust(10) + "Queue".ljust(13) + "Node".ljust(node_len) + "State".ljust(7) +
+          "Cores".ljust(7) + "Mem".ljust(7) + "Used".ljust(10) + "Left".ljust(10) + "Queued".ljust(10) + "Idle".ljust(11) + ("Alive" if probes is not None else ''))
+    print("=".ljust(id_len - 2, '=') + "  " + "=".ljust(name_len - 2, '=') + "  " + "=".ljust(8, '=') + "  " + "=".ljust(11, '=') + "  " + "=".ljust(node_len - 2, '=') + "  " + "=".ljust(5, '=') + "  " +
+          "=".ljust(5, '=') + "  " + "=".ljust(5, '=') + "  " + "=".ljust(8, '=') + "  " + "=".ljust(8, '=') + "  " + "=".ljust(8, '=') + "  " + "=".ljust(9, '=') + ("  " + "=".ljust(11, '=') if probes is not None else ''))
     for k,v in job_list.items():
-        print(k.ljust(8) + v['job_name'].ljust(name_len) + v['type'].upper().ljust(10) + v['queue'].ljust(13) + v['node'].ljust(8) + v['state'].ljust(10))
+        alive = probes[k].summary() if probes and k in probes else ''
+        idle  = idle_time(k, now) if v.state == 'R' else None
+        # Sessions past idle_warn are marked, they may be ended by --reap
+        idle  = format_duration(idle) + ('!' if idle_warn and idle >= idle_warn else '') if idle is not None else '--'
+        print(k.ljust(id_len) + v.job_name.ljust(name_len) + v.type.upper().ljust(10) + v.queue.ljust(13) +
+              ','.join(v.nodes).ljust(node_len) + v.state.ljust(7) +
+              str(v.cores or '--').ljust(7) + (v.mem or '--').ljust(7) + format_duration(v.used(now)).ljust(10) +
+              format_duration(v.remaining(now)).ljust(10) + format_duration(v.queued(now)).ljust(10) + idle.ljust(11) + alive)
+
+def jobs_json(job_list, probes=None):
+    """ Return job_list as a JSON string for other programs, with the
+        derived times filled in """
+    now = time()
+    out = []
+    for k, v in job_list.items():
+        job = v.to_dict()
+        job.update([('node', v.node), ('walltime_used', v.used(now)),
+                    ('walltime_remaining', v.remaining(now)), ('queued', v.queued(now)),
+                    ('idle', idle_time(k, now) if v.state == 'R' else None)])
+        if probes and k in probes:
+            job['alive'] = probes[k].summary()
+        out.append(job)
+    return json.dumps({'time': int(now), 'user': uid, 'jobs': out})
+
+def watch_jobs(interval, as_json=False, probe=False, full_every=12):
+    """ Reprint the job table every interval seconds until Ctrl-C.
+        Queued jobs are re-queried on every refresh. Running jobs only change
+        state when they end, so they are re-queried when their ready marker
+        disappears, and otherwise only with a full scan every full_every
+        refreshes. Their times are kept current from the start time. """
+    job_list = get_jobs(refresh=True) or OrderedDict()
+    ready    = set(k for k in job_list if job_ready(k))
+    count    = 0
+    try:
+        while True:
+            probes = probe_jobs(job_list) if probe else None
+            if as_json:
+                print(jobs_json(job_list, probes), flush=True)
+            else:
+                # Move to the top left and clear the screen
+                sys.stdout.write('\033[H\033[J')
+                if job_list:
+                    print_jobs(job_list, probes)
+                else:
+                    print("No running jobs")
+                print("\nEvery {}s, Ctrl-C to exit".format(interval), flush=True)
+
+            sleep(interval)
+            count += 1
+
+            ended = set(k for k in ready if not job_ready(k))
+            daemon_list = daemon_jobs()
+            if daemon_list is not None:
+                # The daemon scans anyway, it's always up to date
+                job_list = daemon_list
+                with _CacheLock():
+                    _write_cache(job_list)
+            elif ended or count % full_every == 0:
+                # Keep showing the last list while the scheduler is down
+                jobs = get_jobs(refresh=True)
+                if jobs is not None:
+                    job_list = jobs
+            else:
+                pending = [k for k, v in job_list.items() if not v.state == 'R']
+                if pending:
+                    updated = OrderedDict()
+                    for cluster in set(job_list[k].cluster for k in pending):
+                        with on_cluster(cluster):
+                            ids = [k for k in pending if job_list[k].cluster == cluster]
+                            try:
+                                updated.update((i.job_id, i) for i in get_scheduler().get_jobs(ids))
+                            except SchedulerError as err:
+                                print("The scheduler did not answer: {}".format(err), file=stderr)
+                                updated.update((k, job_list[k]) for k in ids)
+                    for k in pending:
+                        if k in updated and not updated[k].state == 'C':
+                            job_list[k] = updated[k]
+                        else:
+                            del job_list[k]
+                    with _CacheLock():
+                        _write_cache(job_list)
+            ready = set(k for k in job_list if job_ready(k))
+    except KeyboardInterrupt:
+        print()
+
+def reap_jobs(dry_run=False):
+    """ Warn about sessions that have been idle for idle_warn seconds, and
+        end those idle for idle_reap seconds. Idle pool sessions end on their
+        own and are left alone. With dry_run nothing is ended. """
+    if not state_dir:
+        print("Idle sessions can't be found without state_dir", file=stderr)
+        return
+    now = time()
+    for job_id, job in (get_jobs(refresh=True) or OrderedDict()).items():
+        idle = idle_time(job_id, now) if job.state == 'R' else None
+        if idle is None or pooled(job_id, job):
+            continue
+        if idle_reap and idle >= idle_reap:
+            print("Ending job {} ({}), idle for {}".format(job_id, job.job_name, format_duration(idle)))
+            if dry_run:
+                continue
+            with on_cluster(job.cluster):
+                if not get_scheduler().delete(job_id):
+                    print("Could not end job " + job_id, file=stderr)
+        elif idle_warn and idle >= idle_warn:
+            print("Job {} ({}) has been idle for {}{}".format(
+                  job_id, job.job_name, format_duration(idle),
+                  ', it will be ended in ' + format_duration(idle_reap - idle) if idle_reap else ''))
 
 def create_gui(display_id):
     """ Use xpra to create a gui. Simply set the display variable if it isn't already
         set and xpra is already running.
         Returns 'new' or 'old' on success and False on failure"""
 
-    # Check for a GUI
-    session_id = rn("xpra list| grep LIVE 2>/dev/null| grep ':" + display_id + "$' 2>/dev/null| sed 's/.*://g'", shell=True).decode()
-
     # If doesn't exit, create a session
-    if session_id:
+    if display_id in xpra_displays():
         type = 'old'
     else:
         type = 'new'
         try:
-            subprocess.check_call(['xpra', 'start', '--no-pulseaudio', ':' + display_id])
+            check_call(['xpra', 'start', '--no-pulseaudio', ':' + display_id])
         except subprocess.CalledProcessError as err:
             print("xpra failed with the following error:\n{0}".format(err))
             return(False)
+        xpra_displays.cache_clear()
 
     # Set DISPLAY and return success
-    os.environ['DISPLAY'] = ':' + session_id
+    os.environ['DISPLAY'] = ':' + display_id
     return(type)
 
 def check_state():
@@ -515,8 +3918,8 @@ def check_state():
 def set_display(type):
     """ Check if running in qconnect, and then set xpra display """
     if type == 'tmux':
-        job_id = os.environ['PBS_JOBID'].split('.')[0]
-        type = create_gui(job_id)
+        job_id = own_job_id()
+        type = create_gui(xpra_display(job_id))
         if type == 'old':
             print("GUI already running on this node.")
         elif type == 'new':
@@ -524,12 +3927,13 @@ def set_display(type):
         else:
             print("Attempt to create GUI failed. Sorry")
             return
+        from socket import gethostname
         print("Run this command in your shell:\n\n"
-              "export DISPLAY=:" + job_id + '\n')
+              "export DISPLAY=:" + xpra_display(job_id) + '\n')
         print("To connect to the gui, from the login node, run:\n\n",
               "{:^50}\n{:^50}\n{:^50}".format("qconnect --connect-gui " + job_id,
               "or",
-              "xpra attach ssh:" + os.environ['USER'] + '@' + rn('hostname').decode().rstrip() + ':' + job_id))
+              "xpra attach ssh:" + os.environ['USER'] + '@' + gethostname() + ':' + xpra_display(job_id)))
     else:
         print("Not running in a qconnect session, not creating GUI")
 
@@ -538,7 +3942,6 @@ def _get_args():
     import argparse, sys
 
     type = check_state()
-    queue = check_queue(uid)
 
     if type:
         description = ("NOTE: You are currently in a qconnect " + type + " session\n\n"
@@ -549,7 +3952,7 @@ def _get_args():
     else:
         description = __doc__
 
-    if not xpra_installed:
+    if not xpra_installed():
         description = description + "\n\nxpra is not installed. GUI applications will not work. Disabled"
 
     parser = argparse.ArgumentParser(
@@ -561,92 +3964,204 @@ def _get_args():
 
     # Connection Arguments
     parser.add_argument('-l', '--list',   action='store_true', help="List running interactive jobs")
+    parser.add_argument('-p', '--probe',  action='store_true', help="With --list, check on the nodes which sessions are alive")
+    parser.add_argument('-w', '--watch',  type=float, nargs='?', const=5, metavar='SECONDS', help="List jobs and keep refreshing the list (default every 5s)")
+    parser.add_argument('--json',         action='store_true', help="With --list or --watch, print the job list as JSON")
     parser.add_argument('-c', '--create', action='store_true', help="Create a new job even if existing jobs are running")
+    parser.add_argument('-r', '--refresh', action='store_true', help="Ignore cached job information and query the queue")
 
     # Job control arguments - Only relevant for creation
-    if xpra_installed:
+    if xpra_installed():
         parser.add_argument('-g', '--gui',   help="[Create Only] Create a GUI job with this program (requires an executable as an argument)")
     parser.add_argument('-n', '--name',  help="[Create Only] A name for the job, not required")
-    parser.add_argument('-t', '--cores', type=int, default=default_cores, help="[Create Only] Number of threads to request for job")
+    parser.add_argument('-t', '--cores', type=int, help="[Create Only] Number of threads to request for job, per node")
+    parser.add_argument('--nodes',       type=int, default=default_nodes, help="[Create Only] Number of nodes for the session, it runs on the first with all of them in $QCONNECT_NODES")
     parser.add_argument('-m', '--mem',   type=int, help="[Create Only] Amount of memory to request for job in GB (integer)")
+    parser.add_argument('--auto-size',   action='store_true', help="[Create Only] Request the cores and memory that earlier sessions of the same name used")
+    parser.add_argument('--template',    default='', help="[Create Only] Job script template to use, one of: " + ', '.join(template_names()))
+    parser.add_argument('--dry-run',     action='store_true', help="[Create Only] Print the job script that would be submitted and exit")
+    parser.add_argument('--count',       type=int, default=1, help="[Create Only] Create this many jobs at once, without attaching")
+    parser.add_argument('--array',       action='store_true', help="[Create Only] With --count, submit a single job array instead (if the queue allows arrays)")
+    parser.add_argument('--pool',        action='store_true', help="Submit idle sessions until pool_size are waiting in the pool, and exit")
+    parser.add_argument('--serve',       action='store_true', help="Run the login node daemon that answers job queries for all users")
+    parser.add_argument('--reap',        action='store_true', help="Warn about idle sessions and end those idle for too long, nothing is ended with --dry-run")
+    parser.add_argument('--metrics',     nargs='?', const='-', metavar='FILE', help="Write queue wait, attach and session metrics in the Prometheus text format to FILE (default stdout)")
 
     # VNC
-    if vnc_installed:
+    if vnc_installed():
         parser.add_argument('--vnc', action='store_true', help="Create or attach to an XFCE VNC. Not recommended, but sometimes useful")
 
-    # GUI Connect if job running
-    if xpra_installed and queue:
+    # GUI Connect to a running job
+    if xpra_installed():
         parser.add_argument('--connect-gui', dest='cg', action='store_true', help=("Connect to an xpra GUI on a running tmux job."))
 
     # Version
     parser.add_argument('-v', '--version', action='store_true', help="Display version number")
 
-    return(parser, queue)
+    # Profiling
+    parser.add_argument('--profile',     action='store_true', help="Print where the time went at exit")
+    parser.add_argument('--profile-log', default=profile_log, metavar='FILE', help="Append timings of every external command to FILE as JSON lines")
+
+    # Node side, used by the job scripts qconnect submits
+    parser.add_argument('--agent', choices=['tmux', 'gui', 'vnc'], help=argparse.SUPPRESS)
+
+    # Options that are only added when their program is installed
+    parser.set_defaults(gui=None, vnc=False, cg=False)
+
+    return(parser)
 
 # Main function for direct running
 def main():
     """Run directly"""
 
     # Get commandline arguments
-    parser, job_list = _get_args()
+    parser = _get_args()
     args = parser.parse_args()
 
+    # Report timings at exit
+    if args.profile:
+        import atexit
+        atexit.register(print_profile)
+    if args.profile_log:
+        import atexit
+        atexit.register(write_profile_log, args.profile_log)
+
     # Print version number
     if args.version:
         print(version)
         return
 
+    # Running inside a job on a compute node
+    if args.agent:
+        run_agent(args.agent, os.environ.get('QCONNECT_COMMAND', ''))
+        return
+
+    # Run the login node daemon
+    if args.serve:
+        serve()
+        return
+
+    # Keep scheduler command times for --metrics
+    if metrics_max_events:
+        import atexit
+        atexit.register(record_command_events)
+
+    # Export metrics, e.g. for the node_exporter textfile collector
+    if args.metrics:
+        write_metrics(args.metrics)
+        return
+
+    # End forgotten sessions
+    if args.reap:
+        reap_jobs(dry_run=args.dry_run)
+        return
+
+    # Top up the session pool
+    if args.pool:
+        fill_pool()
+        return
+
     name = args.name if args.name else ''
 
+    # Size new sessions from what earlier ones of the same name used, cores
+    # and memory given on the command line win
+    if args.auto_size and (args.cores is None or args.mem is None):
+        size = auto_size(*split_job_name(make_job_name(name, args.gui, args.vnc)[0]))
+        if size:
+            args.cores = args.cores or size[0]
+            args.mem   = args.mem or size[1]
+            print("Sized from history: {} cores, {}GB".format(args.cores, args.mem), file=stderr)
+        else:
+            print("Not enough finished sessions to size from, using the defaults", file=stderr)
+    args.cores = args.cores or default_cores
+
+    # Show the job script instead of submitting it
+    if args.dry_run:
+        print(job_script(cores=args.cores, mem=args.mem, gui=args.gui, name=name, vnc=args.vnc,
+                         template=args.template, array=args.count if args.array else 0, nodes=args.nodes)[1])
+        return
+
+    # Create many jobs at once, don't attach to any of them
+    if args.count > 1:
+        job_ids = create_jobs(args.count, cores=args.cores, mem=args.mem, gui=args.gui, name=name,
+                              vnc=args.vnc, template=args.template, array=args.array, nodes=args.nodes)
+        print("\nCreated {} of {} jobs, attach with qconnect <job_id>".format(len(job_ids), args.count))
+        if len(job_ids) < args.count:
+            sys.exit(1)
+        return
+
     # Create a new job, ignore vnc creation requests
     if args.create and not args.vnc:
-        job_id = create_job(cores=args.cores, mem=args.mem, gui=args.gui, name=name)
-        sleep(2)
+        job_id = create_job(cores=args.cores, mem=args.mem, gui=args.gui, name=name, template=args.template,
+                            nodes=args.nodes)
         try_to_attach(job_id)
         return
 
     # Print the list if that is all that is required
+    if args.watch:
+        watch_jobs(args.watch, as_json=args.json, probe=args.probe)
+        return
+
     if args.list:
-        if job_list:
-            print_jobs(job_list)
+        job_list = get_jobs(refresh=args.refresh)
+        if job_list is None:
+            sys.exit(1)
+        probes   = probe_jobs(job_list) if job_list and args.probe else None
+        if args.json:
+            print(jobs_json(job_list or OrderedDict(), probes))
+        elif job_list:
+            print_jobs(job_list, probes)
         else:
             print("No running jobs")
         return
 
+    # Connect to the GUI of a running job
+    if args.cg:
+        job_list = get_jobs(refresh=args.refresh)
+        if job_list is None and not args.job_id:
+            sys.exit(1)
+        if not args.job_id:
+            print("Job ID required when using --connect-gui\n", file=stderr)
+            if job_list:
+                print_jobs(job_list)
+            else:
+                print("No running jobs")
+            return
+        try_to_attach(find_job_id(args.job_id, job_list or {}), attempt_gui=True)
+        return
+
     # If a job ID is specified, just jump straight to attachment
     if args.job_id:
+        job_list = get_jobs(refresh=args.refresh)
+        if job_list is None:
+            sys.exit(1)
         if job_list:
+            job_id = find_job_id(args.job_id, job_list)
             try:
-                if job_list[args.job_id]:
-                    try_to_attach(args.job_id)
+                if job_list[job_id]:
+                    try_to_attach(job_id)
             except KeyError:
-                print("Job ID {} does not exist, it may be complete already\n".format(args.job_id))
+                print("Job ID {} does not exist, it may be complete already\n".format(job_id))
                 print_jobs(job_list)
         else:
             print("No jobs running, please do not provide a job id")
         return
 
-    if xpra_installed and job_list and args.cg:
-        if not args.job_id:
-            print("Job ID required when using --connect-gui\n", file=stderr)
-            if job_list:
-                print_jobs(job_list)
-            else:
-                print("No running jobs")
-            return
-        try_to_attach(args.connect, attempt_gui=True)
-        return
-
-    # Check if we are already in a session
+    # Check if we are already in a session, no queue needed
     if check_state() == 'tmux':
-        set_display(type)
+        set_display('tmux')
         return
 
     # Start the job creation and connection system
-    gui = args.gui if xpra_installed else ''
-    vnc = args.vnc if vnc_installed else ''
+    gui = args.gui if xpra_installed() else ''
+    vnc = args.vnc if vnc_installed() else ''
 
-    check_list_and_run(job_list, args.cores, args.mem, args.name, gui, vnc)
+    # No scan, no way to tell whether a session is already there
+    job_list = get_jobs(refresh=args.refresh)
+    if job_list is None:
+        sys.exit(1)
+    check_list_and_run(job_list, args.cores, args.mem, name, gui, vnc, args.template,
+                       args.nodes)
 
 # The end
 if __name__ == '__main__':